@@ -5,28 +5,16 @@ This module adds a new endpoint to the GlassRain API for tracking checkout event
 and can be expanded to support actual API integration with retailers.
 """
 
-import os
-import json
 import logging
-import psycopg2
+import db_pool
+import checkout_ingest
 from flask import request, jsonify
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 def get_db_connection():
-    """Get a connection to the PostgreSQL database"""
-    try:
-        conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
-        conn.autocommit = True
-        return conn
-    except Exception as e:
-        logger.error(f"Database connection error: {str(e)}")
-        return None
+    """Get a pooled connection to the PostgreSQL database"""
+    return db_pool.get_db_connection()
 
 def track_checkout_endpoint():
     """
@@ -53,19 +41,39 @@ def track_checkout_endpoint():
     try:
         # Get data from request
         data = request.get_json()
-        if not data:
-            return jsonify({'status': 'error', 'message': 'No data provided'}), 400
-        
-        # Validate required fields
-        required_fields = ['store_id', 'store_name', 'products', 'total_value']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'status': 'error', 'message': f'Missing required field: {field}'}), 400
+        event, error = checkout_ingest.validate(data)
+        if error:
+            return jsonify({'status': 'error', 'message': error}), 400
         
         # Log checkout event
-        logger.info(f"Checkout event: {json.dumps(data)}")
+        # Sampled (LOG_SAMPLE_RATES); the events themselves are kept in checkout_events
+        logger.info("Checkout event", extra={
+            'event': 'checkout',
+            'event_key': event['event_key'],
+            'store_id': data['store_id'],
+            'total_value': event['total_value'],
+            'product_count': len(data['products']),
+        })
+        
+        if checkout_ingest.is_buffered():
+            # Written behind by the checkout writer in batches
+            if not checkout_ingest.submit(event):
+                response = jsonify({'status': 'error', 'message': 'Checkout tracking is busy, try again shortly'})
+                response.headers['Retry-After'] = '1'
+                return response, 503
+            
+            result = {
+                'status': 'success',
+                'message': 'Checkout event queued',
+                'event_id': event['event_key']
+            }
+            if data['store_id'] == 5:  # Amazon
+                result['message'] = 'Checkout event queued and integrated with Amazon'
+                result['amazon_url'] = integrate_with_amazon(data)
+            return jsonify(result), 202
         
         # Save to database
+        checkout_ingest.ready()
         conn = get_db_connection()
         if conn:
             try:
@@ -73,15 +81,10 @@ def track_checkout_endpoint():
                 
                 # Insert into checkout_events table
                 cursor.execute("""
-                    INSERT INTO checkout_events (store_id, store_name, products, total_value)
-                    VALUES (%s, %s, %s, %s)
+                    INSERT INTO checkout_events (event_key, store_id, store_name, products, total_value, created_at)
+                    VALUES (%s, %s, %s, %s, %s, %s)
                     RETURNING id
-                """, (
-                    data['store_id'],
-                    data['store_name'],
-                    json.dumps(data['products']),
-                    data['total_value']
-                ))
+                """, checkout_ingest.event_row(event))
                 
                 event_id = cursor.fetchone()[0]
                 
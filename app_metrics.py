@@ -0,0 +1,377 @@
+"""
+Application Metrics
+
+Prometheus metrics for the API, served in the text exposition format on
+/metrics:
+
+- requests per route, method and status code, and a latency histogram
+  per route
+- database statements and time per request (histograms per route), and
+  statement totals for the whole process
+- connection pool utilization, cache hits and misses with their hit ratio,
+  the contractor index and checkout queue depth
+
+Gunicorn runs several worker processes, and each one only sees its own
+requests. So every worker writes a snapshot of its metrics to a file in
+METRICS_DIR, every METRICS_FLUSH_INTERVAL seconds and when it exits. A
+scrape, whichever worker answers it, merges the files of all workers of
+the same server: counters and histograms are summed, including those of
+workers that have since exited, and gauges are summed over the live ones.
+
+Configuration:
+- METRICS_DIR: directory for the per-worker snapshots (default: <tmp>/glassrain-metrics)
+- METRICS_FLUSH_INTERVAL: seconds between snapshots (default 10)
+"""
+
+import os
+import json
+import time
+import atexit
+import shutil
+import logging
+import tempfile
+import threading
+
+from flask import Response, request
+
+import db_pool
+import catalog_cache
+import geocoding
+import contractor_index
+import checkout_ingest
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'glassrain-metrics')
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 10))
+
+PREFIX = 'glassrain_'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+HELP = {
+    'http_requests_total': "HTTP requests by route, method and status code",
+    'http_request_duration_seconds': "HTTP request latency by route",
+    'http_request_db_queries': "Database statements run while serving a request",
+    'http_request_db_seconds': "Database time spent while serving a request",
+    'db_queries_total': "Database statements run on pooled connections",
+    'db_query_seconds_total': "Time spent in database statements",
+    'db_pool_connections': "Pooled database connections by state",
+    'db_pool_max_connections': "Upper bound of pooled database connections",
+    'db_pool_checkouts_total': "Connections checked out of the pool",
+    'db_pool_waits_total': "Checkouts that had to wait for a free connection",
+    'db_pool_timeouts_total': "Checkouts that gave up waiting",
+    'cache_hits_total': "Cache hits by cache",
+    'cache_misses_total': "Cache misses by cache",
+    'cache_hit_ratio': "Share of cache lookups that were hits, by cache",
+    'contractor_index_lookups_total': "Contractor index lookups",
+    'contractor_index_matches_total': "Contractor index lookups that found a match",
+    'checkout_queue_depth': "Checkout events waiting to be written",
+    'checkout_queue_capacity': "Checkout events the queue can hold",
+}
+
+TYPES = {
+    'http_requests_total': 'counter',
+    'http_request_duration_seconds': 'histogram',
+    'http_request_db_queries': 'histogram',
+    'http_request_db_seconds': 'histogram',
+    'db_queries_total': 'counter',
+    'db_query_seconds_total': 'counter',
+    'db_pool_connections': 'gauge',
+    'db_pool_max_connections': 'gauge',
+    'db_pool_checkouts_total': 'counter',
+    'db_pool_waits_total': 'counter',
+    'db_pool_timeouts_total': 'counter',
+    'cache_hits_total': 'counter',
+    'cache_misses_total': 'counter',
+    'cache_hit_ratio': 'gauge',
+    'contractor_index_lookups_total': 'counter',
+    'contractor_index_matches_total': 'counter',
+    'checkout_queue_depth': 'gauge',
+    'checkout_queue_capacity': 'gauge',
+}
+
+
+class Registry:
+    """Counters and histograms of one process, keyed by name and labels"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, labels=(), amount=1):
+        """Add to a counter"""
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets, labels=()):
+        """Record a value in a histogram with the given upper bucket bounds"""
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "bounds": list(buckets), "counts": [0] * len(buckets), "sum": 0.0, "count": 0
+                }
+            for i, bound in enumerate(histogram["bounds"]):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self):
+        """Counters and histograms as JSON-ready lists"""
+        with self._lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                "histograms": [
+                    [name, list(labels), dict(histogram, counts=list(histogram["counts"]))]
+                    for (name, labels), histogram in self._histograms.items()
+                ],
+            }
+
+
+_registry = Registry()
+_request_state = threading.local()
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _observe_query(statement, seconds):
+    _registry.inc('db_queries_total')
+    _registry.inc('db_query_seconds_total', amount=seconds)
+    if getattr(_request_state, 'active', False):
+        _request_state.queries += 1
+        _request_state.db_seconds += seconds
+
+
+def collect_gauges():
+    """Sample the subsystems' own counters as [name, labels, value] entries"""
+    gauges = []
+    counters = []
+
+    pool = db_pool.pool_stats()
+    if pool:
+        gauges.append(['db_pool_connections', [['state', 'in_use']], pool['in_use']])
+        gauges.append(['db_pool_connections', [['state', 'idle']], pool['idle']])
+        gauges.append(['db_pool_max_connections', [], pool['max']])
+        counters.append(['db_pool_checkouts_total', [], pool['checkouts']])
+        counters.append(['db_pool_waits_total', [], pool['waits']])
+        counters.append(['db_pool_timeouts_total', [], pool['timeouts']])
+
+    catalog = catalog_cache.stats()
+    geocode = geocoding.stats()
+    for cache, hits, misses in (
+        ('catalog', catalog['hits'], catalog['misses']),
+        ('geocode', geocode['memory_hits'] + geocode['db_hits'], geocode['misses']),
+    ):
+        counters.append(['cache_hits_total', [['cache', cache]], hits])
+        counters.append(['cache_misses_total', [['cache', cache]], misses])
+
+    index = contractor_index.stats()
+    counters.append(['contractor_index_lookups_total', [], index['lookups']])
+    counters.append(['contractor_index_matches_total', [], index['matches']])
+
+    checkout = checkout_ingest.stats()
+    gauges.append(['checkout_queue_depth', [], checkout['queue_depth']])
+    gauges.append(['checkout_queue_capacity', [], checkout['queue_capacity']])
+    return gauges, counters
+
+
+def _server_dir():
+    # Workers of one gunicorn server share their master's pid as parent
+    return os.path.join(METRICS_DIR, str(os.getppid()))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+
+
+def _remove_stale_servers():
+    # Snapshots of servers that are gone would otherwise add up forever
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return
+    for name in names:
+        if name.isdigit() and not _pid_alive(int(name)):
+            shutil.rmtree(os.path.join(METRICS_DIR, name), ignore_errors=True)
+
+
+def write_snapshot():
+    """Write this worker's metrics to its file in the server's metrics directory"""
+    directory = _server_dir()
+    try:
+        gauges, sampled = collect_gauges()
+    except Exception as e:
+        logger.warning(f"Error sampling metrics: {str(e)}")
+        gauges, sampled = [], []
+    data = _registry.snapshot()
+    data["counters"].extend(sampled)
+    data["gauges"] = gauges
+    data["pid"] = os.getpid()
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"worker-{os.getpid()}.json")
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.warning(f"Error writing metrics snapshot: {str(e)}")
+
+
+def read_snapshots():
+    """Merge the snapshots of every worker of this server"""
+    counters = {}
+    histograms = {}
+    gauges = {}
+    directory = _server_dir()
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        names = []
+
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for metric, labels, value in data.get("counters", []):
+            key = (metric, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for metric, labels, histogram in data.get("histograms", []):
+            key = (metric, tuple(tuple(label) for label in labels))
+            merged = histograms.setdefault(key, {
+                "bounds": histogram["bounds"], "counts": [0] * len(histogram["bounds"]), "sum": 0.0, "count": 0
+            })
+            merged["counts"] = [a + b for a, b in zip(merged["counts"], histogram["counts"])]
+            merged["sum"] += histogram["sum"]
+            merged["count"] += histogram["count"]
+        # Gauges describe the present, so only live workers count
+        if _pid_alive(data.get("pid", 0)):
+            for metric, labels, value in data.get("gauges", []):
+                key = (metric, tuple(tuple(label) for label in labels))
+                gauges[key] = gauges.get(key, 0) + value
+
+    for (metric, labels), hits in list(counters.items()):
+        if metric == 'cache_hits_total':
+            lookups = hits + counters.get(('cache_misses_total', labels), 0)
+            gauges[('cache_hit_ratio', labels)] = hits / lookups if lookups else 0.0
+    return counters, histograms, gauges
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """All workers' metrics in the Prometheus text exposition format"""
+    counters, histograms, gauges = read_snapshots()
+    by_name = {}
+    for (metric, labels), value in list(counters.items()) + list(gauges.items()):
+        by_name.setdefault(metric, []).append((labels, value))
+    for (metric, labels), histogram in histograms.items():
+        by_name.setdefault(metric, []).append((labels, histogram))
+
+    lines = []
+    for metric in sorted(by_name):
+        full_name = PREFIX + metric
+        kind = TYPES.get(metric, 'untyped')
+        lines.append(f"# HELP {full_name} {HELP.get(metric, metric)}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for labels, value in sorted(by_name[metric], key=lambda entry: entry[0]):
+            if kind != 'histogram':
+                lines.append(f"{full_name}{_labels(labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(value["bounds"], value["counts"]):
+                cumulative += count
+                lines.append(f"{full_name}_bucket{_labels(labels, [('le', _number(float(bound)))])} {cumulative}")
+            lines.append(f"{full_name}_bucket{_labels(labels, [('le', '+Inf')])} {value['count']}")
+            lines.append(f"{full_name}_sum{_labels(labels)} {_number(float(value['sum']))}")
+            lines.append(f"{full_name}_count{_labels(labels)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        write_snapshot()
+
+
+def _start():
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        # Threads do not survive a fork, so each worker starts its own
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+        _remove_stale_servers()
+        threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+        atexit.register(write_snapshot)
+
+
+def _before_request():
+    _start()
+    _request_state.active = True
+    _request_state.started = time.perf_counter()
+    _request_state.queries = 0
+    _request_state.db_seconds = 0.0
+
+
+def _after_request(response):
+    if not getattr(_request_state, 'active', False):
+        return response
+    _request_state.active = False
+    elapsed = time.perf_counter() - _request_state.started
+    # The route pattern, not the URL, so ids do not create new series
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    _registry.inc('http_requests_total', [('route', route), ('method', request.method), ('status', str(response.status_code))])
+    _registry.observe('http_request_duration_seconds', elapsed, LATENCY_BUCKETS, [('route', route)])
+    _registry.observe('http_request_db_queries', _request_state.queries, QUERY_COUNT_BUCKETS, [('route', route)])
+    _registry.observe('http_request_db_seconds', _request_state.db_seconds, LATENCY_BUCKETS, [('route', route)])
+    return response
+
+
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    write_snapshot()
+    return Response(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def instrument(app):
+    """Record metrics for every request to ``app`` and serve them on /metrics"""
+    db_pool.add_query_observer(_observe_query)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
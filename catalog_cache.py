@@ -0,0 +1,228 @@
+"""
+Catalog Cache
+
+In-process cache for the nearly static catalog data served by the API
+(service categories, services, tiers, stores, store categories and product
+listings).
+
+Entries expire after a per-key TTL, the cache is bounded with LRU eviction,
+and every entry records the tables it was built from so that a change to one
+table only drops the entries that depend on it. The cache subscribes to
+PostgreSQL LISTEN/NOTIFY through db_notify (see init_catalog_notifications()
+in init_db.py) so edits to the catalog are visible immediately instead of
+after the TTL.
+
+Product listings and single products live in a separate, smaller cache, so
+the many filter combinations clients can ask for never evict the handful of
+catalog entries every page needs.
+
+Configuration:
+- CATALOG_CACHE_TTL: default entry lifetime in seconds (default 300)
+- CATALOG_CACHE_SIZE: maximum number of entries (default 256)
+- CATALOG_PRODUCTS_CACHE_SIZE: maximum number of product entries (default 128)
+- CATALOG_CACHE_LISTEN: set to 0 to disable the LISTEN/NOTIFY subscriber
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import db_notify
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'catalog_changed'
+
+
+class CatalogCache:
+    """Thread-safe TTL + LRU cache with table-based invalidation"""
+
+    def __init__(self, max_entries=256, default_ttl=300.0):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (value, expires_at, tables)
+        self._generation = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+
+    def generation(self):
+        """Return a counter that changes on every invalidation"""
+        with self._lock:
+            return self._generation
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            value, expires_at, _ = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def put(self, key, value, tables=(), ttl=None, generation=None):
+        """
+        Store a value that was built from the given tables.
+
+        If ``generation`` is passed (the value of generation() taken before
+        the data was loaded) and an invalidation happened in the meantime,
+        the value is dropped so stale data is never cached.
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            self._entries[key] = (value, time.monotonic() + ttl, frozenset(tables))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+            return True
+
+    def invalidate(self, key):
+        """Drop a single key"""
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(key, None) is not None:
+                self._stats["invalidations"] += 1
+
+    def invalidate_table(self, table):
+        """Drop every entry that was built from the given table"""
+        with self._lock:
+            self._generation += 1
+            stale = [key for key, entry in self._entries.items() if table in entry[2]]
+            for key in stale:
+                del self._entries[key]
+            self._stats["invalidations"] += len(stale)
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._generation += 1
+            self._stats["invalidations"] += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit/miss counters and the current size"""
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["size"] = len(self._entries)
+            snapshot["max_entries"] = self.max_entries
+        lookups = snapshot["hits"] + snapshot["misses"]
+        snapshot["hit_ratio"] = snapshot["hits"] / lookups if lookups else 0.0
+        return snapshot
+
+
+def _env_number(name, default, cast=int):
+    try:
+        return cast(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid value for {name}, using {default}")
+        return default
+
+
+_default = CatalogCache(
+    max_entries=_env_number('CATALOG_CACHE_SIZE', 256),
+    default_ttl=_env_number('CATALOG_CACHE_TTL', 300.0, float),
+)
+_products = CatalogCache(
+    max_entries=_env_number('CATALOG_PRODUCTS_CACHE_SIZE', 128),
+    default_ttl=_env_number('CATALOG_CACHE_TTL', 300.0, float),
+)
+_subscribe_lock = threading.Lock()
+_subscribed = False
+
+
+def _on_catalog_change(table):
+    if table:
+        invalidate_table(table)
+    else:
+        clear()
+
+
+def start_listener():
+    """Subscribe the cache to catalog change notifications"""
+    global _subscribed
+    if os.environ.get('CATALOG_CACHE_LISTEN', '1') == '0':
+        return
+    if not _subscribed:
+        with _subscribe_lock:
+            if not _subscribed:
+                _subscribed = True
+                # Anything may have changed while the listener was not connected
+                db_notify.subscribe(NOTIFY_CHANNEL, _on_catalog_change, on_connect=clear)
+    # A forked worker inherits the subscription but not the listener thread
+    db_notify.start()
+
+
+def get(key):
+    """Return a cached catalog value, or None"""
+    start_listener()
+    return _default.get(key)
+
+
+def put(key, value, tables=(), ttl=None, generation=None):
+    """Cache a catalog value built from the given tables"""
+    return _default.put(key, value, tables=tables, ttl=ttl, generation=generation)
+
+
+def generation():
+    """Snapshot to pass to put() so concurrent invalidations are not lost"""
+    return _default.generation()
+
+
+def get_product(key):
+    """Return a cached product listing or product, or None"""
+    start_listener()
+    return _products.get(key)
+
+
+def put_product(key, value, tables=(), ttl=None, generation=None):
+    """Cache a product listing or product built from the given tables"""
+    return _products.put(key, value, tables=tables, ttl=ttl, generation=generation)
+
+
+def product_generation():
+    """Snapshot to pass to put_product() so concurrent invalidations are not lost"""
+    return _products.generation()
+
+
+def invalidate(key):
+    """Drop a single cached key"""
+    _default.invalidate(key)
+    _products.invalidate(key)
+
+
+def invalidate_table(table):
+    """Drop every cached value that depends on a table"""
+    _default.invalidate_table(table)
+    _products.invalidate_table(table)
+
+
+def clear():
+    """Drop the whole catalog cache"""
+    _default.clear()
+    _products.clear()
+
+
+def stats():
+    """Return catalog cache counters"""
+    snapshot = _default.stats()
+    snapshot["products"] = _products.stats()
+    return snapshot
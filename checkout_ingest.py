@@ -0,0 +1,392 @@
+"""
+Checkout Event Ingestion
+
+Write-behind buffer for /api/track_checkout. Validated checkout events are
+put on a bounded in-memory queue and a background writer inserts them in
+batches with one multi-row INSERT, so the request thread never waits on
+the database.
+
+A batch is flushed when it reaches CHECKOUT_FLUSH_SIZE events or when
+CHECKOUT_FLUSH_INTERVAL seconds have passed since its first event. When the
+queue is full, submit() waits briefly and then refuses the event so the
+endpoint can answer 503 (backpressure) instead of growing without bound.
+
+If a batch cannot be written (database down), it is appended to a spill
+file under CHECKOUT_SPILL_DIR and fsynced. Spill files are replayed once the
+database is reachable again. Each worker appends to its own
+checkout-<pid>.jsonl and replays only its own file and those of workers
+that have exited, never a file another live worker may still be appending
+to. Every event carries a unique event_key and is inserted with ON CONFLICT
+DO NOTHING, so replaying a file twice is harmless.
+
+Only failures that may pass are retried. A batch the database refuses
+outright (a schema or data error) is logged and set aside in a
+dead-<pid>-<ns>.jsonl file in the same directory, to be inspected and
+replayed by hand. The checkout_events table and its event_key column are
+created the first time a worker writes (see ready()).
+
+Configuration:
+- CHECKOUT_INGEST_MODE: 'buffered' (default) or 'direct' for one INSERT per request
+- CHECKOUT_QUEUE_SIZE: events held in memory per worker (default 5000)
+- CHECKOUT_FLUSH_SIZE: events per INSERT (default 200)
+- CHECKOUT_FLUSH_INTERVAL: seconds before a partial batch is written (default 1)
+- CHECKOUT_SPILL_DIR: directory for events that could not be written (default
+  checkout-spill on the /var/data persistent disk when it is mounted, else
+  the temporary directory, which does not survive a redeploy)
+"""
+
+import os
+import re
+import glob
+import json
+import time
+import uuid
+import queue
+import atexit
+import logging
+import tempfile
+import threading
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import db_pool
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = int(os.environ.get('CHECKOUT_QUEUE_SIZE', 5000))
+FLUSH_SIZE = int(os.environ.get('CHECKOUT_FLUSH_SIZE', 200))
+FLUSH_INTERVAL = float(os.environ.get('CHECKOUT_FLUSH_INTERVAL', 1))
+# Mount point of the Render persistent disk (see RENDER_DEPLOYMENT_GUIDE.md)
+PERSISTENT_DISK = '/var/data'
+
+SPILL_DIR = os.environ.get('CHECKOUT_SPILL_DIR') or (
+    os.path.join(PERSISTENT_DISK, 'checkout-spill') if os.path.isdir(PERSISTENT_DISK)
+    else os.path.join(tempfile.gettempdir(), 'glassrain-checkout-spill')
+)
+
+# Seconds submit() waits for room in a full queue before refusing an event
+ENQUEUE_TIMEOUT = 0.05
+
+# Seconds between attempts to replay spill files
+REPLAY_INTERVAL = 30
+
+# checkout-<pid>.jsonl is appended to by a worker; checkout-<pid>-<ns>.jsonl
+# is a closed file put back after a failed replay
+SPILL_FILE = re.compile(r"checkout-(\d+)(-\d+)?\.jsonl$")
+
+# Errors that retrying the same events cannot fix
+PERMANENT_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, psycopg2.ProgrammingError)
+
+REQUIRED_FIELDS = ['store_id', 'store_name', 'products', 'total_value']
+
+INSERT_SQL = """
+    INSERT INTO checkout_events (event_key, store_id, store_name, products, total_value, created_at)
+    VALUES %s
+    ON CONFLICT (event_key) DO NOTHING
+"""
+
+
+def is_buffered():
+    """Whether checkout events are written behind by the background writer"""
+    return os.environ.get('CHECKOUT_INGEST_MODE', 'buffered') != 'direct'
+
+
+def validate(data):
+    """Return (event, None) for a valid payload or (None, error message)"""
+    if not data:
+        return None, 'No data provided'
+    for field in REQUIRED_FIELDS:
+        if field not in data:
+            return None, f'Missing required field: {field}'
+    if not isinstance(data['products'], list):
+        return None, 'products must be a list'
+    try:
+        total_value = float(data['total_value'])
+    except (TypeError, ValueError):
+        return None, 'total_value must be a number'
+
+    event = {
+        'event_key': uuid.uuid4().hex,
+        'store_id': data['store_id'],
+        'store_name': data['store_name'],
+        'products': json.dumps(data['products']),
+        'total_value': total_value,
+        'created_at': datetime.utcnow().isoformat(),
+    }
+    return event, None
+
+
+def event_row(event):
+    """Column values for one event in INSERT_SQL order"""
+    return (
+        event['event_key'],
+        event['store_id'],
+        event['store_name'],
+        event['products'],
+        event['total_value'],
+        event['created_at'],
+    )
+
+
+def write_events(events):
+    """Insert events with one multi-row INSERT; raises if they were not written"""
+    if not ready():
+        raise RuntimeError("checkout_events table unavailable")
+    conn = db_pool.get_db_connection()
+    if not conn:
+        raise RuntimeError("Database connection failed")
+    try:
+        cursor = conn.cursor()
+        execute_values(cursor, INSERT_SQL, [event_row(event) for event in events], page_size=len(events))
+        cursor.close()
+    finally:
+        conn.close()
+
+
+def ensure_checkout_table(dsn=None):
+    """Ensure the checkout_events table exists with the event_key column"""
+    conn = db_pool.get_db_connection(dsn)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS checkout_events (
+                id SERIAL PRIMARY KEY,
+                store_id INTEGER,
+                store_name VARCHAR(255),
+                products JSONB,
+                total_value NUMERIC(10, 2),
+                created_at TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        cursor.execute("ALTER TABLE checkout_events ADD COLUMN IF NOT EXISTS event_key TEXT")
+        cursor.execute("ALTER TABLE checkout_events ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT NOW()")
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_checkout_events_event_key
+            ON checkout_events (event_key)
+        """)
+        cursor.close()
+        return True
+    except Exception as e:
+        logger.error(f"Error creating checkout_events table: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+
+_table_lock = threading.Lock()
+_table_ready = False
+
+
+def ready():
+    """Whether checkout_events has the event_key column, creating it if needed"""
+    global _table_ready
+    if _table_ready:
+        return True
+    with _table_lock:
+        if not _table_ready:
+            _table_ready = ensure_checkout_table()
+    return _table_ready
+
+
+class CheckoutWriter:
+    """Bounded queue of checkout events drained in batches by a background thread"""
+
+    def __init__(self, max_queue=QUEUE_SIZE, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 spill_dir=SPILL_DIR, write=write_events):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.spill_dir = spill_dir
+        self.write = write
+        self._lock = threading.Lock()
+        self._pid = None
+        self._last_replay = 0.0
+        self._stats = {
+            "accepted": 0, "rejected": 0, "written": 0, "batches": 0,
+            "write_errors": 0, "spilled": 0, "replayed": 0, "dead_lettered": 0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def start(self):
+        """Start the writer thread for this process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            # Threads do not survive a fork, so each worker starts its own
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='checkout-writer', daemon=True).start()
+            atexit.register(self.drain)
+
+    def submit(self, event, timeout=ENQUEUE_TIMEOUT):
+        """Queue an event; False if the queue stayed full for ``timeout`` seconds"""
+        self.start()
+        try:
+            self.queue.put(event, timeout=timeout)
+        except queue.Full:
+            self._count("rejected")
+            return False
+        self._count("accepted")
+        return True
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=REPLAY_INTERVAL)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch):
+        """Write a batch, spilling it to disk if the database rejects it"""
+        if not batch:
+            return
+        try:
+            self.write(batch)
+            self._count("written", len(batch))
+            self._count("batches")
+        except PERMANENT_ERRORS as e:
+            self._count("write_errors")
+            logger.error(f"Database refused {len(batch)} checkout events, setting them aside: {str(e)}")
+            self.dead_letter(batch)
+        except Exception as e:
+            self._count("write_errors")
+            logger.error(f"Error writing {len(batch)} checkout events: {str(e)}")
+            self.spill(batch)
+
+    def _append(self, name, batch):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        with open(os.path.join(self.spill_dir, name), 'a') as spill_file:
+            for event in batch:
+                spill_file.write(json.dumps(event) + "\n")
+            spill_file.flush()
+            os.fsync(spill_file.fileno())
+
+    def spill(self, batch):
+        """Append events to a spill file and fsync it"""
+        try:
+            self._append(f"checkout-{os.getpid()}.jsonl", batch)
+            self._count("spilled", len(batch))
+        except Exception as e:
+            logger.error(f"Error spilling {len(batch)} checkout events, events lost: {str(e)}")
+
+    def dead_letter(self, batch):
+        """Set aside events the database refused, so they are not retried"""
+        try:
+            self._append(f"dead-{os.getpid()}-{time.time_ns()}.jsonl", batch)
+            self._count("dead_lettered", len(batch))
+        except Exception as e:
+            logger.error(f"Error setting aside {len(batch)} checkout events, events lost: {str(e)}")
+
+    def replay_spilled(self):
+        """Write events from spill files back to the database"""
+        self._last_replay = time.monotonic()
+        for path in sorted(glob.glob(os.path.join(self.spill_dir, "checkout-*.jsonl"))):
+            if not _replayable(path):
+                continue
+            # Renaming claims the file, so two workers never replay it together
+            claimed = f"{path}.{os.getpid()}.replay"
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            try:
+                with open(claimed) as spill_file:
+                    events = [json.loads(line) for line in spill_file if line.strip()]
+                for start in range(0, len(events), self.flush_size):
+                    self.write(events[start:start + self.flush_size])
+                os.remove(claimed)
+                self._count("replayed", len(events))
+                logger.info(f"Replayed {len(events)} spilled checkout events")
+            except PERMANENT_ERRORS as e:
+                logger.error(f"Database refused spilled checkout events, setting them aside: {str(e)}")
+                os.rename(claimed, os.path.join(self.spill_dir, f"dead-{os.getpid()}-{time.time_ns()}.jsonl"))
+            except Exception as e:
+                logger.warning(f"Could not replay spilled checkout events yet: {str(e)}")
+                os.rename(claimed, os.path.join(self.spill_dir, f"checkout-{os.getpid()}-{time.time_ns()}.jsonl"))
+                return
+
+    def _spill_pending(self):
+        return os.path.isdir(self.spill_dir) and any(
+            _replayable(path) for path in glob.glob(os.path.join(self.spill_dir, "checkout-*.jsonl"))
+        )
+
+    def _run(self):
+        while True:
+            try:
+                self.flush(self._next_batch())
+                if time.monotonic() - self._last_replay >= REPLAY_INTERVAL and self._spill_pending():
+                    self.replay_spilled()
+            except Exception as e:
+                logger.error(f"Checkout writer error: {str(e)}")
+
+    def drain(self):
+        """Write (or spill) everything still queued; used at shutdown"""
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.flush_size:
+                self.flush(batch)
+                batch = []
+        self.flush(batch)
+
+    def stats(self):
+        """Return ingestion counters and the current queue depth"""
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["queue_depth"] = self.queue.qsize()
+        snapshot["queue_capacity"] = self.queue.maxsize
+        return snapshot
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _replayable(path):
+    """Whether no other live worker can still be appending to a spill file"""
+    match = SPILL_FILE.search(os.path.basename(path))
+    if not match:
+        return False
+    pid = int(match.group(1))
+    return bool(match.group(2)) or pid == os.getpid() or not _pid_alive(pid)
+
+
+_writer = CheckoutWriter()
+
+
+def submit(event):
+    """Queue a validated event on the shared writer"""
+    return _writer.submit(event)
+
+
+def stats():
+    """Return checkout ingestion counters"""
+    return _writer.stats()
@@ -0,0 +1,368 @@
+"""
+Contractor Match Index
+
+In-memory index used by /api/match-contractor so that matching a service
+and zipcode to the best contractor is a dictionary lookup instead of a
+three-table join per request.
+
+For every (service_id, zipcode) pair the index keeps the contractors that
+offer the service there, pre-ranked the same way the old SQL did (Diamond,
+Gold, Standard, then rating), so the best match is the head of one list.
+
+The index is built once per worker and then kept current incrementally:
+init_contractor_notifications() in init_db.py installs triggers that send
+the id of every changed contractor (including tier and rating updates made
+by the review analyzer) on the 'contractor_changed' channel. The listener
+only collects the ids; a refresher thread reloads everything that changed
+within CONTRACTOR_REFRESH_DELAY seconds in one batch, so a 500-row UPDATE
+costs three queries rather than 1500 and never holds up other channels. A
+full rebuild still runs in the background every CONTRACTOR_INDEX_TTL
+seconds as a safety net.
+
+Configuration:
+- CONTRACTOR_INDEX_TTL: seconds between safety-net rebuilds (default 600)
+- CONTRACTOR_REFRESH_DELAY: seconds notifications are collected before a
+  batch refresh (default 0.2)
+"""
+
+import os
+import time
+import bisect
+import logging
+import threading
+
+from psycopg2.extras import RealDictCursor
+
+import db_pool
+import db_notify
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'contractor_changed'
+
+CONTRACTOR_INDEX_TTL = float(os.environ.get('CONTRACTOR_INDEX_TTL', 600))
+CONTRACTOR_REFRESH_DELAY = float(os.environ.get('CONTRACTOR_REFRESH_DELAY', 0.2))
+
+TIER_ORDER = {'Diamond': 0, 'Gold': 1, 'Standard': 2}
+
+CONTRACTOR_COLUMNS = """
+    c.id, c.name, c.description, c.contact_email,
+    c.contact_phone, c.website, c.logo_url, c.rating,
+    c.tier_level
+"""
+
+SERVICE_COLUMNS = "s.id, s.name, s.description, s.base_price"
+
+
+def _key(value):
+    """Normalize ids and zipcodes from JSON or the database to one form"""
+    return str(value).strip()
+
+
+def rank_key(contractor):
+    """Sort key reproducing the tier-then-rating order of the matching query"""
+    return (
+        TIER_ORDER.get(contractor.get('tier_level'), len(TIER_ORDER)),
+        -float(contractor.get('rating') or 0),
+        _key(contractor['id']),
+    )
+
+
+class ContractorIndex:
+    """Pre-ranked contractors per service plus service areas per contractor"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._contractors = {}     # contractor key -> contractor row
+        self._ranked = {}          # (service key, zipcode) -> sorted [(rank_key, contractor key)]
+        self._services_of = {}     # contractor key -> set of service keys
+        self._areas = {}           # contractor key -> set of zipcodes
+        self._services = {}        # service key -> service row
+        self._building = False
+        self._changed_while_building = set()
+        self.loaded_at = None
+        self._stats = {"lookups": 0, "matches": 0, "rebuilds": 0, "contractor_refreshes": 0}
+
+    def is_loaded(self):
+        """Whether the index has been built at least once"""
+        return self.loaded_at is not None
+
+    def is_stale(self):
+        """Whether the safety-net rebuild interval has passed"""
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > CONTRACTOR_INDEX_TTL
+
+    def load(self, cursor):
+        """Rebuild the whole index from the database"""
+        with self._lock:
+            self._building = True
+            self._changed_while_building = set()
+        try:
+            cursor.execute(f"SELECT {CONTRACTOR_COLUMNS} FROM contractors c")
+            contractors = {_key(row['id']): dict(row) for row in cursor.fetchall()}
+
+            cursor.execute("SELECT contractor_id, service_id FROM contractor_services")
+            services_of = {}
+            for row in cursor.fetchall():
+                services_of.setdefault(_key(row['contractor_id']), set()).add(_key(row['service_id']))
+
+            cursor.execute("SELECT contractor_id, zipcode FROM contractor_service_areas")
+            areas = {}
+            for row in cursor.fetchall():
+                areas.setdefault(_key(row['contractor_id']), set()).add(_key(row['zipcode']))
+
+            cursor.execute(f"SELECT {SERVICE_COLUMNS} FROM services s")
+            services = {_key(row['id']): dict(row) for row in cursor.fetchall()}
+
+            ranked = {}
+            for contractor_key, service_keys in services_of.items():
+                contractor = contractors.get(contractor_key)
+                if contractor is None:
+                    continue
+                entry = (rank_key(contractor), contractor_key)
+                for service_key in service_keys:
+                    for zipcode in areas.get(contractor_key, ()):
+                        ranked.setdefault((service_key, zipcode), []).append(entry)
+            for entries in ranked.values():
+                entries.sort()
+
+            with self._lock:
+                self._contractors = contractors
+                self._ranked = ranked
+                self._services_of = services_of
+                self._areas = areas
+                self._services = services
+                self.loaded_at = time.monotonic()
+                self._stats["rebuilds"] += 1
+                changed = self._changed_while_building
+        finally:
+            with self._lock:
+                self._building = False
+                self._changed_while_building = set()
+
+        # Changes notified during the rebuild may predate the snapshot
+        if changed:
+            self.refresh_contractors(cursor, changed)
+        logger.info(f"Built contractor match index with {len(contractors)} contractors")
+
+    def refresh_contractor(self, cursor, contractor_id):
+        """Reload one contractor's row, services and service areas"""
+        self.refresh_contractors(cursor, [contractor_id])
+
+    def refresh_contractors(self, cursor, contractor_ids):
+        """Reload the rows, services and service areas of many contractors in three queries"""
+        contractor_keys = {_key(contractor_id) for contractor_id in contractor_ids}
+        with self._lock:
+            if self._building:
+                self._changed_while_building.update(contractor_keys)
+
+        # Compared as text because contractor ids are INTEGER or TEXT depending on the deployment
+        keys = list(contractor_keys)
+        cursor.execute(f"SELECT {CONTRACTOR_COLUMNS} FROM contractors c WHERE c.id::text = ANY(%s)", (keys,))
+        rows = {_key(row['id']): dict(row) for row in cursor.fetchall()}
+        cursor.execute(
+            "SELECT contractor_id, service_id FROM contractor_services WHERE contractor_id::text = ANY(%s)", (keys,)
+        )
+        services_of = {}
+        for row in cursor.fetchall():
+            services_of.setdefault(_key(row['contractor_id']), set()).add(_key(row['service_id']))
+        cursor.execute(
+            "SELECT contractor_id, zipcode FROM contractor_service_areas WHERE contractor_id::text = ANY(%s)", (keys,)
+        )
+        areas = {}
+        for row in cursor.fetchall():
+            areas.setdefault(_key(row['contractor_id']), set()).add(_key(row['zipcode']))
+
+        with self._lock:
+            for contractor_key in contractor_keys:
+                self._unindex(contractor_key)
+                contractor = rows.get(contractor_key)
+                if contractor is None:
+                    self._contractors.pop(contractor_key, None)
+                    self._services_of.pop(contractor_key, None)
+                    self._areas.pop(contractor_key, None)
+                    continue
+                self._contractors[contractor_key] = contractor
+                self._services_of[contractor_key] = services_of.get(contractor_key, set())
+                self._areas[contractor_key] = areas.get(contractor_key, set())
+                entry = (rank_key(contractor), contractor_key)
+                for pair in self._pairs(contractor_key):
+                    bisect.insort(self._ranked.setdefault(pair, []), entry)
+            self._stats["contractor_refreshes"] += len(contractor_keys)
+
+    def _pairs(self, contractor_key):
+        return [
+            (service_key, zipcode)
+            for service_key in self._services_of.get(contractor_key, ())
+            for zipcode in self._areas.get(contractor_key, ())
+        ]
+
+    def _unindex(self, contractor_key):
+        """Remove a contractor's ranked entries; the caller holds the lock"""
+        old = self._contractors.get(contractor_key)
+        if old is None:
+            return
+        old_entry = (rank_key(old), contractor_key)
+        for pair in self._pairs(contractor_key):
+            entries = self._ranked.get(pair, [])
+            position = bisect.bisect_left(entries, old_entry)
+            if position < len(entries) and entries[position] == old_entry:
+                del entries[position]
+            if not entries:
+                self._ranked.pop(pair, None)
+
+    def reload_services(self, cursor):
+        """Reload service details after the services table changed"""
+        cursor.execute(f"SELECT {SERVICE_COLUMNS} FROM services s")
+        services = {_key(row['id']): dict(row) for row in cursor.fetchall()}
+        with self._lock:
+            self._services = services
+
+    def ranked(self, service_id, zipcode, limit=None):
+        """Return contractors for a service in a zipcode, best first"""
+        with self._lock:
+            entries = self._ranked.get((_key(service_id), _key(zipcode)), [])
+            return [dict(self._contractors[contractor_key]) for _, contractor_key in entries[:limit]]
+
+    def best_match(self, service_id, zipcode):
+        """Return the best contractor for a service in a zipcode, or None"""
+        matches = self.ranked(service_id, zipcode, limit=1)
+        with self._lock:
+            self._stats["lookups"] += 1
+            if matches:
+                self._stats["matches"] += 1
+        return matches[0] if matches else None
+
+    def service(self, service_id):
+        """Return service details, or None"""
+        with self._lock:
+            service = self._services.get(_key(service_id))
+        return dict(service) if service is not None else None
+
+    def stats(self):
+        """Return lookup counters and the index size"""
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["contractors"] = len(self._contractors)
+            snapshot["services"] = len(self._services)
+            snapshot["service_areas"] = len(self._ranked)
+        return snapshot
+
+
+_index = ContractorIndex()
+_build_lock = threading.Lock()
+_subscribed = False
+_pending_lock = threading.Lock()
+_pending = set()
+_pending_event = threading.Event()
+_refresher_pid = None
+
+
+def _with_cursor(action):
+    conn = db_pool.get_db_connection()
+    if not conn:
+        raise RuntimeError("Database connection failed")
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        result = action(cursor)
+        cursor.close()
+        return result
+    finally:
+        conn.close()
+
+
+def _rebuild(if_unloaded=False):
+    with _build_lock:
+        # Concurrent cold requests wait here for the first build instead of repeating it
+        if if_unloaded and _index.is_loaded():
+            return
+        _with_cursor(_index.load)
+
+
+def _rebuild_in_background():
+    if _build_lock.locked():
+        return
+
+    def run():
+        try:
+            _rebuild()
+        except Exception as e:
+            logger.error(f"Error rebuilding contractor index: {str(e)}")
+    threading.Thread(target=run, name='contractor-index-rebuild', daemon=True).start()
+
+
+def _refresh_loop():
+    while True:
+        _pending_event.wait()
+        # Let the rest of a batch UPDATE's notifications arrive
+        time.sleep(CONTRACTOR_REFRESH_DELAY)
+        with _pending_lock:
+            _pending_event.clear()
+            contractor_keys = set(_pending)
+            _pending.clear()
+        try:
+            if None in contractor_keys:
+                _rebuild()
+            elif contractor_keys:
+                _with_cursor(lambda cursor: _index.refresh_contractors(cursor, contractor_keys))
+        except Exception as e:
+            logger.error(f"Error refreshing contractor index: {str(e)}")
+
+
+def _start_refresher():
+    global _refresher_pid
+    with _pending_lock:
+        # Threads do not survive a fork, so each worker starts its own
+        if _refresher_pid == os.getpid():
+            return
+        _refresher_pid = os.getpid()
+    threading.Thread(target=_refresh_loop, name='contractor-index-refresh', daemon=True).start()
+
+
+def _on_contractor_change(payload):
+    if not _index.is_loaded():
+        return
+    _start_refresher()
+    with _pending_lock:
+        # An empty payload asks for a full rebuild
+        _pending.add(payload or None)
+        _pending_event.set()
+
+
+def _on_catalog_change(table):
+    if _index.is_loaded() and table in ('services', ''):
+        _with_cursor(_index.reload_services)
+
+
+def _subscribe():
+    global _subscribed
+    if not _subscribed:
+        _subscribed = True
+        db_notify.subscribe(NOTIFY_CHANNEL, _on_contractor_change, on_connect=_rebuild_in_background)
+        db_notify.subscribe('catalog_changed', _on_catalog_change)
+    db_notify.start()
+
+
+def get_index():
+    """Return the loaded index, building it on first use; None if the database is unavailable"""
+    _subscribe()
+    if not _index.is_loaded():
+        try:
+            _rebuild(if_unloaded=True)
+        except Exception as e:
+            logger.error(f"Error building contractor index: {str(e)}")
+            return None
+    elif _index.is_stale():
+        _rebuild_in_background()
+    return _index
+
+
+def warm_up():
+    """Build the index in the background so the first match request is fast"""
+    if not os.environ.get('DATABASE_URL'):
+        return
+    threading.Thread(target=get_index, name='contractor-index-warmup', daemon=True).start()
+
+
+def stats():
+    """Return contractor index counters"""
+    return _index.stats()
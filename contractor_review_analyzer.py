@@ -8,28 +8,42 @@ The results are used to improve the contractor matching system.
 
 import os
 import json
+import time
+import signal
 import logging
-import psycopg2
+import argparse
+import multiprocessing
+import log_config
+import db_pool
+import review_store
+import review_scoring
+import review_llm
+import review_scheduler
+import review_throttle
+import contractor_traffic
+from psycopg2.extras import execute_values
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 import re
 import random  # For simulating review data if needed
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
+# Contractors' review sources fetched in parallel by the analyzer
+ANALYZER_CONCURRENCY = int(os.environ.get('REVIEW_ANALYZER_CONCURRENCY', 8))
+
+# Seconds a single source fetch may run before it counts as failed
+FETCH_TIMEOUT = float(os.environ.get('REVIEW_FETCH_TIMEOUT', 30))
+
+# Simulated review histories start here (see simulate_reviews)
+SIMULATION_EPOCH = datetime(2025, 1, 1).date()
+
+# Contractors written per transaction by write_contractor_metrics()
+METRICS_BATCH_SIZE = int(os.environ.get('REVIEW_METRICS_BATCH_SIZE', 500))
+
 def get_db_connection():
-    """Get a connection to the PostgreSQL database"""
-    try:
-        conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
-        conn.autocommit = True
-        return conn
-    except Exception as e:
-        logger.error(f"Database connection error: {str(e)}")
-        return None
+    """Get a pooled connection to the PostgreSQL database"""
+    return db_pool.get_db_connection()
 
 def ensure_contractor_metrics_table():
     """Ensure the contractor_metrics table exists"""
@@ -76,67 +90,57 @@ def ensure_contractor_metrics_table():
     finally:
         conn.close()
 
-def get_contractors_needing_update(days_threshold=7):
-    """Get contractors that need metrics updates"""
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database")
-        return []
+def simulate_reviews(contractor, source, since, min_rating, window_days, positive_text, negative_text):
+    """
+    Generate a stable simulated review history for a contractor
     
-    try:
-        cursor = conn.cursor()
-        
-        # Get contractors that haven't been updated in X days or don't have metrics
-        cursor.execute("""
-            SELECT c.id, c.name 
-            FROM contractors c
-            LEFT JOIN contractor_metrics m ON c.id = m.contractor_id
-            WHERE m.contractor_id IS NULL 
-                OR m.last_updated < %s
-            LIMIT 100
-        """, (datetime.now() - timedelta(days=days_threshold),))
-        
-        contractors = []
-        for row in cursor.fetchall():
-            contractors.append({
-                "id": row[0],
-                "name": row[1],
-                "website": None  # Set website to None since it's not in our schema
+    Reviews arrive every few days from SIMULATION_EPOCH on, and review i of
+    a contractor is always the same review, so repeated runs see the same
+    history plus whatever has "arrived" since. Only reviews on or after
+    ``since`` (default: the last ``window_days`` days) are returned.
+    """
+    rng = random.Random(f"{source}:{contractor['id']}")
+    interval = rng.randint(4, 12)
+    since = since or (datetime.now() - timedelta(days=window_days)).date()
+    today = datetime.now().date()
+    
+    reviews = []
+    i = 0
+    while True:
+        reviewed_on = SIMULATION_EPOCH + timedelta(days=i * interval + rng.randint(0, interval - 1))
+        if reviewed_on > today:
+            break
+        if reviewed_on >= since:
+            rating = random.Random(f"{source}:{contractor['id']}:{i}").randint(min_rating, 5)
+            reviews.append({
+                "id": f"{source.lower()}-{contractor['id']}-{i}",
+                "rating": rating,
+                "text": f"Sample {source} review {i+1} for {contractor['name']}. {positive_text if rating >= 4 else negative_text}",
+                "date": reviewed_on.strftime("%Y-%m-%d")
             })
-        
-        cursor.close()
-        return contractors
-    except Exception as e:
-        logger.error(f"Error getting contractors for update: {str(e)}")
-        return []
-    finally:
-        conn.close()
+        i += 1
+    return reviews
 
-def fetch_google_reviews(contractor):
+def fetch_google_reviews(contractor, since=None):
     """
     Fetch Google reviews for a contractor
     
     In a real implementation, this would use web scraping or the Google Places API
     to get reviews for the contractor based on their name and website.
+    Only reviews posted on or after ``since`` are needed.
     """
     logger.info(f"Fetching Google reviews for {contractor['name']}")
     
     # In a production system, you would:
     # 1. Get the business Place ID using Google Places API search
-    # 2. Fetch reviews using the Place ID
+    # 2. Fetch reviews using the Place ID, newest first, stopping at ``since``
 
     # For demonstration, generate simulated review data
     # This would be replaced by actual API calls or web scraping
-    num_reviews = random.randint(5, 20)
-    reviews = []
-    
-    for i in range(num_reviews):
-        rating = random.randint(3, 5)  # Mostly positive ratings
-        reviews.append({
-            "rating": rating,
-            "text": f"Sample Google review {i+1} for {contractor['name']}. {'Great service!' if rating >= 4 else 'Decent service but could improve.'}",
-            "date": (datetime.now() - timedelta(days=random.randint(1, 90))).strftime("%Y-%m-%d")
-        })
+    reviews = simulate_reviews(
+        contractor, "Google", since, min_rating=3, window_days=90,  # Mostly positive ratings
+        positive_text="Great service!", negative_text="Decent service but could improve."
+    )
     
     return {
         "source": "Google",
@@ -145,31 +149,26 @@ def fetch_google_reviews(contractor):
         "reviews": reviews
     }
 
-def fetch_yelp_reviews(contractor):
+def fetch_yelp_reviews(contractor, since=None):
     """
     Fetch Yelp reviews for a contractor
     
     In a real implementation, this would use the Yelp Fusion API
     to get reviews for the contractor based on their name and website.
+    Only reviews posted on or after ``since`` are needed.
     """
     logger.info(f"Fetching Yelp reviews for {contractor['name']}")
     
     # In a production system, you would:
     # 1. Search for the business using the Yelp Fusion API
-    # 2. Fetch reviews using the business ID
+    # 2. Fetch reviews using the business ID, newest first, stopping at ``since``
 
     # For demonstration, generate simulated review data
     # This would be replaced by actual API calls
-    num_reviews = random.randint(3, 15)
-    reviews = []
-    
-    for i in range(num_reviews):
-        rating = random.randint(2, 5)  # Mix of ratings
-        reviews.append({
-            "rating": rating,
-            "text": f"Sample Yelp review {i+1} for {contractor['name']}. {'Highly recommended!' if rating >= 4 else 'They were okay, but could have done better.'}",
-            "date": (datetime.now() - timedelta(days=random.randint(1, 120))).strftime("%Y-%m-%d")
-        })
+    reviews = simulate_reviews(
+        contractor, "Yelp", since, min_rating=2, window_days=120,  # Mix of ratings
+        positive_text="Highly recommended!", negative_text="They were okay, but could have done better."
+    )
     
     return {
         "source": "Yelp",
@@ -207,33 +206,14 @@ def analyze_reviews_with_ai(reviews_data):
                 "review_count": 0
             }
         
-        average_rating = sum(review["rating"] for review in all_reviews) / total_reviews
-        
-        # Extract text for sentiment analysis
-        review_texts = [review["text"] for review in all_reviews]
-        
-        # In a real implementation, this would call the OpenAI API
-        # For demonstration, use simple rules to simulate sentiment analysis
-        
-        # Simulate sentiment analysis
-        sentiment_score = min(5.0, average_rating * (1 + random.uniform(-0.1, 0.1)))
-        
-        # Extract quality keywords
-        positive_keywords = ["professional", "reliable", "thorough", "detailed", 
-                            "punctual", "efficient", "friendly", "courteous",
-                            "skilled", "experienced", "knowledgeable", "responsive"]
-        
-        # In a real implementation, these would be extracted from the AI analysis
-        # For demonstration, randomly select a subset of keywords
-        extracted_keywords = random.sample(positive_keywords, min(5, len(positive_keywords)))
-        
-        return {
-            "sentiment_score": sentiment_score,
-            "average_rating": average_rating,
-            "quality_keywords": extracted_keywords,
-            "data_sources": sources,
-            "review_count": total_reviews
-        }
+        # Counts and ratings come from the local scorer; sentiment and keywords
+        # from the language model when one is configured
+        analysis = review_scoring.score_reviews({None: reviews_data})[None]
+        if review_llm.is_enabled():
+            answer = review_llm.analyze({None: reviews_data}).get(None)
+            if answer:
+                analysis.update(answer)
+        return analysis
         
     except Exception as e:
         logger.error(f"Error analyzing reviews with AI: {str(e)}")
@@ -262,32 +242,8 @@ def simple_review_analysis(reviews_data):
                 "review_count": 0
             }
         
-        average_rating = sum(review["rating"] for review in all_reviews) / total_reviews
-        
-        # Sentiment score = average rating on 0-5 scale
-        sentiment_score = average_rating
-        
-        # Simulate extracted keywords based on rating
-        possible_keywords = {
-            "high": ["reliable", "professional", "quality", "satisfied", "recommend"],
-            "medium": ["decent", "acceptable", "satisfactory"],
-            "low": ["improvement", "disappointed", "late"]
-        }
-        
-        if average_rating >= 4.0:
-            keywords = random.sample(possible_keywords["high"], 3)
-        elif average_rating >= 3.0:
-            keywords = random.sample(possible_keywords["medium"], 2) + random.sample(possible_keywords["high"], 1)
-        else:
-            keywords = random.sample(possible_keywords["low"], 2) + random.sample(possible_keywords["medium"], 1)
-        
-        return {
-            "sentiment_score": sentiment_score,
-            "average_rating": average_rating,
-            "quality_keywords": keywords,
-            "data_sources": sources,
-            "review_count": total_reviews
-        }
+        # Sentiment score = average rating on 0-5 scale; keywords by frequency
+        return review_scoring.score_reviews({None: reviews_data}, lexicon_weight=0)[None]
         
     except Exception as e:
         logger.error(f"Error in simple review analysis: {str(e)}")
@@ -299,130 +255,329 @@ def simple_review_analysis(reviews_data):
             "review_count": 0
         }
 
-def update_contractor_metrics(contractor_id, metrics_data):
-    """Update contractor metrics in the database"""
-    conn = get_db_connection()
+def tier_for_score(sentiment_score):
+    """Determine tier level based on sentiment score"""
+    if sentiment_score >= 4.5:
+        return "Diamond"
+    if sentiment_score >= 4.0:
+        return "Gold"
+    return "Standard"
+
+def write_contractor_metrics(metrics_by_contractor, batch_size=METRICS_BATCH_SIZE):
+    """
+    Upsert metrics for many contractors over one connection
+    
+    Each batch is one INSERT ... ON CONFLICT DO UPDATE into contractor_metrics
+    plus one UPDATE of contractors.tier_level/rating, committed together.
+    Takes a list of (contractor_id, metrics) and returns the set of
+    contractor ids whose batch was written; a failed batch is rolled back
+    without affecting the others.
+    """
+    written = set()
+    if not metrics_by_contractor:
+        return written
+    
+    conn = db_pool.get_db_connection(autocommit=False)
     if not conn:
         logger.error("Failed to connect to database")
-        return False
+        return written
     
+    # Rows are locked in id order so concurrent runs cannot deadlock
+    rows = sorted(metrics_by_contractor, key=lambda item: item[0])
     try:
         cursor = conn.cursor()
-        
-        # Determine tier level based on sentiment score
-        tier_level = "Standard"
-        if metrics_data["sentiment_score"] >= 4.5:
-            tier_level = "Diamond"
-        elif metrics_data["sentiment_score"] >= 4.0:
-            tier_level = "Gold"
-        
-        # Check if metrics exist for this contractor
-        cursor.execute("SELECT contractor_id FROM contractor_metrics WHERE contractor_id = %s", (contractor_id,))
-        exists = cursor.fetchone() is not None
-        
-        if exists:
-            # Update existing metrics
-            cursor.execute("""
-                UPDATE contractor_metrics
-                SET review_count = %s,
-                    average_rating = %s,
-                    sentiment_score = %s,
-                    quality_keywords = %s,
-                    tier_level = %s,
-                    last_updated = NOW(),
-                    data_sources = %s
-                WHERE contractor_id = %s
-            """, (
-                metrics_data["review_count"],
-                metrics_data["average_rating"],
-                metrics_data["sentiment_score"],
-                metrics_data["quality_keywords"],
-                tier_level,
-                metrics_data["data_sources"],
-                contractor_id
-            ))
-        else:
-            # Insert new metrics
-            cursor.execute("""
-                INSERT INTO contractor_metrics
-                (contractor_id, review_count, average_rating, sentiment_score, quality_keywords, tier_level, data_sources)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """, (
-                contractor_id,
-                metrics_data["review_count"],
-                metrics_data["average_rating"],
-                metrics_data["sentiment_score"],
-                metrics_data["quality_keywords"],
-                tier_level,
-                metrics_data["data_sources"]
-            ))
-        
-        # Also update the tier_level in the contractors table
-        cursor.execute("""
-            UPDATE contractors
-            SET tier_level = %s,
-                rating = %s
-            WHERE id = %s
-        """, (
-            tier_level,
-            metrics_data["average_rating"],
-            contractor_id
-        ))
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            metric_rows = []
+            contractor_rows = []
+            for contractor_id, metrics_data in batch:
+                tier_level = tier_for_score(metrics_data["sentiment_score"])
+                metric_rows.append((
+                    contractor_id,
+                    metrics_data["review_count"],
+                    metrics_data["average_rating"],
+                    metrics_data["sentiment_score"],
+                    metrics_data["quality_keywords"],
+                    tier_level,
+                    metrics_data["data_sources"]
+                ))
+                contractor_rows.append((contractor_id, tier_level, metrics_data["average_rating"]))
+            
+            try:
+                execute_values(cursor, """
+                    INSERT INTO contractor_metrics
+                    (contractor_id, review_count, average_rating, sentiment_score, quality_keywords, tier_level, data_sources, last_updated)
+                    VALUES %s
+                    ON CONFLICT (contractor_id) DO UPDATE
+                    SET review_count = EXCLUDED.review_count,
+                        average_rating = EXCLUDED.average_rating,
+                        sentiment_score = EXCLUDED.sentiment_score,
+                        quality_keywords = COALESCE(EXCLUDED.quality_keywords, contractor_metrics.quality_keywords),
+                        tier_level = EXCLUDED.tier_level,
+                        last_updated = EXCLUDED.last_updated,
+                        data_sources = EXCLUDED.data_sources
+                """, metric_rows, template="(%s, %s, %s, %s, %s, %s, %s, NOW())", page_size=batch_size)
+                
+                # Also update the tier_level in the contractors table
+                execute_values(cursor, """
+                    UPDATE contractors AS c
+                    SET tier_level = v.tier_level,
+                        rating = v.rating
+                    FROM (VALUES %s) AS v (id, tier_level, rating)
+                    WHERE c.id = v.id
+                """, contractor_rows, template="(%s, %s, %s::numeric)", page_size=batch_size)
+                
+                conn.commit()
+                written.update(contractor_id for contractor_id, _ in batch)
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error writing metrics for {len(batch)} contractors: {str(e)}")
         
         cursor.close()
-        logger.info(f"Updated metrics for contractor ID {contractor_id}")
-        return True
-    except Exception as e:
-        logger.error(f"Error updating contractor metrics: {str(e)}")
-        return False
+        logger.info(f"Updated metrics for {len(written)} out of {len(rows)} contractors")
+        return written
     finally:
         conn.close()
 
+def update_contractor_metrics(contractor_id, metrics_data):
+    """Update contractor metrics in the database"""
+    return contractor_id in write_contractor_metrics([(contractor_id, metrics_data)])
+
 def process_contractor(contractor):
     """Process a single contractor"""
     logger.info(f"Processing contractor: {contractor['name']} (ID: {contractor['id']})")
     
+    result = analyze_contractors_concurrently([contractor], concurrency=len(REVIEW_SOURCES))[0]
+    if not result["success"]:
+        logger.error(f"Error processing contractor {contractor['id']}: {result['errors']}")
+    return result["success"]
+
+REVIEW_SOURCES = {
+    "Google": fetch_google_reviews,
+    "Yelp": fetch_yelp_reviews,
+}
+
+def fetch_reviews_concurrently(contractors, concurrency=ANALYZER_CONCURRENCY, timeout=FETCH_TIMEOUT, watermarks=None,
+                               sources=None):
+    """
+    Fetch every review source for every contractor in parallel
+    
+    Runs at most ``concurrency`` fetches at a time, and each source's fetches
+    within its review_throttle rate and concurrency limits. A fetch that gets
+    no permit, or that runs longer than ``timeout`` seconds, is abandoned and
+    reported as an error. Each
+    source is asked only for reviews since its watermark, given as
+    {(contractor_id, source): date}. ``sources`` maps source names to
+    fetchers (default REVIEW_SOURCES). Returns
+    {contractor_id: {"reviews": [source data, ...], "errors": {source: message}}}
+    with the reviews in ``sources`` order.
+    """
+    sources = REVIEW_SOURCES if sources is None else sources
+    watermarks = watermarks or {}
+    fetched = {contractor['id']: {} for contractor in contractors}
+    errors = {contractor['id']: {} for contractor in contractors}
+    started = {}
+    
+    def run(key, fetch, contractor):
+        with review_throttle.permit(key[1], timeout):
+            # The timeout covers the fetch, not the wait for a permit
+            started[key] = time.monotonic()
+            return fetch(contractor, since=watermarks.get(key))
+    
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='review-fetch')
+    pending = {}
+    for contractor in contractors:
+        for source, fetch in sources.items():
+            key = (contractor['id'], source)
+            pending[executor.submit(run, key, fetch, contractor)] = key
+    
     try:
-        # Fetch reviews from different sources
-        google_reviews = fetch_google_reviews(contractor)
-        yelp_reviews = fetch_yelp_reviews(contractor)
-        
-        # Combine review data
-        reviews_data = [google_reviews, yelp_reviews]
-        
-        # Analyze reviews
-        metrics = analyze_reviews_with_ai(reviews_data)
-        
-        # Update contractor metrics in database
-        update_contractor_metrics(contractor['id'], metrics)
-        
-        return True
+        while pending:
+            done, _ = wait(pending, timeout=min(1.0, timeout), return_when=FIRST_COMPLETED)
+            for future in done:
+                contractor_id, source = pending.pop(future)
+                try:
+                    fetched[contractor_id][source] = future.result()
+                except Exception as e:
+                    errors[contractor_id][source] = str(e)
+            
+            # A thread cannot be interrupted, so a slow fetch is abandoned rather than stopped
+            now = time.monotonic()
+            for future, key in list(pending.items()):
+                if key in started and now - started[key] > timeout:
+                    del pending[future]
+                    errors[key[0]][key[1]] = f"Timed out after {timeout:g}s"
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    return {
+        contractor_id: {
+            "reviews": [by_source[name] for name in sources if name in by_source],
+            "errors": errors[contractor_id]
+        }
+        for contractor_id, by_source in fetched.items()
+    }
+
+def analyze_contractors_concurrently(contractors, concurrency=ANALYZER_CONCURRENCY, timeout=FETCH_TIMEOUT):
+    """
+    Fetch new reviews for many contractors in parallel, then analyze and store them
+    
+    Only reviews since each source's watermark are fetched. They are added
+    to review_store, and the stored running totals give the contractor's
+    review count, average rating and sentiment.
+    
+    Returns one result per contractor: {"id", "name", "success", "errors"}.
+    A contractor whose sources did not all arrive is not updated, so its
+    metrics are never computed from partial data.
+    """
+    watermarks = review_store.load_watermarks([contractor['id'] for contractor in contractors])
+    fetched = fetch_reviews_concurrently(contractors, concurrency, timeout, watermarks)
+    results = []
+    complete = {}
+    keywords = {}
+    
+    for contractor in contractors:
+        outcome = fetched[contractor['id']]
+        result = {
+            "id": contractor['id'],
+            "name": contractor['name'],
+            "success": False,
+            "errors": dict(outcome["errors"])
+        }
+        if not outcome["errors"]:
+            complete[contractor['id']] = outcome["reviews"]
+        results.append(result)
+    
+    # Score all new reviews in one batch; each review gets its own sentiment
+    try:
+        for contractor_id, scores in review_scoring.score_reviews(complete, annotate=True).items():
+            # Keywords come from the new reviews; without any, the stored ones are kept
+            if scores["review_count"]:
+                keywords[contractor_id] = scores["quality_keywords"]
     except Exception as e:
-        logger.error(f"Error processing contractor {contractor['id']}: {str(e)}")
-        return False
+        logger.error(f"Error scoring reviews: {str(e)}")
+        complete = {}
+        for result in results:
+            if not result["errors"]:
+                result["errors"]["analysis"] = str(e)
+    
+    # A language model, when configured, reads each contractor's new reviews
+    # (batched and cached by review_llm); its sentiment applies to those reviews
+    if complete and review_llm.is_enabled():
+        try:
+            for contractor_id, answer in review_llm.analyze(complete).items():
+                keywords[contractor_id] = answer["quality_keywords"]
+                for source_data in complete[contractor_id]:
+                    for review in source_data["reviews"]:
+                        review["sentiment"] = answer["sentiment_score"]
+        except Exception as e:
+            # The local scores are kept
+            logger.error(f"Error analyzing reviews with AI: {str(e)}")
+    
+    aggregates = review_store.ingest(complete) if complete else {}
+    if aggregates is None:
+        aggregates = {}
+        for result in results:
+            if not result["errors"]:
+                result["errors"]["database"] = "Failed to store reviews"
+    
+    metrics = []
+    for contractor_id, aggregate in aggregates.items():
+        metrics.append((contractor_id, {
+            "review_count": aggregate["review_count"],
+            "average_rating": aggregate["average_rating"],
+            "sentiment_score": aggregate["sentiment_score"],
+            "quality_keywords": keywords.get(contractor_id),
+            "data_sources": aggregate["data_sources"]
+        }))
+    
+    # Store all metrics in batches rather than one connection per contractor
+    written = write_contractor_metrics(metrics)
+    for result in results:
+        if result["id"] in written:
+            result["success"] = True
+        elif not result["errors"]:
+            result["errors"]["database"] = "Failed to update contractor metrics"
+    
+    return results
+
+def ensure_analyzer_tables():
+    """Ensure every table the analyzer writes to exists"""
+    ensure_contractor_metrics_table()
+    add_tier_level_to_contractors_table()
+    review_store.ensure_review_tables()
+    review_scheduler.ensure_lease_table()
+    contractor_traffic.ensure_traffic_table()
+    review_throttle.ensure_rate_limit_table()
+    if review_llm.is_enabled():
+        review_llm.ensure_review_analysis_cache_table()
 
-def run_review_analyzer(max_contractors=10, days_threshold=7):
+def _process_claimed(concurrency, fetch_timeout):
+    def process(contractors):
+        results = analyze_contractors_concurrently(contractors, concurrency, fetch_timeout)
+        for result in results:
+            if not result["success"]:
+                logger.warning(f"Failed to process contractor {result['id']}: {result['errors']}")
+        return results
+    return process
+
+def run_review_analyzer(max_contractors=10, days_threshold=7, concurrency=ANALYZER_CONCURRENCY, fetch_timeout=FETCH_TIMEOUT):
     """Run the review analyzer for contractors needing updates"""
     logger.info("Starting contractor review analyzer")
     
     # First, ensure necessary tables exist
-    ensure_contractor_metrics_table()
-    add_tier_level_to_contractors_table()
+    ensure_analyzer_tables()
+    
+    # Lease up to max_contractors stale contractors, so a concurrent run or
+    # daemon never processes the same ones
+    worker = review_scheduler.Worker(_process_claimed(concurrency, fetch_timeout), days_threshold=days_threshold)
+    results = worker.run_once(limit=max_contractors)
+    successful = sum(1 for result in results if result["success"])
+    
+    logger.info(f"Processed {successful} out of {len(results)} contractors")
+    logger.info(f"Review source throttling: {review_throttle.stats()}")
+    if review_llm.is_enabled():
+        logger.info(f"Review analysis: {review_llm.stats()}")
+    return successful
+
+def _run_review_worker(days_threshold, concurrency, fetch_timeout):
+    worker = review_scheduler.Worker(_process_claimed(concurrency, fetch_timeout), days_threshold=days_threshold)
+    worker.install_signal_handlers()
+    worker.run_forever()
+
+def run_review_daemon(processes=1, days_threshold=7, concurrency=ANALYZER_CONCURRENCY, fetch_timeout=FETCH_TIMEOUT):
+    """
+    Refresh contractors continuously with one or more worker processes
     
-    # Get contractors that need updates
-    contractors = get_contractors_needing_update(days_threshold)
-    logger.info(f"Found {len(contractors)} contractors needing updates")
+    Workers claim batches through review_scheduler leases, so more daemons
+    (here or on other machines) add throughput without duplicating work.
+    SIGTERM lets every worker finish its batch and exit.
+    """
+    ensure_analyzer_tables()
+    if processes <= 1:
+        _run_review_worker(days_threshold, concurrency, fetch_timeout)
+        return
     
-    # Process up to max_contractors
-    contractors_to_process = contractors[:max_contractors]
-    successful = 0
+    children = [
+        multiprocessing.Process(
+            target=_run_review_worker,
+            args=(days_threshold, concurrency, fetch_timeout),
+            name=f"review-worker-{i + 1}"
+        )
+        for i in range(processes)
+    ]
+    for child in children:
+        child.start()
     
-    for contractor in contractors_to_process:
-        if process_contractor(contractor):
-            successful += 1
+    def forward(signum, frame):
+        for child in children:
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
     
-    logger.info(f"Processed {successful} out of {len(contractors_to_process)} contractors")
-    return successful
+    for child in children:
+        child.join()
 
 def add_tier_level_to_contractors_table():
     """Add tier_level column to contractors table if it doesn't exist"""
@@ -460,6 +615,56 @@ def add_tier_level_to_contractors_table():
     finally:
         conn.close()
 
+def run_fetch_load_test(contractors=500, concurrency=32, error_rate=0.0, fetch_timeout=FETCH_TIMEOUT):
+    """
+    Fetch reviews for simulated contractors from FakeProviders, without a database
+    
+    Each fake provider enforces the quota configured for its source in
+    REVIEW_RATE_LIMITS, so any request the throttle lets through too early
+    comes back RateLimited. Returns the fetch outcome, the provider calls
+    and the throttle counters.
+    """
+    providers = {
+        source: review_throttle.FakeProvider(
+            fetch, rate=review_throttle.RATE_LIMITS.get(source, review_throttle.DEFAULT_RATE),
+            error_rate=error_rate, seed=source
+        )
+        for source, fetch in REVIEW_SOURCES.items()
+    }
+    rates, shared = review_throttle.settings()
+    review_throttle.configure(shared=False)
+    try:
+        started = time.monotonic()
+        fetched = fetch_reviews_concurrently(
+            [{"id": i, "name": f"Load Test Contractor {i}"} for i in range(1, contractors + 1)],
+            concurrency, fetch_timeout, sources=providers
+        )
+        elapsed = time.monotonic() - started
+        throttle = review_throttle.stats()
+    finally:
+        review_throttle.configure(rates, shared=shared)
+    
+    return {
+        "contractors": contractors,
+        "seconds": round(elapsed, 2),
+        "failed_contractors": sum(1 for outcome in fetched.values() if outcome["errors"]),
+        "providers": {source: provider.calls for source, provider in providers.items()},
+        "throttle": throttle
+    }
+
 # Run the analyzer if executed directly
 if __name__ == '__main__':
-    run_review_analyzer()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Refresh contractor review metrics")
+    parser.add_argument('--daemon', action='store_true', help="keep refreshing until stopped")
+    parser.add_argument('--processes', type=int, default=1, help="worker processes in daemon mode")
+    parser.add_argument('--max-contractors', type=int, default=10, help="contractors refreshed in a single run")
+    parser.add_argument('--load-test', type=int, metavar='CONTRACTORS', help="fetch from fake providers and report throttling")
+    args = parser.parse_args()
+    
+    log_config.configure(filename='contractor_review_analyzer.log')
+    if args.load_test:
+        print(json.dumps(run_fetch_load_test(args.load_test), indent=2))
+    elif args.daemon:
+        run_review_daemon(args.processes)
+    else:
+        run_review_analyzer(args.max_contractors)
\ No newline at end of file
@@ -0,0 +1,156 @@
+"""
+Contractor Traffic
+
+Counts how often each contractor is shown by /api/contractors and
+/api/match-contractor, so the review analyzer can refresh the contractors
+that matter most to live traffic first.
+
+Hits are counted in memory (a dict update under a lock) and flushed by a
+background thread every CONTRACTOR_TRAFFIC_FLUSH seconds. The flush adds
+them with one multi-row upsert into contractor_traffic. The stored count
+decays with a half-life of CONTRACTOR_TRAFFIC_HALF_LIFE_HOURS, so it
+reflects recent traffic rather than all-time totals. review_scheduler
+ranks stale contractors by staleness x (1 + decayed hits).
+
+Configuration:
+- CONTRACTOR_TRAFFIC_FLUSH: seconds between flushes (default 60)
+- CONTRACTOR_TRAFFIC_HALF_LIFE_HOURS: half-life of the stored hit counts (default 24)
+"""
+
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import Counter
+
+from psycopg2.extras import execute_values
+
+import db_pool
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.environ.get('CONTRACTOR_TRAFFIC_FLUSH', 60))
+HALF_LIFE_HOURS = float(os.environ.get('CONTRACTOR_TRAFFIC_HALF_LIFE_HOURS', 24))
+
+_counts = Counter()
+_lock = threading.Lock()
+_flusher_pid = None
+_stats = {"recorded": 0, "flushed": 0, "flushes": 0, "flush_errors": 0}
+
+
+def decayed_hits_sql(alias='t'):
+    """SQL expression for a contractor_traffic row's hit count decayed to now"""
+    return (
+        f"COALESCE({alias}.hits * POWER(0.5, EXTRACT(EPOCH FROM NOW() - {alias}.updated_at) "
+        f"/ {HALF_LIFE_HOURS * 3600.0}), 0)"
+    )
+
+
+def ensure_traffic_table(dsn=None):
+    """Ensure the contractor_traffic table exists"""
+    conn = db_pool.get_db_connection(dsn)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS contractor_traffic (
+                contractor_id INTEGER PRIMARY KEY,
+                hits DOUBLE PRECISION NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        cursor.close()
+        return True
+    except Exception as e:
+        logger.error(f"Error creating contractor_traffic table: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+
+def record(contractor_ids):
+    """Count one hit for each contractor shown in a response"""
+    if not contractor_ids:
+        return
+    _start()
+    with _lock:
+        for contractor_id in contractor_ids:
+            if contractor_id is not None:
+                _counts[contractor_id] += 1
+                _stats["recorded"] += 1
+
+
+def flush():
+    """Add the hits counted since the last flush to contractor_traffic"""
+    with _lock:
+        if not _counts:
+            return 0
+        pending = dict(_counts)
+        _counts.clear()
+
+    conn = db_pool.get_db_connection()
+    if not conn:
+        _restore(pending)
+        return 0
+    try:
+        cursor = conn.cursor()
+        # Decay the stored count to now before adding; rows in id order avoid deadlocks
+        execute_values(cursor, f"""
+            INSERT INTO contractor_traffic AS t (contractor_id, hits, updated_at)
+            VALUES %s
+            ON CONFLICT (contractor_id) DO UPDATE
+            SET hits = {decayed_hits_sql('t')} + EXCLUDED.hits,
+                updated_at = NOW()
+        """, sorted(pending.items()), template="(%s, %s, NOW())", page_size=1000)
+        cursor.close()
+        with _lock:
+            _stats["flushed"] += sum(pending.values())
+            _stats["flushes"] += 1
+        return len(pending)
+    except Exception as e:
+        logger.warning(f"Error flushing contractor traffic: {str(e)}")
+        _restore(pending)
+        return 0
+    finally:
+        conn.close()
+
+
+def _restore(pending):
+    # Keep the hits for the next flush rather than losing them
+    with _lock:
+        _stats["flush_errors"] += 1
+        _counts.update(pending)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"Contractor traffic flusher error: {str(e)}")
+
+
+def _start():
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        # Threads do not survive a fork, so each worker starts its own
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+        threading.Thread(target=_flush_loop, name='contractor-traffic-flush', daemon=True).start()
+        atexit.register(flush)
+
+
+def stats():
+    """Return traffic counter totals and the number of contractors awaiting a flush"""
+    with _lock:
+        snapshot = dict(_stats)
+        snapshot["pending_contractors"] = len(_counts)
+    return snapshot
@@ -0,0 +1,116 @@
+"""
+PostgreSQL LISTEN/NOTIFY Dispatcher
+
+Runs one background listener connection per process and dispatches
+notifications to the callbacks subscribed to each channel. The in-process
+caches use it to drop or refresh their data as soon as the underlying
+tables change.
+
+Set DB_NOTIFY_LISTEN=0 to disable the listener (caches then rely on their
+TTLs alone).
+"""
+
+import os
+import time
+import select
+import logging
+import threading
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for newly subscribed channels
+POLL_INTERVAL = 5
+
+_subscriptions = {}   # channel -> list of (callback, on_connect)
+_lock = threading.Lock()
+_listener_pid = None
+
+
+def subscribe(channel, callback, on_connect=None):
+    """
+    Call ``callback(payload)`` for every notification on ``channel``.
+
+    ``on_connect()`` runs each time the listener (re)connects, because
+    notifications sent while it was disconnected are lost.
+    """
+    with _lock:
+        _subscriptions.setdefault(channel, []).append((callback, on_connect))
+    start()
+
+
+def start(dsn=None):
+    """Start the listener thread for this process if it is not running"""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    if os.environ.get('DB_NOTIFY_LISTEN', '1') == '0':
+        return
+    dsn = dsn or os.environ.get('DATABASE_URL')
+    if not dsn:
+        return
+
+    with _lock:
+        # Threads do not survive a fork, so each worker starts its own
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        thread = threading.Thread(target=_listen_loop, args=(dsn,), name='db-notify-listener', daemon=True)
+        thread.start()
+
+
+def _dispatch(channel, payload):
+    with _lock:
+        handlers = list(_subscriptions.get(channel, []))
+    for callback, _ in handlers:
+        try:
+            callback(payload)
+        except Exception as e:
+            logger.error(f"Error handling notification on '{channel}': {str(e)}")
+
+
+def _listen_new_channels(conn, listening):
+    with _lock:
+        pending = {channel: list(handlers) for channel, handlers in _subscriptions.items() if channel not in listening}
+    if not pending:
+        return
+    cursor = conn.cursor()
+    for channel, handlers in pending.items():
+        cursor.execute(f"LISTEN {channel}")
+        listening.add(channel)
+        for _, on_connect in handlers:
+            if on_connect:
+                on_connect()
+        logger.info(f"Listening for notifications on '{channel}'")
+    cursor.close()
+
+
+def _listen_loop(dsn):
+    backoff = 1
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(dsn)
+            conn.autocommit = True
+            listening = set()
+            _listen_new_channels(conn, listening)
+            backoff = 1
+
+            while True:
+                if select.select([conn], [], [], POLL_INTERVAL) != ([], [], []):
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        _dispatch(notify.channel, notify.payload)
+                _listen_new_channels(conn, listening)
+        except Exception as e:
+            logger.error(f"Notification listener error: {str(e)}")
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 60)
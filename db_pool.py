@@ -0,0 +1,405 @@
+"""
+Shared PostgreSQL Connection Pool
+
+This module keeps a bounded pool of psycopg2 connections per process so that
+the API server, the checkout endpoint, the review analyzer and the database
+initialization script reuse connections instead of opening a new one for
+every call.
+
+Pool sizing is configured through environment variables:
+- DB_POOL_MIN: connections opened when the pool is created (default 1)
+- DB_POOL_MAX: hard upper bound of open connections (default 10)
+- DB_POOL_TIMEOUT: seconds to wait for a free connection (default 5)
+- DB_POOL_MAX_USES: checkouts before a connection is recycled (default 500)
+- DB_POOL_CHECK_AFTER: idle seconds after which a connection is pinged
+  before it is handed out (default 30, 0 pings on every checkout)
+
+Query observers registered with add_query_observer() are told about every
+statement run on a pooled cursor and how long it took (used by
+app_metrics for per-request database timings).
+"""
+
+import os
+import time
+import logging
+import threading
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the checkout timeout"""
+
+
+class PooledConnection:
+    """
+    Proxy around a pooled psycopg2 connection.
+
+    Attribute access is forwarded to the real connection. Calling close()
+    hands the connection back to the pool instead of closing the socket, so
+    existing code that does ``conn.close()`` keeps working unchanged. A proxy
+    that is dropped without being closed is returned when it is garbage
+    collected.
+    """
+
+    def __init__(self, pool, raw):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_raw', raw)
+        object.__setattr__(self, '_released', False)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+    def __enter__(self):
+        self._raw.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._raw.__exit__(exc_type, exc_value, traceback)
+
+    def cursor(self, *args, **kwargs):
+        cursor = self._raw.cursor(*args, **kwargs)
+        if _query_observers:
+            return ObservedCursor(cursor)
+        return cursor
+
+    @property
+    def raw(self):
+        """The underlying psycopg2 connection"""
+        return self._raw
+
+    def close(self):
+        """Return the connection to the pool (safe to call more than once)"""
+        if self._released:
+            return
+        object.__setattr__(self, '_released', True)
+        self._pool.putconn(self._raw)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ObservedCursor:
+    """
+    Proxy around a psycopg2 cursor that reports every statement it runs
+    to the query observers, together with its duration in seconds.
+    """
+
+    def __init__(self, raw):
+        object.__setattr__(self, '_raw', raw)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __enter__(self):
+        self._raw.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._raw.__exit__(exc_type, exc_value, traceback)
+
+    @property
+    def raw(self):
+        """The underlying psycopg2 cursor"""
+        return self._raw
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return self._raw.execute(query, vars)
+        finally:
+            _notify_query_observers(query, time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return self._raw.executemany(query, vars_list)
+        finally:
+            _notify_query_observers(query, time.perf_counter() - started)
+
+
+_query_observers = []
+
+
+def add_query_observer(observer):
+    """Call ``observer(statement, seconds)`` after each statement run on a pooled cursor"""
+    if observer not in _query_observers:
+        _query_observers.append(observer)
+
+
+def _notify_query_observers(query, seconds):
+    for observer in _query_observers:
+        try:
+            observer(query, seconds)
+        except Exception as e:
+            logger.warning(f"Query observer failed: {str(e)}")
+
+
+class ConnectionPool:
+    """Thread-safe, bounded pool of psycopg2 connections for a single DSN"""
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=5.0,
+                 max_uses=500, check_after=30.0, connect=None):
+        if maxconn < 1:
+            raise ValueError("maxconn must be at least 1")
+        self.dsn = dsn
+        self.minconn = max(0, min(minconn, maxconn))
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.check_after = check_after
+        self._connect = connect or psycopg2.connect
+
+        self._cond = threading.Condition()
+        self._idle = []       # LIFO stack of idle raw connections
+        self._meta = {}       # id(raw) -> {"uses": int, "last_used": float}
+        self._size = 0        # open connections, idle and in use
+        self._closed = False
+
+        self._stats = {
+            "checkouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "discarded": 0,
+            "failed_health_checks": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+        }
+
+    def prefill(self):
+        """Open connections until the pool holds at least minconn"""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                raw = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._meta[id(raw)]["last_used"] = time.monotonic()
+                self._idle.append(raw)
+                self._cond.notify()
+
+    def getconn(self, autocommit=True):
+        """Check out a connection, waiting up to the configured timeout"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+
+        while True:
+            raw = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed")
+                    if self._idle:
+                        raw = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection available after {self.timeout}s "
+                            f"({self._size} in use)"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if raw is None:
+                try:
+                    raw = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(raw):
+                self._discard(raw)
+                with self._cond:
+                    self._stats["failed_health_checks"] += 1
+                continue
+
+            try:
+                if raw.autocommit != autocommit:
+                    raw.autocommit = autocommit
+            except Exception:
+                self._discard(raw)
+                continue
+
+            elapsed = time.monotonic() - started
+            with self._cond:
+                meta = self._meta[id(raw)]
+                meta["uses"] += 1
+                self._stats["checkouts"] += 1
+                if waited:
+                    self._stats["waits"] += 1
+                    self._stats["wait_time_total"] += elapsed
+                    self._stats["wait_time_max"] = max(self._stats["wait_time_max"], elapsed)
+            return PooledConnection(self, raw)
+
+    def putconn(self, raw):
+        """Return a raw connection to the pool, recycling it if needed"""
+        meta = self._meta.get(id(raw))
+        if meta is None:
+            return
+
+        try:
+            if not raw.closed and raw.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                raw.rollback()
+        except Exception:
+            pass
+
+        if self._closed or raw.closed or meta["uses"] >= self.max_uses:
+            if meta["uses"] >= self.max_uses:
+                with self._cond:
+                    self._stats["recycled"] += 1
+            self._discard(raw)
+            return
+
+        with self._cond:
+            meta["last_used"] = time.monotonic()
+            self._idle.append(raw)
+            self._cond.notify()
+
+    def closeall(self):
+        """Close every idle connection and refuse further checkouts"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for raw in idle:
+            self._discard(raw)
+
+    def stats(self):
+        """Return a snapshot of pool utilization counters"""
+        with self._cond:
+            snapshot = dict(self._stats)
+            snapshot.update({
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min": self.minconn,
+                "max": self.maxconn,
+            })
+        checkouts = snapshot["checkouts"]
+        snapshot["wait_time_avg"] = snapshot["wait_time_total"] / checkouts if checkouts else 0.0
+        return snapshot
+
+    def _open(self):
+        raw = self._connect(self.dsn)
+        with self._cond:
+            self._meta[id(raw)] = {"uses": 0, "last_used": time.monotonic()}
+            self._stats["created"] += 1
+        return raw
+
+    def _healthy(self, raw):
+        if raw.closed:
+            return False
+        idle_for = time.monotonic() - self._meta[id(raw)]["last_used"]
+        if idle_for < self.check_after:
+            return True
+        try:
+            cursor = raw.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            if not raw.autocommit:
+                raw.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"Discarding broken pooled connection: {str(e)}")
+            return False
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self._cond:
+            if self._meta.pop(id(raw), None) is not None:
+                self._size -= 1
+                self._stats["discarded"] += 1
+            self._cond.notify()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def _env_number(name, default, cast=int):
+    try:
+        return cast(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid value for {name}, using {default}")
+        return default
+
+
+def get_pool(dsn=None):
+    """Get (or lazily create) the process-wide pool for a DSN"""
+    global _pools_pid
+    dsn = dsn or os.environ.get('DATABASE_URL')
+
+    with _pools_lock:
+        # Forked workers must not share sockets with their parent
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+
+        pool = _pools.get(dsn)
+        if pool is None:
+            pool = ConnectionPool(
+                dsn,
+                minconn=_env_number('DB_POOL_MIN', 1),
+                maxconn=_env_number('DB_POOL_MAX', 10),
+                timeout=_env_number('DB_POOL_TIMEOUT', 5.0, float),
+                max_uses=_env_number('DB_POOL_MAX_USES', 500),
+                check_after=_env_number('DB_POOL_CHECK_AFTER', 30.0, float),
+            )
+            _pools[dsn] = pool
+            try:
+                pool.prefill()
+            except Exception as e:
+                logger.error(f"Database pool prefill error: {str(e)}")
+    return pool
+
+
+def get_db_connection(dsn=None, autocommit=True):
+    """Get a pooled connection to the PostgreSQL database"""
+    try:
+        return get_pool(dsn).getconn(autocommit=autocommit)
+    except Exception as e:
+        logger.error(f"Database connection error: {str(e)}")
+        return None
+
+
+def pool_stats():
+    """Return utilization counters for the default pool"""
+    with _pools_lock:
+        pool = _pools.get(os.environ.get('DATABASE_URL'))
+    if pool is None:
+        return {}
+    return pool.stats()
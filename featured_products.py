@@ -0,0 +1,99 @@
+"""
+Featured Products
+
+Keeps an in-memory pool of product IDs per store category and samples
+"random" featured products from it, instead of sorting the whole products
+table with ORDER BY RANDOM() on every request.
+
+The pool holds up to FEATURED_POOL_PER_CATEGORY products per category and
+is reloaded every FEATURED_POOL_TTL seconds or when the catalog cache is
+invalidated. The products of a large category are picked by a hash of their
+id rather than at random, and the pool is sorted, so a reload of an
+unchanged catalog yields the same pool and sampling with a seed always
+returns the same products for the same catalog (useful in tests).
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+
+import catalog_cache
+
+logger = logging.getLogger(__name__)
+
+FEATURED_POOL_PER_CATEGORY = int(os.environ.get('FEATURED_POOL_PER_CATEGORY', 200))
+FEATURED_POOL_TTL = float(os.environ.get('FEATURED_POOL_TTL', 600))
+
+
+class FeaturedPool:
+    """Per-category pools of product IDs with constant-time sampling"""
+
+    def __init__(self, per_category=FEATURED_POOL_PER_CATEGORY, ttl=FEATURED_POOL_TTL):
+        self.per_category = per_category
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._by_category = {}
+        self._all = []
+        self._loaded_at = None
+        self._generation = None
+
+    def is_fresh(self):
+        """Whether the pool is loaded, younger than the TTL and not invalidated"""
+        return (
+            self._loaded_at is not None
+            and self._generation == catalog_cache.generation()
+            and time.monotonic() - self._loaded_at < self.ttl
+        )
+
+    def refresh(self, cursor):
+        """Reload the pool from the products table"""
+        generation = catalog_cache.generation()
+        cursor.execute("""
+            SELECT id, category_id
+            FROM (
+                SELECT p.id, p.category_id,
+                       ROW_NUMBER() OVER (PARTITION BY p.category_id ORDER BY md5(p.id::text), p.id) as pick
+                FROM products p
+                JOIN stores s ON p.store_id = s.id
+                JOIN store_categories sc ON p.category_id = sc.id
+            ) picked
+            WHERE picked.pick <= %s
+        """, (self.per_category,))
+        rows = cursor.fetchall()
+
+        by_category = {}
+        for row in rows:
+            product_id, category_id = (row['id'], row['category_id']) if isinstance(row, dict) else row
+            by_category.setdefault(category_id, []).append(product_id)
+        for ids in by_category.values():
+            ids.sort(key=str)
+
+        with self._lock:
+            self._by_category = by_category
+            self._all = sorted((pid for ids in by_category.values() for pid in ids), key=str)
+            self._loaded_at = time.monotonic()
+            self._generation = generation
+        logger.info(f"Loaded featured product pool with {len(self._all)} products")
+
+    def sample(self, cursor, limit, seed=None, category_id=None):
+        """Return up to ``limit`` product IDs, reproducible when a seed is given"""
+        if not self.is_fresh():
+            with self._refresh_lock:
+                # Requests that waited for another thread's refresh reuse it
+                if not self.is_fresh():
+                    self.refresh(cursor)
+        with self._lock:
+            pool = self._by_category.get(category_id, []) if category_id is not None else self._all
+        rng = random.Random(seed) if seed is not None else random
+        return rng.sample(pool, min(limit, len(pool)))
+
+
+_default = FeaturedPool()
+
+
+def sample(cursor, limit, seed=None, category_id=None):
+    """Sample featured product IDs from the shared pool"""
+    return _default.sample(cursor, limit, seed=seed, category_id=category_id)
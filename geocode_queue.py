@@ -0,0 +1,301 @@
+"""
+Background Geocoding
+
+Resolves addresses saved with geocode_status = 'pending' outside the request
+thread, so /api/process-address does not hold a gunicorn worker while
+Mapbox responds.
+
+Queued addresses are geocoded in batches, a few at a time in parallel, and
+written back with a single UPDATE per batch. Rows that were never picked up
+(for example because the worker restarted) are swept from the database
+periodically, so no pending address is lost. The sweep claims rows by
+stamping geocode_claimed_at with FOR UPDATE SKIP LOCKED, so each abandoned
+row is picked up by one worker, and again only if that worker does not
+resolve it in time either.
+
+An address ends 'not_found' when the geocoder finds nothing and 'failed'
+when it rejects the query outright. Timeouts, connection errors, rate
+limits and server errors leave the row pending for the sweep to retry, up
+to GEOCODE_MAX_ATTEMPTS times.
+
+The geocoding columns are added to addresses the first time a worker
+needs them (see ready()); until that succeeds, addresses are geocoded on
+the request thread.
+
+Configuration:
+- GEOCODE_MODE: 'async' (default) or 'sync' to geocode on the request thread
+- GEOCODE_BATCH_SIZE: addresses written per batch (default 20)
+- GEOCODE_CONCURRENCY: geocoder calls in flight per batch (default 4)
+- GEOCODE_MAX_ATTEMPTS: geocoder calls before a transient error becomes 'failed' (default 5)
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from psycopg2.extras import execute_values
+
+import db_pool
+import geocoding
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.environ.get('GEOCODE_BATCH_SIZE', 20))
+CONCURRENCY = int(os.environ.get('GEOCODE_CONCURRENCY', 4))
+MAX_ATTEMPTS = int(os.environ.get('GEOCODE_MAX_ATTEMPTS', 5))
+
+# Seconds to wait for more addresses before geocoding a partial batch
+BATCH_WAIT = 0.5
+
+# Seconds between sweeps for pending rows nobody is working on
+SWEEP_INTERVAL = 60
+
+# Pending rows older than this are considered abandoned by their worker
+SWEEP_AFTER = "2 minutes"
+
+_queue = queue.Queue(maxsize=10000)
+_lock = threading.Lock()
+_worker_pid = None
+_columns_lock = threading.Lock()
+_columns_ready = False
+_stats = {"queued": 0, "resolved": 0, "not_found": 0, "failed": 0, "retrying": 0, "batches": 0}
+
+
+def is_async():
+    """Whether addresses should be geocoded in the background"""
+    return os.environ.get('GEOCODE_MODE', 'async') != 'sync'
+
+
+def ensure_geocode_columns(dsn=None):
+    """Add the geocoding state columns to the addresses table"""
+    conn = db_pool.get_db_connection(dsn)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            ALTER TABLE addresses
+                ADD COLUMN IF NOT EXISTS geocode_status TEXT NOT NULL DEFAULT 'done',
+                ADD COLUMN IF NOT EXISTS geocode_query TEXT,
+                ADD COLUMN IF NOT EXISTS geocode_error TEXT,
+                ADD COLUMN IF NOT EXISTS geocoded_at TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS geocode_claimed_at TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS geocode_attempts INTEGER NOT NULL DEFAULT 0
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_addresses_geocode_pending
+            ON addresses (created_at)
+            WHERE geocode_status = 'pending'
+        """)
+        cursor.close()
+        return True
+    except Exception as e:
+        logger.error(f"Error adding geocode columns to addresses: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+
+def ready():
+    """Whether the addresses table has the geocoding columns, adding them if needed"""
+    global _columns_ready
+    if _columns_ready:
+        return True
+    with _columns_lock:
+        if not _columns_ready:
+            _columns_ready = ensure_geocode_columns()
+            if not _columns_ready:
+                logger.warning("Geocoding columns unavailable, geocoding on the request thread")
+    return _columns_ready
+
+
+def enqueue(address_id, query):
+    """Schedule an address row for background geocoding"""
+    start()
+    try:
+        _queue.put_nowait((address_id, query))
+        with _lock:
+            _stats["queued"] += 1
+    except queue.Full:
+        # The row stays pending and is picked up by the next sweep
+        logger.warning(f"Geocode queue full, address {address_id} left for the sweeper")
+
+
+def start():
+    """Start the background geocoding worker for this process"""
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    with _lock:
+        if _worker_pid == os.getpid():
+            return
+        _worker_pid = os.getpid()
+        threading.Thread(target=_worker_loop, name='geocode-worker', daemon=True).start()
+
+
+def _next_batch(timeout):
+    """Block for the first item, then collect more for up to BATCH_WAIT seconds"""
+    try:
+        batch = [_queue.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(batch) < BATCH_SIZE:
+        try:
+            batch.append(_queue.get(timeout=BATCH_WAIT))
+        except queue.Empty:
+            break
+    return batch
+
+
+def is_transient(error):
+    """Whether a geocoder error may succeed on a later attempt"""
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return True
+
+
+def _geocode_one(item):
+    address_id, query = item
+    try:
+        return address_id, geocoding.geocode(query), None
+    except Exception as e:
+        return address_id, None, e
+
+
+def resolve_batch(batch, executor):
+    """Geocode a batch of (address_id, query) pairs and write the results"""
+    results = list(executor.map(_geocode_one, batch))
+
+    resolved = []
+    unresolved = []
+    for address_id, data, error in results:
+        if data:
+            resolved.append((
+                address_id,
+                data['street'],
+                data['city'],
+                data['state'],
+                data['zip'],
+                data['country'],
+                data.get('lat', 0),
+                data.get('lng', 0),
+                f"{data['street']}, {data['city']}, {data['state']} {data['zip']}, {data['country']}",
+            ))
+        elif error is None:
+            unresolved.append((address_id, 'not_found', None, False))
+        else:
+            unresolved.append((address_id, 'failed', str(error), is_transient(error)))
+
+    conn = db_pool.get_db_connection()
+    if not conn:
+        logger.error("Failed to connect to database; geocoded addresses stay pending")
+        return
+    statuses = []
+    try:
+        cursor = conn.cursor()
+        if resolved:
+            execute_values(cursor, """
+                UPDATE addresses AS a
+                SET street = v.street, city = v.city, state = v.state, zip = v.zip,
+                    country = v.country, lat = v.lat, lng = v.lng,
+                    full_address = v.full_address,
+                    geocode_status = 'done', geocode_error = NULL, geocoded_at = NOW()
+                FROM (VALUES %s) AS v (id, street, city, state, zip, country, lat, lng, full_address)
+                WHERE a.id = v.id
+            """, resolved)
+        if unresolved:
+            # A transient error keeps the row pending, claimed until the sweep may retry it
+            statuses = execute_values(cursor, f"""
+                UPDATE addresses AS a
+                SET geocode_attempts = a.geocode_attempts + 1,
+                    geocode_error = v.error,
+                    geocode_status = CASE
+                        WHEN v.transient AND a.geocode_attempts + 1 < {MAX_ATTEMPTS} THEN 'pending' ELSE v.status
+                    END,
+                    geocoded_at = NOW(),
+                    geocode_claimed_at = NOW()
+                FROM (VALUES %s) AS v (id, status, error, transient)
+                WHERE a.id = v.id
+                RETURNING a.geocode_status
+            """, unresolved, fetch=True)
+        cursor.close()
+    finally:
+        conn.close()
+
+    with _lock:
+        _stats["batches"] += 1
+        _stats["resolved"] += len(resolved)
+        for (status,) in statuses:
+            _stats['retrying' if status == 'pending' else status] += 1
+
+
+def _sweep_pending():
+    """Queue pending rows that no worker has resolved in time"""
+    conn = db_pool.get_db_connection()
+    if not conn:
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            UPDATE addresses AS a
+            SET geocode_claimed_at = NOW()
+            FROM (
+                SELECT id
+                FROM addresses
+                WHERE geocode_status = 'pending'
+                AND created_at < NOW() - INTERVAL '{SWEEP_AFTER}'
+                AND (geocode_claimed_at IS NULL OR geocode_claimed_at < NOW() - INTERVAL '{SWEEP_AFTER}')
+                ORDER BY created_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ) AS claimed
+            WHERE a.id = claimed.id
+            RETURNING a.id, COALESCE(a.geocode_query, a.full_address)
+        """, (BATCH_SIZE * 5,))
+        rows = cursor.fetchall()
+        for i, (address_id, query) in enumerate(rows):
+            try:
+                _queue.put_nowait((address_id, query))
+            except queue.Full:
+                # Let another worker's sweep take what did not fit
+                cursor.execute(
+                    "UPDATE addresses SET geocode_claimed_at = NULL WHERE id = ANY(%s)",
+                    ([address_id for address_id, _ in rows[i:]],)
+                )
+                break
+        cursor.close()
+    except Exception as e:
+        logger.error(f"Error sweeping pending geocodes: {str(e)}")
+    finally:
+        conn.close()
+
+
+def _worker_loop():
+    executor = ThreadPoolExecutor(max_workers=CONCURRENCY, thread_name_prefix='geocode')
+    last_sweep = 0.0
+    while True:
+        if time.monotonic() - last_sweep >= SWEEP_INTERVAL:
+            _sweep_pending()
+            last_sweep = time.monotonic()
+        batch = _next_batch(timeout=SWEEP_INTERVAL)
+        if not batch:
+            continue
+        try:
+            resolve_batch(batch, executor)
+        except Exception as e:
+            logger.error(f"Error resolving geocode batch: {str(e)}")
+
+
+def stats():
+    """Return background geocoding counters"""
+    with _lock:
+        snapshot = dict(_stats)
+    snapshot["queue_depth"] = _queue.qsize()
+    return snapshot
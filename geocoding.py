@@ -0,0 +1,339 @@
+"""
+Geocoding Client
+
+Geocodes free-form addresses for /api/process-address.
+
+Requests to Mapbox go through one keep-alive requests.Session with
+connect/read timeouts and retries on transient errors. Results are cached
+by normalized address string, first in a small in-process LRU and then in
+the geocode_cache table, so resubmitting an address does not call Mapbox
+again.
+
+The backend is pluggable: GEOCODER_BACKEND=stub (or set_backend()) swaps
+Mapbox for StubGeocoder so tests and local development run without
+network access.
+
+Configuration:
+- GEOCODER_TIMEOUT: read timeout in seconds (default 10)
+- GEOCODER_RETRIES: retries on connection errors and 429/5xx (default 2)
+- GEOCODE_CACHE_TTL_DAYS: age after which cached results are ignored (default 30)
+- GEOCODE_CACHE_MAX_ROWS: rows kept in geocode_cache (default 100000)
+"""
+
+import os
+import re
+import json
+import random
+import logging
+import threading
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import db_pool
+from catalog_cache import CatalogCache
+
+logger = logging.getLogger(__name__)
+
+MAPBOX_GEOCODE_URL = "https://api.mapbox.com/geocoding/v5/mapbox.places/{query}.json"
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = float(os.environ.get('GEOCODER_TIMEOUT', 10))
+RETRIES = int(os.environ.get('GEOCODER_RETRIES', 2))
+
+CACHE_TTL_DAYS = int(os.environ.get('GEOCODE_CACHE_TTL_DAYS', 30))
+CACHE_MAX_ROWS = int(os.environ.get('GEOCODE_CACHE_MAX_ROWS', 100000))
+
+# Roughly one insert in this many also trims the table to CACHE_MAX_ROWS
+PRUNE_EVERY = 200
+
+
+class GeocoderNotConfigured(Exception):
+    """Raised when the selected backend is missing its credentials"""
+
+
+def normalize_address(address):
+    """Normalize an address string for use as a cache key"""
+    text = (address or '').lower()
+    text = re.sub(r'[^\w#]+', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def parse_mapbox_feature(feature, full_address):
+    """Convert a Mapbox geocoding feature into the address fields we store"""
+    context = feature.get('context', [])
+
+    street = feature.get('text', '')
+    address_number = feature.get('address', '')
+    if address_number:
+        street = f"{address_number} {street}"
+
+    city = ""
+    state = ""
+    country = "USA"
+    postal_code = ""
+
+    # Extract information from context
+    for item in context:
+        if item.get('id', '').startswith('place'):
+            city = item.get('text', '')
+        elif item.get('id', '').startswith('region'):
+            state = item.get('text', '')
+        elif item.get('id', '').startswith('country'):
+            country = item.get('text', '')
+        elif item.get('id', '').startswith('postcode'):
+            postal_code = item.get('text', '')
+
+    coordinates = feature.get('center', [0, 0])
+    return {
+        'street': street,
+        'city': city,
+        'state': state,
+        'zip': postal_code,
+        'country': country,
+        'lat': coordinates[1],  # Mapbox returns [longitude, latitude]
+        'lng': coordinates[0],
+        'full_address': feature.get('place_name', full_address)
+    }
+
+
+def build_session(retries=RETRIES, pool_size=10):
+    """Create a keep-alive HTTP session that retries transient failures"""
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class MapboxGeocoder:
+    """Geocode addresses with the Mapbox Places API"""
+
+    name = 'mapbox'
+
+    def __init__(self, token=None, session=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        self.token = token
+        self.session = session or build_session()
+        self.timeout = timeout
+
+    def geocode(self, address):
+        """Return the parsed address fields, or None if Mapbox found nothing"""
+        token = self.token or os.environ.get('MAPBOX_API_KEY')
+        if not token:
+            raise GeocoderNotConfigured("Mapbox API key not configured")
+
+        response = self.session.get(
+            MAPBOX_GEOCODE_URL.format(query=quote(address, safe='')),
+            params={'access_token': token, 'country': 'US', 'types': 'address'},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        features = response.json().get('features') or []
+        if not features:
+            return None
+        # The first feature is the most relevant match
+        return parse_mapbox_feature(features[0], address)
+
+
+class StubGeocoder:
+    """Offline geocoder for tests: known addresses or a deterministic fake location"""
+
+    name = 'stub'
+
+    def __init__(self, results=None):
+        self.results = {normalize_address(key): value for key, value in (results or {}).items()}
+        self.calls = 0
+
+    def geocode(self, address):
+        """Return the configured result, or a fake location derived from the address"""
+        self.calls += 1
+        key = normalize_address(address)
+        if key in self.results:
+            return dict(self.results[key]) if self.results[key] else None
+        rng = random.Random(key)
+        return {
+            'street': address.split(',')[0].strip(),
+            'city': 'Springfield',
+            'state': 'IL',
+            'zip': '62701',
+            'country': 'United States',
+            'lat': round(rng.uniform(25.0, 48.0), 6),
+            'lng': round(rng.uniform(-123.0, -70.0), 6),
+            'full_address': address
+        }
+
+
+class GeocodeCache:
+    """Two-level cache: in-process LRU in front of the geocode_cache table"""
+
+    def __init__(self, memory_entries=1024, ttl_days=CACHE_TTL_DAYS, max_rows=CACHE_MAX_ROWS):
+        self.memory = CatalogCache(max_entries=memory_entries, default_ttl=ttl_days * 86400)
+        self.ttl_days = ttl_days
+        self.max_rows = max_rows
+        self._stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "db_errors": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key):
+        """Return a cached result that is younger than the TTL, or None"""
+        result = self.memory.get(key)
+        if result is not None:
+            self._count("memory_hits")
+            return result
+
+        conn = db_pool.get_db_connection()
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT result FROM geocode_cache
+                    WHERE address_key = %s
+                    AND created_at > NOW() - make_interval(days => %s)
+                """, (key, self.ttl_days))
+                row = cursor.fetchone()
+                cursor.close()
+                if row:
+                    result = row[0] if isinstance(row[0], dict) else json.loads(row[0])
+                    self.memory.put(key, result)
+                    self._count("db_hits")
+                    return result
+            except Exception as e:
+                self._count("db_errors")
+                logger.warning(f"Geocode cache lookup failed: {str(e)}")
+            finally:
+                conn.close()
+
+        self._count("misses")
+        return None
+
+    def put(self, key, result):
+        """Cache a result in memory and in the geocode_cache table"""
+        self.memory.put(key, result)
+
+        conn = db_pool.get_db_connection()
+        if not conn:
+            return
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO geocode_cache (address_key, result, created_at)
+                VALUES (%s, %s, NOW())
+                ON CONFLICT (address_key) DO UPDATE
+                SET result = EXCLUDED.result, created_at = EXCLUDED.created_at
+            """, (key, json.dumps(result)))
+            if random.randrange(PRUNE_EVERY) == 0:
+                cursor.execute("""
+                    DELETE FROM geocode_cache
+                    WHERE address_key IN (
+                        SELECT address_key FROM geocode_cache
+                        ORDER BY created_at DESC
+                        OFFSET %s
+                    )
+                """, (self.max_rows,))
+            cursor.close()
+        except Exception as e:
+            self._count("db_errors")
+            logger.warning(f"Geocode cache write failed: {str(e)}")
+        finally:
+            conn.close()
+
+    def stats(self):
+        """Return hit/miss counters for both cache levels"""
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["memory"] = self.memory.stats()
+        return snapshot
+
+
+def ensure_geocode_cache_table(dsn=None):
+    """Ensure the geocode_cache table exists"""
+    conn = db_pool.get_db_connection(dsn)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS geocode_cache (
+                address_key TEXT PRIMARY KEY,
+                result JSONB NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_geocode_cache_created_at
+            ON geocode_cache (created_at)
+        """)
+        cursor.close()
+        return True
+    except Exception as e:
+        logger.error(f"Error creating geocode_cache table: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+
+_backend = None
+_cache = GeocodeCache()
+
+
+def get_backend():
+    """Return the configured geocoder backend"""
+    global _backend
+    if _backend is None:
+        if os.environ.get('GEOCODER_BACKEND', 'mapbox') == 'stub':
+            _backend = StubGeocoder()
+        else:
+            _backend = MapboxGeocoder()
+    return _backend
+
+
+def set_backend(backend):
+    """Replace the geocoder backend (e.g. with a StubGeocoder in tests)"""
+    global _backend
+    _backend = backend
+
+
+def cached(address):
+    """Return a cached geocode for an address without calling the backend"""
+    key = normalize_address(address)
+    if not key:
+        return None
+    result = _cache.get(key)
+    return dict(result) if result is not None else None
+
+
+def geocode(address):
+    """Geocode an address, using the cache when possible; None if not found"""
+    key = normalize_address(address)
+    if not key:
+        return None
+
+    hit = _cache.get(key)
+    if hit is not None:
+        return dict(hit)
+
+    result = get_backend().geocode(address)
+    if result:
+        _cache.put(key, result)
+        # Callers may modify what they get back; the cached entry must not change
+        return dict(result)
+    return result
+
+
+def stats():
+    """Return geocode cache counters"""
+    return _cache.stats()
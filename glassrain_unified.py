@@ -12,8 +12,22 @@ This is a fully contained Flask application for GlassRain that combines all feat
 
 import os
 import json
+import base64
 import logging
-import psycopg2
+import log_config
+import db_pool
+import catalog_cache
+import http_cache
+import product_search
+import recommendations
+import featured_products
+import contractor_index
+import geocoding
+import geocode_queue
+import checkout_ingest
+import contractor_traffic
+import app_metrics
+import sql_trace
 from decimal import Decimal
 from flask import Flask, jsonify, request, render_template, redirect, send_from_directory
 from psycopg2.extras import RealDictCursor
@@ -25,12 +39,7 @@ def index():
     return "GlassRain is running!"
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='glassrain_unified.log', 
-    filemode='a'
-)
+log_config.configure(filename='glassrain_unified.log')
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
@@ -47,20 +56,15 @@ class DecimalEncoder(json.JSONEncoder):
 app.json_encoder = DecimalEncoder
 
 def get_db_connection():
-    """Get a connection to the PostgreSQL database"""
-    try:
-        conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
-        conn.autocommit = True
-        return conn
-    except Exception as e:
-        logger.error(f"Database connection error: {str(e)}")
-        return None
+    """Get a pooled connection to the PostgreSQL database"""
+    return db_pool.get_db_connection()
 
 def add_headers(response):
     """Add headers to allow iframe embedding and CORS"""
     response.headers['X-Frame-Options'] = 'ALLOWALL'
     response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, If-None-Match'
+    response.headers['Access-Control-Expose-Headers'] = 'ETag, X-Next-Cursor'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
     return response
 
@@ -85,6 +89,15 @@ def status():
         "status": "online",
         "version": "1.0.0",
         "database": db_status,
+        "db_pool": db_pool.pool_stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "contractor_index": contractor_index.stats(),
+        "geocode_cache": geocoding.stats(),
+        "geocode_queue": geocode_queue.stats(),
+        "checkout_ingest": checkout_ingest.stats(),
+        "contractor_traffic": contractor_traffic.stats(),
+        "logging": log_config.stats(),
+        "sql_trace": sql_trace.stats(),
         "name": "GlassRain Unified API",
         "features": [
             "service_categories",
@@ -100,6 +113,11 @@ def status():
 @app.route('/api/service-categories')
 def get_service_categories():
     """Return list of service categories"""
+    cached = catalog_cache.get('service_categories')
+    if cached is not None:
+        return http_cache.conditional_response(cached)
+    generation = catalog_cache.generation()
+    
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
@@ -115,7 +133,9 @@ def get_service_categories():
         cursor.close()
         conn.close()
         
-        return jsonify(categories)
+        payload = http_cache.json_payload(categories)
+        catalog_cache.put('service_categories', payload, tables=('service_categories',), generation=generation)
+        return http_cache.conditional_response(payload)
     except Exception as e:
         logger.error(f"Error fetching service categories: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -123,6 +143,11 @@ def get_service_categories():
 @app.route('/api/services')
 def get_services():
     """Return list of available services with categories and subcategories"""
+    cached = catalog_cache.get('services')
+    if cached is not None:
+        return http_cache.conditional_response(cached)
+    generation = catalog_cache.generation()
+    
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
@@ -138,36 +163,41 @@ def get_services():
         """)
         categories = cursor.fetchall()
         
-        # For each category, get its services
+        # Fetch every service and option in bulk and stitch them onto their
+        # parents in Python, so the query count does not grow with the catalog
+        cursor.execute("""
+            SELECT s.id, s.category_id, s.name, s.description, s.base_price, 
+                   COALESCE(s.base_price_per_sqft, 0) as base_price_per_sqft,
+                   COALESCE(s.min_price, 0) as min_price,
+                   COALESCE(s.unit, '') as unit
+            FROM services s
+            ORDER BY s.name
+        """)
+        services = cursor.fetchall()
+        
+        cursor.execute("""
+            SELECT id, service_id, name, description, price_adjustment, is_default
+            FROM service_options
+            ORDER BY name
+        """)
+        options_by_service = {}
+        for option in cursor.fetchall():
+            options_by_service.setdefault(option.pop('service_id'), []).append(option)
+        
+        services_by_category = {}
+        for service in services:
+            service['options'] = options_by_service.get(service['id'], [])
+            services_by_category.setdefault(service.pop('category_id'), []).append(service)
+        
         for category in categories:
-            cursor.execute("""
-                SELECT s.id, s.name, s.description, s.base_price, 
-                       COALESCE(s.base_price_per_sqft, 0) as base_price_per_sqft,
-                       COALESCE(s.min_price, 0) as min_price,
-                       COALESCE(s.unit, '') as unit
-                FROM services s
-                WHERE s.category_id = %s
-                ORDER BY s.name
-            """, (category['id'],))
-            services = cursor.fetchall()
-            
-            # For each service, get its sub-services if any
-            for service in services:
-                cursor.execute("""
-                    SELECT id, name, description, price_adjustment, is_default
-                    FROM service_options
-                    WHERE service_id = %s
-                    ORDER BY name
-                """, (service['id'],))
-                options = cursor.fetchall()
-                service['options'] = options
-            
-            category['services'] = services
+            category['services'] = services_by_category.get(category['id'], [])
         
         cursor.close()
         conn.close()
         
-        return jsonify(categories)
+        payload = http_cache.json_payload(categories)
+        catalog_cache.put('services', payload, tables=('service_categories', 'services', 'service_options'), generation=generation)
+        return http_cache.conditional_response(payload)
     except Exception as e:
         logger.error(f"Error fetching services: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -175,6 +205,11 @@ def get_services():
 @app.route('/api/service-tiers')
 def get_service_tiers():
     """Return service tiers with their multipliers"""
+    cached = catalog_cache.get('service_tiers')
+    if cached is not None:
+        return http_cache.conditional_response(cached)
+    generation = catalog_cache.generation()
+    
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
@@ -190,16 +225,59 @@ def get_service_tiers():
         cursor.close()
         conn.close()
         
-        return jsonify(tiers)
+        payload = http_cache.json_payload(tiers)
+        catalog_cache.put('service_tiers', payload, tables=('service_tiers',), generation=generation)
+        return http_cache.conditional_response(payload)
     except Exception as e:
         logger.error(f"Error fetching service tiers: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def encode_page_cursor(values):
+    """Encode keyset pagination values into an opaque cursor string"""
+    payload = json.dumps(values, cls=DecimalEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_page_cursor(cursor):
+    """
+    Decode a /api/contractors cursor into its (tier_level, rating, id) key
+    
+    Returns None unless the cursor holds exactly a string, a finite number
+    and an integer id, so a tampered cursor never reaches the query.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')), parse_float=Decimal)
+    except (ValueError, UnicodeError, RecursionError):
+        return None
+    if not isinstance(values, list) or len(values) != 3:
+        return None
+    tier_level, rating, contractor_id = values
+    if not isinstance(tier_level, str):
+        return None
+    if isinstance(rating, bool) or not isinstance(rating, (int, Decimal)) or not Decimal(rating).is_finite():
+        return None
+    if isinstance(contractor_id, bool) or not isinstance(contractor_id, int) or not -2**63 <= contractor_id < 2**63:
+        return None
+    return tier_level, rating, contractor_id
+
 @app.route('/api/contractors', methods=['GET'])
 def get_contractors():
-    """Return contractors, optionally filtered by service type"""
+    """
+    Return contractors, optionally filtered by service type and zipcode
+    
+    Results are ordered by (tier_level, rating, id) and paginated with a
+    keyset cursor: pass `limit` (default 50, max 200) and the `after` value
+    from the previous response's X-Next-Cursor header to get the next page.
+    """
     service_id = request.args.get('service_id')
     zipcode = request.args.get('zipcode')
+    limit = max(1, min(request.args.get('limit', default=50, type=int), 200))
+    after = request.args.get('after')
+    
+    after_key = None
+    if after:
+        after_key = decode_page_cursor(after)
+        if after_key is None:
+            return jsonify({"error": "Invalid pagination cursor"}), 400
     
     conn = get_db_connection()
     if not conn:
@@ -237,29 +315,56 @@ def get_contractors():
             """)
             params.append(zipcode)
         
+        if after_key:
+            where_clauses.append("""
+                (COALESCE(c.tier_level, ''), COALESCE(c.rating, 0), c.id) < (%s, %s, %s)
+            """)
+            params.extend(after_key)
+        
         if where_clauses:
             query += " WHERE " + " AND ".join(where_clauses)
             
-        query += " GROUP BY c.id ORDER BY c.tier_level DESC, c.rating DESC"
+        query += """
+            GROUP BY c.id
+            ORDER BY COALESCE(c.tier_level, '') DESC, COALESCE(c.rating, 0) DESC, c.id DESC
+            LIMIT %s
+        """
+        # Fetch one extra row to find out whether another page exists
+        params.append(limit + 1)
         
         cursor.execute(query, params)
         contractors = cursor.fetchall()
         
-        # Get services for each contractor
-        for contractor in contractors:
+        next_cursor = None
+        if len(contractors) > limit:
+            contractors = contractors[:limit]
+            last = contractors[-1]
+            next_cursor = encode_page_cursor([last['tier_level'] or '', last['rating'] or 0, last['id']])
+        
+        # Get services for every contractor on the page in one query
+        services_by_contractor = {}
+        if contractors:
             cursor.execute("""
-                SELECT s.id, s.name, s.description, s.base_price
+                SELECT cs.contractor_id, s.id, s.name, s.description, s.base_price
                 FROM services s
                 JOIN contractor_services cs ON s.id = cs.service_id
-                WHERE cs.contractor_id = %s
-            """, (contractor['id'],))
-            services = cursor.fetchall()
-            contractor['services'] = services
+                WHERE cs.contractor_id = ANY(%s)
+            """, ([contractor['id'] for contractor in contractors],))
+            for service in cursor.fetchall():
+                services_by_contractor.setdefault(service.pop('contractor_id'), []).append(service)
+        
+        for contractor in contractors:
+            contractor['services'] = services_by_contractor.get(contractor['id'], [])
             
         cursor.close()
         conn.close()
         
-        return jsonify(contractors)
+        contractor_traffic.record([contractor['id'] for contractor in contractors])
+        
+        response = jsonify(contractors)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
     except Exception as e:
         logger.error(f"Error fetching contractors: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -276,62 +381,89 @@ def match_contractor():
     if not service_id or not zipcode:
         return jsonify({"error": "service_id and zipcode are required"}), 400
     
-    conn = get_db_connection()
-    if not conn:
+    index = contractor_index.get_index()
+    if index is None:
         return jsonify({"error": "Database connection failed"}), 500
     
     try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Find best matching contractor
-        cursor.execute("""
-            SELECT c.id, c.name, c.description, c.contact_email, 
-                  c.contact_phone, c.website, c.logo_url, c.rating,
-                  c.tier_level
-            FROM contractors c
-            JOIN contractor_services cs ON c.id = cs.contractor_id
-            JOIN contractor_service_areas csa ON c.id = csa.contractor_id
-            WHERE cs.service_id = %s
-            AND csa.zipcode = %s
-            ORDER BY 
-                c.tier_level = 'Diamond' DESC,
-                c.tier_level = 'Gold' DESC,
-                c.tier_level = 'Standard' DESC,
-                c.rating DESC
-            LIMIT 1
-        """, (service_id, zipcode))
-        
-        contractor = cursor.fetchone()
-        
-        if not contractor:
-            return jsonify({
-                "match_found": False,
-                "message": "No matching contractor found for this service in your area"
-            })
-            
-        # Get service details
-        cursor.execute("""
-            SELECT s.id, s.name, s.description, s.base_price
-            FROM services s
-            WHERE s.id = %s
-        """, (service_id,))
-        service = cursor.fetchone()
-        
-        cursor.close()
-        conn.close()
-        
-        return jsonify({
-            "match_found": True,
-            "contractor": contractor,
-            "service": service
-        })
+        return jsonify(contractor_match_result(index, service_id, zipcode))
     except Exception as e:
         logger.error(f"Error matching contractor: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# Largest number of line items accepted by /api/match-contractor/batch
+MAX_MATCH_BATCH = 100
+
+@app.route('/api/match-contractor/batch', methods=['POST'])
+def match_contractor_batch():
+    """
+    Match the best contractor for several services and locations at once
+    
+    Expected JSON payload:
+    {
+        "items": [
+            {"service_id": 1, "zipcode": "94103"},
+            ...
+        ]
+    }
+    
+    Returns {"results": [...]} with one entry per item, in the same order and
+    in the same shape /api/match-contractor returns for a single item.
+    """
+    if not request.json:
+        return jsonify({"error": "No JSON data provided"}), 400
+    
+    items = request.json.get('items') if isinstance(request.json, dict) else request.json
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items must be a non-empty list"}), 400
+    if len(items) > MAX_MATCH_BATCH:
+        return jsonify({"error": f"At most {MAX_MATCH_BATCH} items can be matched per request"}), 400
+    
+    index = contractor_index.get_index()
+    if index is None:
+        return jsonify({"error": "Database connection failed"}), 500
+    
+    try:
+        results = []
+        for item in items:
+            service_id = item.get('service_id') if isinstance(item, dict) else None
+            zipcode = item.get('zipcode') if isinstance(item, dict) else None
+            if not service_id or not zipcode:
+                results.append({"error": "service_id and zipcode are required"})
+                continue
+            results.append(contractor_match_result(index, service_id, zipcode))
+        
+        return jsonify({"results": results})
+    except Exception as e:
+        logger.error(f"Error matching contractors in batch: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+def contractor_match_result(index, service_id, zipcode):
+    """Build the match response for one service and zipcode from the contractor index"""
+    contractor = index.best_match(service_id, zipcode)
+    
+    if not contractor:
+        return {
+            "match_found": False,
+            "message": "No matching contractor found for this service in your area"
+        }
+    
+    contractor_traffic.record([contractor['id']])
+    
+    return {
+        "match_found": True,
+        "contractor": contractor,
+        "service": index.service(service_id)
+    }
+
 @app.route('/api/stores')
 def get_stores():
     """Return list of stores"""
+    cached = catalog_cache.get('stores')
+    if cached is not None:
+        return http_cache.conditional_response(cached)
+    generation = catalog_cache.generation()
+    
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
@@ -347,7 +479,9 @@ def get_stores():
         cursor.close()
         conn.close()
         
-        return jsonify(stores)
+        payload = http_cache.json_payload(stores)
+        catalog_cache.put('stores', payload, tables=('stores',), generation=generation)
+        return http_cache.conditional_response(payload)
     except Exception as e:
         logger.error(f"Error fetching stores: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -355,6 +489,11 @@ def get_stores():
 @app.route('/api/store-categories')
 def get_store_categories():
     """Return list of store product categories"""
+    cached = catalog_cache.get('store_categories')
+    if cached is not None:
+        return http_cache.conditional_response(cached)
+    generation = catalog_cache.generation()
+    
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
@@ -370,7 +509,9 @@ def get_store_categories():
         cursor.close()
         conn.close()
         
-        return jsonify(categories)
+        payload = http_cache.json_payload(categories)
+        catalog_cache.put('store_categories', payload, tables=('store_categories',), generation=generation)
+        return http_cache.conditional_response(payload)
     except Exception as e:
         logger.error(f"Error fetching store categories: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -380,6 +521,7 @@ def get_recommended_products():
     """Return recommended products for a room"""
     room_type = request.args.get('room')
     limit = request.args.get('limit', default=10, type=int)
+    seed = request.args.get('seed', type=int)
     
     if not room_type:
         return jsonify({"error": "Room type is required"}), 400
@@ -391,101 +533,27 @@ def get_recommended_products():
     try:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        # First approach: Try direct text matching on products
-        search_query = """
-            SELECT p.id, p.name, p.description, p.price, 
-                p.is_on_sale, p.sale_price, p.image_url,
-                p.product_url, p.external_id,
-                s.id as store_id, s.name as store_name, s.logo_url as store_logo,
-                sc.name as category_name
-            FROM products p
-            JOIN stores s ON p.store_id = s.id
-            JOIN store_categories sc ON p.category_id = sc.id
-            WHERE sc.name ILIKE %s
-            OR p.name ILIKE %s
-            OR p.description ILIKE %s
-            ORDER BY p.price DESC
-            LIMIT %s
-        """
-        
-        # Use room type as search parameter
-        search_pattern = f"%{room_type}%"
-        params = [search_pattern, search_pattern, search_pattern, limit]
-        
-        cursor.execute(search_query, params)
-        recommended_products = cursor.fetchall()
-        
-        # If no direct matches, use room category mapping
-        if len(recommended_products) == 0:
-            logger.info(f"No direct matches for room type {room_type}, trying category mapping")
-            
-            # Map room types to categories that would be relevant for that room
-            room_category_map = {
-                'living': ['Furniture', 'Lighting', 'Decor', 'Entertainment'],
-                'kitchen': ['Kitchen', 'Appliances', 'Dining'],
-                'bedroom': ['Furniture', 'Bedding', 'Lighting', 'Decor'],
-                'bathroom': ['Bath', 'Fixtures', 'Storage'],
-                'office': ['Office', 'Furniture', 'Electronics'],
-                'outdoor': ['Outdoor', 'Garden', 'Patio']
-            }
-            
-            # Get categories relevant to this room type
-            relevant_categories = room_category_map.get(room_type.lower(), ['Furniture', 'Lighting', 'Decor'])
-            
-            placeholders = ', '.join(['%s'] * len(relevant_categories))
-            category_query = f"""
-                SELECT p.id, p.name, p.description, p.price, 
-                      p.is_on_sale, p.sale_price, p.image_url,
-                      p.product_url, p.external_id,
-                      s.id as store_id, s.name as store_name, s.logo_url as store_logo,
-                      sc.name as category_name
-                FROM products p
-                JOIN stores s ON p.store_id = s.id
-                JOIN store_categories sc ON p.category_id = sc.id
-                WHERE sc.name ILIKE ANY(%s)
-                ORDER BY p.price DESC
-                LIMIT %s
-            """
-            
-            # Build array of patterns for ILIKE ANY
-            category_patterns = [f"%{cat}%" for cat in relevant_categories]
-            cursor.execute(category_query, [category_patterns, limit])
-            recommended_products = cursor.fetchall()
+        # Ranked product lists per room are precomputed by recommendations.py
+        recommended_products = recommendations.get_room_products(cursor, room_type, limit)
         
-        # If still no results, return featured products
+        # If nothing has been precomputed yet, return featured products
         if len(recommended_products) == 0:
-            logger.info(f"No category matches for room type {room_type}, falling back to featured products")
-            
-            # Fallback to random products
-            cursor.execute("""
-                SELECT p.id, p.name, p.description, p.price, 
-                    p.is_on_sale, p.sale_price, p.image_url,
-                    p.product_url, p.external_id,
-                    s.id as store_id, s.name as store_name, s.logo_url as store_logo,
-                    sc.name as category_name
-                FROM products p
-                JOIN stores s ON p.store_id = s.id
-                JOIN store_categories sc ON p.category_id = sc.id
-                ORDER BY RANDOM()
-                LIMIT %s
-            """, [limit])
-            recommended_products = cursor.fetchall()
-        
-        # Format the products for the response
-        for product in recommended_products:
-            # Format for JSON serialization
-            if product['price'] is not None:
-                product['price'] = float(product['price'])
-            if product['sale_price'] is not None:
-                product['sale_price'] = float(product['sale_price'])
-            
-            # Add formatted data
-            product['image_url'] = product['image_url'] or '/static/img/product-placeholder.jpg'
+            logger.info(f"No recommendations for room type {room_type}, falling back to featured products")
             
-            # Rename store_name to a more frontend-friendly property
-            product['store'] = product['store_name']
-        
-        return jsonify({"products": recommended_products})
+            # Fallback to products sampled from the featured pool
+            product_ids = featured_products.sample(cursor, limit, seed=seed)
+            if product_ids:
+                cursor.execute(f"""
+                    SELECT {recommendations.PRODUCT_COLUMNS}
+                    FROM products p
+                    JOIN stores s ON p.store_id = s.id
+                    JOIN store_categories sc ON p.category_id = sc.id
+                    WHERE p.id = ANY(%s)
+                    ORDER BY array_position(%s, p.id)
+                """, [product_ids, product_ids])
+                recommended_products = cursor.fetchall()
+        
+        return http_cache.json_response({"products": recommended_products})
     
     except Exception as e:
         logger.error(f"Error retrieving recommended products: {str(e)}")
@@ -495,13 +563,24 @@ def get_recommended_products():
         if conn:
             conn.close()
 
+# Most products returned per category by /api/products
+MAX_PRODUCTS_PER_CATEGORY = 100
+
 @app.route('/api/products')
 def get_products():
-    """Return products, optionally filtered by store or category"""
+    """Return products grouped by category, optionally filtered by store or category"""
     store_id = request.args.get('store_id')
     category_id = request.args.get('category_id')
     search_term = request.args.get('search')
-    limit = request.args.get('limit', default=20, type=int)
+    limit = min(max(1, request.args.get('limit', default=20, type=int)), MAX_PRODUCTS_PER_CATEGORY)
+    
+    # Free-text searches are too varied to be worth caching server-side
+    cache_key = None if search_term else f"products?store_id={store_id or ''}&category_id={category_id or ''}&limit={limit}"
+    if cache_key:
+        cached = catalog_cache.get_product(cache_key)
+        if cached is not None:
+            return http_cache.conditional_response(cached, http_cache.REVALIDATE_CACHE_CONTROL)
+    generation = catalog_cache.product_generation()
     
     conn = get_db_connection()
     if not conn:
@@ -510,62 +589,82 @@ def get_products():
     try:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
-        # Get all categories first
-        cursor.execute("""
-            SELECT sc.id, sc.name
-            FROM store_categories sc
-            ORDER BY sc.name
-        """)
-        categories = cursor.fetchall()
+        where_clauses = []
+        params = []
         
-        # For each category, get its products (with filters applied)
-        for category in categories:
-            query = """
-                SELECT p.id, p.name, p.description, p.price, 
+        if store_id:
+            where_clauses.append("p.store_id = %s")
+            params.append(store_id)
+            
+        if category_id:
+            where_clauses.append("p.category_id = %s")
+            params.append(category_id)
+            
+        # Within a category, search results are ordered by relevance
+        order_sql = "p.name, p.id"
+        order_params = []
+        search = product_search.build_filter(search_term, cursor) if search_term else None
+        if search:
+            where_clauses.append(search.where_sql)
+            params.extend(search.where_params)
+            order_sql = f"{search.rank_sql} DESC, p.name, p.id"
+            order_params = search.rank_params
+        
+        where_sql = ("WHERE " + " AND ".join(where_clauses)) if where_clauses else ""
+        
+        # Rank products within each category and keep the top `limit` of
+        # every category in a single pass. Categories without matching
+        # products simply produce no rows.
+        cursor.execute(f"""
+            SELECT ranked.*
+            FROM (
+                SELECT sc.id as category_id, sc.name as category_name,
+                      p.id, p.name, p.description, p.price, 
                       p.is_on_sale, p.sale_price, p.image_url,
                       p.product_url, p.external_id,
-                      s.id as store_id, s.name as store_name, s.logo_url as store_logo
+                      s.id as store_id, s.name as store_name, s.logo_url as store_logo,
+                      ROW_NUMBER() OVER (PARTITION BY p.category_id ORDER BY {order_sql}) as category_rank
                 FROM products p
                 JOIN stores s ON p.store_id = s.id
-                WHERE p.category_id = %s
-            """
-            
-            params = [category['id']]
+                JOIN store_categories sc ON p.category_id = sc.id
+                {where_sql}
+            ) ranked
+            WHERE ranked.category_rank <= %s
+            ORDER BY ranked.category_name, ranked.category_id, ranked.category_rank
+        """, order_params + params + [limit])
+        rows = cursor.fetchall()
+        
+        categories = []
+        categories_by_id = {}
+        for product in rows:
+            category_key = product.pop('category_id')
+            category_name = product.pop('category_name')
+            product.pop('category_rank')
             
-            if store_id:
-                query += " AND p.store_id = %s"
-                params.append(store_id)
-                
-            if search_term:
-                query += " AND (p.name ILIKE %s OR p.description ILIKE %s)"
-                search_pattern = f"%{search_term}%"
-                params.extend([search_pattern, search_pattern])
-                
-            query += f" ORDER BY p.name LIMIT {limit}"
+            category = categories_by_id.get(category_key)
+            if category is None:
+                category = {'id': category_key, 'name': category_name, 'products': []}
+                categories_by_id[category_key] = category
+                categories.append(category)
             
-            cursor.execute(query, params)
-            products = cursor.fetchall()
+            # Format for JSON serialization
+            if product['price'] is not None:
+                product['price'] = float(product['price'])
+            if product['sale_price'] is not None:
+                product['sale_price'] = float(product['sale_price'])
             
-            # Format the products for the response
-            for product in products:
-                # Format for JSON serialization
-                if product['price'] is not None:
-                    product['price'] = float(product['price'])
-                if product['sale_price'] is not None:
-                    product['sale_price'] = float(product['sale_price'])
-                
-                # Add formatted data
-                product['image_url'] = product['image_url'] or '/static/img/product-placeholder.jpg'
-                
-            category['products'] = products
+            # Add formatted data
+            product['image_url'] = product['image_url'] or '/static/img/product-placeholder.jpg'
             
-        # Filter out categories with no products
-        categories = [cat for cat in categories if cat['products']]
+            category['products'].append(product)
         
         cursor.close()
         conn.close()
         
-        return jsonify(categories)
+        payload = http_cache.json_payload(categories)
+        if cache_key:
+            catalog_cache.put_product(cache_key, payload, tables=('products', 'stores', 'store_categories'), generation=generation)
+        return http_cache.conditional_response(payload, http_cache.REVALIDATE_CACHE_CONTROL)
     except Exception as e:
         logger.error(f"Error fetching products: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -613,72 +712,43 @@ def process_address():
         return jsonify({"error": "No JSON data provided"}), 400
     
     address_data = request.json
+    pending = False
     
     # Check for the different format from updated template
     if 'address' in address_data:
         # This is from the updated template which just sends the full address string
         # We need to geocode it to get the details
         full_address = address_data['address']
+        user_id = address_data.get('user_id')
         
-        # Get geocoding from Mapbox
-        mapbox_token = os.environ.get('MAPBOX_API_KEY')
-        if not mapbox_token:
-            return jsonify({"error": "Mapbox API key not configured"}), 500
-            
-        # Geocode the address using Mapbox
+        # Geocode the address (cached by normalized address string). In async
+        # mode only the cache is consulted here; anything else is saved as
+        # pending and resolved by the background geocoder.
         try:
-            import requests
-            geocode_url = f"https://api.mapbox.com/geocoding/v5/mapbox.places/{full_address}.json?access_token={mapbox_token}&country=US&types=address"
-            response = requests.get(geocode_url)
-            geocode_data = response.json()
-            
-            if not geocode_data['features'] or len(geocode_data['features']) == 0:
-                return jsonify({"error": "Could not geocode the address"}), 400
-                
-            # Get the first feature (most relevant match)
-            feature = geocode_data['features'][0]
-            
-            # Extract components from the context and place_name
-            context = feature.get('context', [])
-            place_name_parts = feature.get('place_name', '').split(', ')
-            
-            street = feature.get('text', '')
-            address_number = feature.get('address', '')
-            if address_number:
-                street = f"{address_number} {street}"
-                
-            city = ""
-            state = ""
-            country = "USA"
-            postal_code = ""
-            
-            # Extract information from context
-            for item in context:
-                if item.get('id', '').startswith('place'):
-                    city = item.get('text', '')
-                elif item.get('id', '').startswith('region'):
-                    state = item.get('text', '')
-                elif item.get('id', '').startswith('country'):
-                    country = item.get('text', '')
-                elif item.get('id', '').startswith('postcode'):
-                    postal_code = item.get('text', '')
-            
-            # Build standardized address_data
-            coordinates = feature.get('center', [0, 0])
-            address_data = {
-                'street': street,
-                'city': city,
-                'state': state,
-                'zip': postal_code,
-                'country': country,
-                'lat': coordinates[1],  # Mapbox returns [longitude, latitude]
-                'lng': coordinates[0],
-                'full_address': feature.get('place_name', full_address)
-            }
-            
+            if geocode_queue.is_async() and geocode_queue.ready():
+                geocoded = geocoding.cached(full_address)
+                pending = geocoded is None
+            else:
+                geocoded = geocoding.geocode(full_address)
+                if not geocoded:
+                    return jsonify({"error": "Could not geocode the address"}), 400
+        except geocoding.GeocoderNotConfigured as e:
+            return jsonify({"error": str(e)}), 500
         except Exception as e:
             logger.error(f"Error geocoding address: {str(e)}")
             return jsonify({"error": "Failed to process address information"}), 500
+        
+        if pending:
+            address_data = {
+                'street': full_address,
+                'city': '',
+                'state': '',
+                'zip': '',
+                'country': '',
+            }
+        else:
+            address_data = geocoded
+        address_data['user_id'] = user_id
     else:
         # This is from the original template with individual fields
         # Validate required fields
@@ -701,23 +771,42 @@ def process_address():
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         # Add address
-        cursor.execute("""
-            INSERT INTO addresses (
-                street, city, state, zip, country,
-                lat, lng, full_address, created_at
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s, NOW()
-            ) RETURNING id
-        """, (
-            address_data['street'],
-            address_data['city'],
-            address_data['state'],
-            address_data['zip'],
-            address_data['country'],
-            address_data.get('lat', 0),
-            address_data.get('lng', 0),
-            f"{address_data['street']}, {address_data['city']}, {address_data['state']} {address_data['zip']}, {address_data['country']}",
-        ))
+        if pending:
+            cursor.execute("""
+                INSERT INTO addresses (
+                    street, city, state, zip, country,
+                    lat, lng, full_address, created_at,
+                    geocode_status, geocode_query
+                ) VALUES (
+                    %s, %s, %s, %s, %s, 0, 0, %s, NOW(), 'pending', %s
+                ) RETURNING id
+            """, (
+                address_data['street'],
+                address_data['city'],
+                address_data['state'],
+                address_data['zip'],
+                address_data['country'],
+                full_address,
+                full_address,
+            ))
+        else:
+            cursor.execute("""
+                INSERT INTO addresses (
+                    street, city, state, zip, country,
+                    lat, lng, full_address, created_at
+                ) VALUES (
+                    %s, %s, %s, %s, %s, %s, %s, %s, NOW()
+                ) RETURNING id
+            """, (
+                address_data['street'],
+                address_data['city'],
+                address_data['state'],
+                address_data['zip'],
+                address_data['country'],
+                address_data.get('lat', 0),
+                address_data.get('lng', 0),
+                f"{address_data['street']}, {address_data['city']}, {address_data['state']} {address_data['zip']}, {address_data['country']}",
+            ))
         
         address_id = cursor.fetchone()['id']
         
@@ -738,15 +827,54 @@ def process_address():
         cursor.close()
         conn.close()
         
+        if pending:
+            geocode_queue.enqueue(address_id, full_address)
+            return jsonify({
+                "success": True,
+                "address_id": address_id,
+                "geocode_status": "pending",
+                "status_url": f"/api/addresses/{address_id}/geocode",
+                "message": "Address saved, location is being resolved"
+            }), 202
+        
         return jsonify({
             "success": True,
             "address_id": address_id,
+            "geocode_status": "done",
             "message": "Address saved successfully"
         })
     except Exception as e:
         logger.error(f"Error saving address: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/addresses/<int:address_id>/geocode', methods=['GET'])
+def get_address_geocode_status(address_id):
+    """Report whether background geocoding of a saved address has finished"""
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
+    
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("""
+            SELECT id as address_id, geocode_status, geocode_error,
+                   street, city, state, zip, country,
+                   lat, lng, full_address, geocoded_at
+            FROM addresses
+            WHERE id = %s
+        """, (address_id,))
+        address = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        
+        if not address:
+            return jsonify({"error": "Address not found"}), 404
+        
+        return jsonify(address)
+    except Exception as e:
+        logger.error(f"Error retrieving geocode status: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/addresses', methods=['GET'])
 def get_addresses():
     """Get saved addresses for current user"""
@@ -784,6 +912,12 @@ def serve_static(filename):
 @app.route('/api/products/<int:product_id>')
 def get_product(product_id):
     """Return a specific product by ID"""
+    cache_key = f"product:{product_id}"
+    cached = catalog_cache.get_product(cache_key)
+    if cached is not None:
+        return http_cache.conditional_response(cached, http_cache.REVALIDATE_CACHE_CONTROL)
+    generation = catalog_cache.product_generation()
+    
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
@@ -817,7 +951,9 @@ def get_product(product_id):
         # Add formatted data
         product['image_url'] = product['image_url'] or '/static/img/product-placeholder.jpg'
         
-        return jsonify(product)
+        payload = http_cache.json_payload(product)
+        catalog_cache.put_product(cache_key, payload, tables=('products', 'stores', 'store_categories'), generation=generation)
+        return http_cache.conditional_response(payload, http_cache.REVALIDATE_CACHE_CONTROL)
     
     except Exception as e:
         logger.error(f"Error getting product: {str(e)}")
@@ -830,6 +966,18 @@ def get_product(product_id):
 # Add retailer checkout endpoint
 add_retailer_checkout_endpoint(app)
 
+# Request, database and cache metrics for Prometheus on /metrics
+app_metrics.instrument(app)
+
+# Per-request SQL tracing and N+1 detection (SQL_TRACE=on|dev)
+sql_trace.instrument(app)
+
+# Build the contractor match index before the first match request
+contractor_index.warm_up()
+
+# Keep room recommendations current as products change
+recommendations.start_refresher()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 3000))
     debug = os.environ.get('FLASK_ENV') == 'development'
@@ -0,0 +1,51 @@
+"""
+HTTP Conditional Responses
+
+Helpers for serving read-only JSON with strong ETags. A payload is
+serialized once into bytes together with a content hash; the bytes can be
+kept in the catalog cache and served again, or answered with
+304 Not Modified when the client's If-None-Match matches, without
+serializing the data again.
+
+Configuration:
+- HTTP_CACHE_MAX_AGE: seconds browsers may reuse catalog responses without
+  revalidating (default 60)
+"""
+
+import os
+import hashlib
+from collections import namedtuple
+
+from flask import current_app, jsonify, request
+
+JsonPayload = namedtuple('JsonPayload', ['body', 'etag'])
+
+CATALOG_MAX_AGE = int(os.environ.get('HTTP_CACHE_MAX_AGE', 60))
+
+# Catalog data changes rarely, so browsers may reuse it for a short while
+CATALOG_CACHE_CONTROL = f"public, max-age={CATALOG_MAX_AGE}"
+
+# Prices and sale flags must be revalidated on every view
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+def json_payload(data):
+    """Serialize data exactly like jsonify() and hash the resulting bytes"""
+    body = jsonify(data).get_data()
+    return JsonPayload(body, hashlib.sha256(body).hexdigest()[:32])
+
+
+def conditional_response(payload, cache_control=CATALOG_CACHE_CONTROL):
+    """Return the payload, or 304 if the client already has this ETag"""
+    if request.if_none_match.contains(payload.etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(payload.body, mimetype=current_app.json.mimetype)
+    response.set_etag(payload.etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def json_response(data, cache_control=REVALIDATE_CACHE_CONTROL):
+    """Serialize data and answer conditionally in one step"""
+    return conditional_response(json_payload(data), cache_control)
@@ -0,0 +1,227 @@
+"""
+Logging Setup
+
+Configures logging for the web app and the command line scripts so that
+no request thread ever writes to disk itself.
+
+Log calls only put the record on a bounded in-memory queue (QueueHandler).
+A background QueueListener thread formats the records and writes them to a
+size-rotated file and/or stderr. When the queue is full, records are dropped
+and counted rather than blocking the caller.
+
+Only a single process may rotate a log file; several processes renaming
+the same file under each other lose records. The process that called
+configure() rotates its file, and analyzer workers forked from it append
+to the same file through a WatchedFileHandler. Gunicorn workers have no
+such owner, so under gunicorn the app logs to stderr only, where the
+platform (Render) collects it. With LOG_ROTATE=external every process
+appends through a WatchedFileHandler and an external tool (logrotate)
+rotates the file.
+
+Records are written as one JSON object per line. Fields passed with
+``extra=`` are included, and an ``event`` field lets high-volume events be
+sampled: with LOG_SAMPLE_RATES="checkout=0.1", only one in ten INFO records
+logged with ``extra={'event': 'checkout'}`` is kept. Warnings and errors are
+never sampled out.
+
+Configuration:
+- LOG_LEVEL: minimum level (default INFO)
+- LOG_FORMAT: 'json' (default) or 'text'
+- LOG_FILE: overrides the log file name passed to configure()
+- LOG_ROTATE: 'size' (default) or 'external'. Under gunicorn, 'size' means
+  no log file, only stderr
+- LOG_MAX_BYTES / LOG_BACKUP_COUNT: rotation size (default 10 MB) and files kept (default 5)
+- LOG_QUEUE_SIZE: records buffered before new ones are dropped (default 10000)
+- LOG_SAMPLE_RATES: comma separated event=rate pairs (default checkout=0.1)
+"""
+
+import os
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, WatchedFileHandler
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_ROTATE = os.environ.get('LOG_ROTATE', 'size')
+
+# Attributes every LogRecord has; anything else came in through ``extra=``
+logger = logging.getLogger(__name__)
+
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_lock = threading.Lock()
+_stats = {"dropped": 0, "sampled_out": 0}
+_state = {"pid": None, "queue": None, "listener": None, "handlers": None, "owner": None}
+
+
+def parse_sample_rates(value):
+    """Parse "event=rate,event=rate" into a dict of floats"""
+    rates = {}
+    for item in (value or '').split(','):
+        name, _, rate = item.partition('=')
+        if name.strip() and rate.strip():
+            try:
+                rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+            except ValueError:
+                logger.warning(f"Ignoring invalid LOG_SAMPLE_RATES entry: {item.strip()}")
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line JSON objects"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of records tagged with a sampled ``event``"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'event', None))
+        if rate is None or record.levelno >= logging.WARNING or random.random() < rate:
+            return True
+        with _lock:
+            _stats["sampled_out"] += 1
+        return False
+
+
+class _AsyncQueueHandler(QueueHandler):
+    """QueueHandler that never blocks and restarts its listener after a fork"""
+
+    def enqueue(self, record):
+        if _state["pid"] != os.getpid():
+            _start_listener()
+        try:
+            _state["queue"].put_nowait(record)
+        except queue.Full:
+            with _lock:
+                _stats["dropped"] += 1
+
+    def prepare(self, record):
+        # The listener runs in this process, so the record needs no pickling
+        # and keeps its exc_info for the formatter
+        return record
+
+
+def _file_handler(filename):
+    if LOG_ROTATE == 'external':
+        return WatchedFileHandler(filename)
+    # Gunicorn runs several workers on the same file and none of them may
+    # rotate it, so they log to stderr and leave the file alone
+    if 'gunicorn' in sys.modules:
+        return None
+    return RotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+
+
+def _without_rotation(handlers):
+    """Replace rotating handlers inherited through a fork with appending ones"""
+    replaced = []
+    for handler in handlers:
+        if isinstance(handler, RotatingFileHandler):
+            appending = WatchedFileHandler(handler.baseFilename)
+            appending.setFormatter(handler.formatter)
+            appending.setLevel(handler.level)
+            handler = appending
+        replaced.append(handler)
+    return replaced
+
+
+def _start_listener():
+    with _lock:
+        if _state["pid"] == os.getpid():
+            return
+        # Only the process that configured logging rotates its file
+        if _state["owner"] != os.getpid():
+            _state["handlers"] = _without_rotation(_state["handlers"])
+        # Threads do not survive a fork, so each worker starts its own listener
+        _state["queue"] = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        listener = QueueListener(_state["queue"], *_state["handlers"], respect_handler_level=True)
+        listener.start()
+        _state["listener"] = listener
+        _state["pid"] = os.getpid()
+
+
+def _stop_listener():
+    listener = _state["listener"]
+    if listener is not None and _state["pid"] == os.getpid():
+        try:
+            listener.stop()
+        except queue.Full:
+            pass
+
+
+def configure(filename=None, stream=True, level=None, fmt=None):
+    """
+    Route all logging through the background writer.
+
+    ``filename`` is a rotating log file (LOG_FILE overrides it; ignored under
+    gunicorn) and ``stream`` also writes to stderr. Calling configure() again replaces the handlers.
+    """
+    level = level or os.environ.get('LOG_LEVEL', 'INFO').upper()
+    fmt = fmt or os.environ.get('LOG_FORMAT', 'json')
+    filename = os.environ.get('LOG_FILE', filename)
+    formatter = JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT)
+
+    handlers = []
+    file_handler = _file_handler(filename) if filename else None
+    if file_handler is not None:
+        handlers.append(file_handler)
+    if stream or not handlers:
+        handlers.append(logging.StreamHandler(sys.stderr))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    _stop_listener()
+    _state["handlers"] = handlers
+    _state["owner"] = os.getpid()
+    _state["pid"] = None
+    _start_listener()
+
+    queue_handler = _AsyncQueueHandler(None)
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', 'checkout=0.1'))))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    return queue_handler
+
+
+def stats():
+    """Return logging queue counters"""
+    with _lock:
+        snapshot = dict(_stats)
+    log_queue = _state["queue"]
+    snapshot["queue_depth"] = log_queue.qsize() if log_queue is not None else 0
+    return snapshot
+
+
+atexit.register(_stop_listener)
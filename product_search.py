@@ -0,0 +1,176 @@
+"""
+Product Search
+
+Builds the SQL used to search products by name, description and category.
+
+The default backend relies on the maintained ``products.search_vector``
+tsvector column and the pg_trgm index on ``products.name`` created by
+init_product_search() in init_db.py. Every word of the search term is
+matched as a prefix, so partial words typed into the search box still
+match. Misspelled names are caught by trigram similarity. Results are
+ranked by relevance.
+
+For test environments without those extensions, PRODUCT_SEARCH_BACKEND=memory
+switches to an in-process token index that is rebuilt from the products
+table whenever the catalog cache is invalidated.
+"""
+
+import os
+import re
+import time
+import bisect
+import logging
+import threading
+from collections import namedtuple
+
+import catalog_cache
+
+logger = logging.getLogger(__name__)
+
+# Text search configuration used for both the column and the queries
+SEARCH_CONFIG = 'english'
+
+# Words beyond this are ignored so a pasted paragraph cannot build a huge query
+MAX_TERMS = 8
+
+MEMORY_INDEX_TTL = 300
+
+SearchFilter = namedtuple('SearchFilter', ['where_sql', 'where_params', 'rank_sql', 'rank_params'])
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Split text into lowercase search words"""
+    return _WORD_RE.findall((text or '').lower())
+
+
+def prefix_tsquery(term):
+    """Turn free text into a to_tsquery() expression that prefix-matches every word"""
+    words = tokenize(term)[:MAX_TERMS]
+    return ' & '.join(f"{word}:*" for word in words)
+
+
+def build_filter(term, cursor=None, include_category=False):
+    """
+    Return a SearchFilter for the products table aliased as ``p``, or None
+    if the term contains no searchable words.
+
+    ``include_category`` also matches products whose store category name
+    matches the term. The memory backend needs ``cursor`` to (re)build its
+    index.
+    """
+    if not tokenize(term):
+        return None
+    if os.environ.get('PRODUCT_SEARCH_BACKEND', 'postgres') == 'memory':
+        return _memory_filter(term, cursor, include_category)
+    return _postgres_filter(term, include_category)
+
+
+def _postgres_filter(term, include_category):
+    query = prefix_tsquery(term)
+    where_sql = f"(p.search_vector @@ to_tsquery('{SEARCH_CONFIG}', %s) OR p.name %% %s"
+    where_params = [query, term]
+    if include_category:
+        where_sql += f"""
+            OR p.category_id IN (
+                SELECT id FROM store_categories
+                WHERE to_tsvector('{SEARCH_CONFIG}', name) @@ to_tsquery('{SEARCH_CONFIG}', %s)
+            )"""
+        where_params.append(query)
+    where_sql += ")"
+
+    rank_sql = (
+        f"(ts_rank_cd(p.search_vector, to_tsquery('{SEARCH_CONFIG}', %s))"
+        f" + similarity(p.name, %s))"
+    )
+    return SearchFilter(where_sql, where_params, rank_sql, [query, term])
+
+
+class MemorySearchIndex:
+    """Prefix-searchable token index over product names, descriptions and categories"""
+
+    # Score added for each query word found in a field
+    WEIGHTS = {'name': 3, 'description': 1, 'category': 1}
+
+    def __init__(self):
+        self._postings = []     # sorted (token, field, product_id)
+        self._tokens = []       # tokens of _postings, for bisect
+        self.size = 0
+
+    def build(self, rows):
+        """Index rows of (id, name, description, category_name)"""
+        postings = set()
+        for product_id, name, description, category_name in rows:
+            for field, text in (('name', name), ('description', description), ('category', category_name)):
+                for token in tokenize(text):
+                    postings.add((token, field, product_id))
+        self._postings = sorted(postings, key=lambda posting: (posting[0], posting[1], str(posting[2])))
+        self._tokens = [posting[0] for posting in self._postings]
+        self.size = len(rows)
+
+    def search(self, term, include_category=False):
+        """Return product ids matching every word of term, best match first"""
+        scores = None
+        for word in tokenize(term)[:MAX_TERMS]:
+            word_scores = {}
+            start = bisect.bisect_left(self._tokens, word)
+            for token, field, product_id in self._postings[start:]:
+                if not token.startswith(word):
+                    break
+                if field == 'category' and not include_category:
+                    continue
+                word_scores[product_id] = max(word_scores.get(product_id, 0), self.WEIGHTS[field])
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {pid: score + word_scores[pid] for pid, score in scores.items() if pid in word_scores}
+            if not scores:
+                return []
+        ranked = sorted((scores or {}).items(), key=lambda item: (-item[1], str(item[0])))
+        return [product_id for product_id, _ in ranked]
+
+
+_memory_index = MemorySearchIndex()
+_memory_lock = threading.Lock()
+_memory_state = {"generation": None, "built_at": 0.0}
+
+
+def _memory_filter(term, cursor, include_category):
+    index = get_memory_index(cursor)
+    product_ids = index.search(term, include_category=include_category)
+    if not product_ids:
+        return SearchFilter("FALSE", [], "0", [])
+    # Earlier positions in the id list are better matches
+    return SearchFilter(
+        "p.id = ANY(%s)", [product_ids],
+        "(-array_position(%s, p.id))", [product_ids]
+    )
+
+
+def get_memory_index(cursor):
+    """Return the in-process index, rebuilding it if the catalog changed"""
+    generation = catalog_cache.generation()
+    with _memory_lock:
+        fresh = (
+            _memory_state["generation"] == generation
+            and time.monotonic() - _memory_state["built_at"] < MEMORY_INDEX_TTL
+        )
+        if not fresh:
+            if cursor is None:
+                raise ValueError("A cursor is required to build the product search index")
+            cursor.execute("""
+                SELECT p.id, p.name, p.description, sc.name as category_name
+                FROM products p
+                LEFT JOIN store_categories sc ON p.category_id = sc.id
+            """)
+            rows = [
+                (row['id'], row['name'], row['description'], row['category_name'])
+                if isinstance(row, dict) else tuple(row)
+                for row in cursor.fetchall()
+            ]
+            _memory_index.build(rows)
+            _memory_state["generation"] = generation
+            _memory_state["built_at"] = time.monotonic()
+            logger.info(f"Built in-memory product search index for {len(rows)} products")
+        return _memory_index
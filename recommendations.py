@@ -0,0 +1,323 @@
+"""
+Room Product Recommendations
+
+Precomputes a ranked product list for every room type into the
+room_product_recommendations table so that /api/recommended_products is a
+single indexed lookup.
+
+Products whose name or description mentions the room (or whose category
+matches it) rank first, followed by products from the categories mapped to
+the room in room_categories; both groups are ordered by price. A row trigger
+on products records which rooms a product change affects in
+room_recommendation_dirty, and refresh_dirty_rooms() recomputes only those
+rooms. Until init_db.py (or ``python recommendations.py --all``) has filled
+the table, rooms are ranked live from ROOM_CATEGORY_MAP instead.
+
+The API calls start_refresher(), so every worker runs it in the
+background every RECOMMENDATION_REFRESH_INTERVAL seconds; the dirty rows are
+claimed with DELETE ... RETURNING, so concurrent workers never refresh a
+room twice. It can also be run by hand:
+
+    python recommendations.py            # refresh rooms marked dirty
+    python recommendations.py --all      # rebuild every room
+
+Configuration:
+- RECOMMENDATION_REFRESH_INTERVAL: seconds between background refreshes
+  (default 60, 0 disables the background refresh)
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+
+from psycopg2 import errors
+
+import db_pool
+import log_config
+import product_search
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOM = 'default'
+
+# Room types and the store categories that are relevant for them
+ROOM_CATEGORY_MAP = {
+    'living': ['Furniture', 'Lighting', 'Decor', 'Entertainment'],
+    'kitchen': ['Kitchen', 'Appliances', 'Dining'],
+    'bedroom': ['Furniture', 'Bedding', 'Lighting', 'Decor'],
+    'bathroom': ['Bath', 'Fixtures', 'Storage'],
+    'office': ['Office', 'Furniture', 'Electronics'],
+    'outdoor': ['Outdoor', 'Garden', 'Patio'],
+    DEFAULT_ROOM: ['Furniture', 'Lighting', 'Decor'],
+}
+
+# Products stored per room; requests never ask for more than this
+RECOMMENDATION_DEPTH = 100
+
+REFRESH_INTERVAL = float(os.environ.get('RECOMMENDATION_REFRESH_INTERVAL', 60))
+
+_refresher_pid = None
+_refresher_lock = threading.Lock()
+
+# Product columns in the shape the frontend expects, formatted in SQL
+PRODUCT_COLUMNS = """
+    p.id, p.name, p.description, p.price::float8 as price,
+    p.is_on_sale, p.sale_price::float8 as sale_price,
+    COALESCE(p.image_url, '/static/img/product-placeholder.jpg') as image_url,
+    p.product_url, p.external_id,
+    s.id as store_id, s.name as store_name, s.logo_url as store_logo,
+    s.name as store, sc.name as category_name
+"""
+
+
+def room_key(room_type):
+    """Map a free-form room name (e.g. "Living Room") to a precomputed room"""
+    for word in product_search.tokenize(room_type):
+        if word in ROOM_CATEGORY_MAP:
+            return word
+    return DEFAULT_ROOM
+
+
+def get_room_products(cursor, room_type, limit):
+    """Return the precomputed recommendations for a room, or live ones until they exist"""
+    room = room_key(room_type)
+    limit = min(limit, RECOMMENDATION_DEPTH)
+    try:
+        cursor.execute(f"""
+            SELECT {PRODUCT_COLUMNS}
+            FROM room_product_recommendations r
+            JOIN products p ON p.id = r.product_id
+            JOIN stores s ON p.store_id = s.id
+            JOIN store_categories sc ON p.category_id = sc.id
+            WHERE r.room = %s
+            ORDER BY r.rank
+            LIMIT %s
+        """, (room, limit))
+        products = cursor.fetchall()
+    except errors.UndefinedTable:
+        logger.warning("room_product_recommendations does not exist; run init_db.py")
+        products = []
+    return products or get_live_room_products(cursor, room, limit)
+
+
+def get_live_room_products(cursor, room, limit):
+    """Rank a room's products on the fly from ROOM_CATEGORY_MAP"""
+    patterns = [f"%{room}%"] + [f"%{category}%" for category in ROOM_CATEGORY_MAP[room]]
+    cursor.execute(f"""
+        SELECT {PRODUCT_COLUMNS}
+        FROM products p
+        JOIN stores s ON p.store_id = s.id
+        JOIN store_categories sc ON p.category_id = sc.id
+        WHERE sc.name ILIKE ANY(%s)
+        ORDER BY p.price DESC, p.id
+        LIMIT %s
+    """, (patterns, limit))
+    return cursor.fetchall()
+
+
+def ensure_recommendation_tables(dsn=None):
+    """Create the recommendation tables and the product change trigger"""
+    conn = db_pool.get_db_connection(dsn, autocommit=False)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return False
+
+    try:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS room_categories (
+                room TEXT NOT NULL,
+                category_pattern TEXT NOT NULL,
+                PRIMARY KEY (room, category_pattern)
+            )
+        """)
+        for room, categories in ROOM_CATEGORY_MAP.items():
+            for category in categories:
+                cursor.execute("""
+                    INSERT INTO room_categories (room, category_pattern)
+                    VALUES (%s, %s)
+                    ON CONFLICT DO NOTHING
+                """, (room, category))
+
+        # products.id is INTEGER in some deployments and TEXT in others
+        cursor.execute("""
+            SELECT format_type(a.atttypid, a.atttypmod)
+            FROM pg_attribute a
+            WHERE a.attrelid = 'products'::regclass AND a.attname = 'id'
+        """)
+        product_id_type = cursor.fetchone()[0]
+
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS room_product_recommendations (
+                room TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                product_id {product_id_type} NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+                score REAL NOT NULL,
+                PRIMARY KEY (room, rank)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS room_recommendation_dirty (
+                room TEXT PRIMARY KEY,
+                marked_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+
+        cursor.execute("""
+            CREATE OR REPLACE FUNCTION mark_room_recommendations_dirty() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP <> 'DELETE' THEN
+                    INSERT INTO room_recommendation_dirty (room)
+                    SELECT DISTINCT rc.room
+                    FROM room_categories rc
+                    LEFT JOIN store_categories sc ON sc.id = NEW.category_id
+                    WHERE sc.name ILIKE '%' || rc.category_pattern || '%'
+                       OR NEW.name ILIKE '%' || rc.room || '%'
+                       OR NEW.description ILIKE '%' || rc.room || '%'
+                    ON CONFLICT (room) DO NOTHING;
+                END IF;
+                IF TG_OP <> 'INSERT' THEN
+                    INSERT INTO room_recommendation_dirty (room)
+                    SELECT DISTINCT rc.room
+                    FROM room_categories rc
+                    LEFT JOIN store_categories sc ON sc.id = OLD.category_id
+                    WHERE sc.name ILIKE '%' || rc.category_pattern || '%'
+                       OR OLD.name ILIKE '%' || rc.room || '%'
+                       OR OLD.description ILIKE '%' || rc.room || '%'
+                    ON CONFLICT (room) DO NOTHING;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        cursor.execute("DROP TRIGGER IF EXISTS room_recommendations_dirty_trigger ON products")
+        cursor.execute("""
+            CREATE TRIGGER room_recommendations_dirty_trigger
+            AFTER INSERT OR UPDATE OR DELETE ON products
+            FOR EACH ROW EXECUTE PROCEDURE mark_room_recommendations_dirty()
+        """)
+
+        conn.commit()
+        cursor.close()
+        return True
+    except Exception as e:
+        logger.error(f"Error creating recommendation tables: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+
+def refresh_room(cursor, room):
+    """Recompute the ranked product list for one room"""
+    search = product_search.build_filter(room, cursor, include_category=True) if room != DEFAULT_ROOM else None
+    text_sql = search.where_sql if search else "FALSE"
+    text_params = search.where_params if search else []
+
+    cursor.execute("DELETE FROM room_product_recommendations WHERE room = %s", (room,))
+    cursor.execute(f"""
+        INSERT INTO room_product_recommendations (room, rank, product_id, score)
+        SELECT %s,
+               ROW_NUMBER() OVER (ORDER BY candidates.score DESC, candidates.price DESC, candidates.id),
+               candidates.id,
+               candidates.score
+        FROM (
+            SELECT p.id, p.price,
+                   CASE WHEN {text_sql} THEN 2 ELSE 1 END as score
+            FROM products p
+            JOIN store_categories sc ON p.category_id = sc.id
+            WHERE {text_sql}
+               OR sc.name ILIKE ANY(
+                   SELECT '%%' || category_pattern || '%%'
+                   FROM room_categories
+                   WHERE room = %s
+               )
+            ORDER BY score DESC, p.price DESC, p.id
+            LIMIT %s
+        ) candidates
+    """, [room] + text_params + text_params + [room, RECOMMENDATION_DEPTH])
+    return cursor.rowcount
+
+
+def refresh_dirty_rooms(dsn=None):
+    """Recompute the rooms affected by product changes since the last refresh"""
+    conn = db_pool.get_db_connection(dsn, autocommit=False)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return []
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM room_recommendation_dirty RETURNING room")
+        rooms = [row[0] for row in cursor.fetchall()]
+        for room in rooms:
+            count = refresh_room(cursor, room)
+            logger.info(f"Refreshed {count} recommendations for room '{room}'")
+        conn.commit()
+        cursor.close()
+        return rooms
+    except Exception as e:
+        logger.error(f"Error refreshing room recommendations: {str(e)}")
+        conn.rollback()
+        return []
+    finally:
+        conn.close()
+
+
+def refresh_all_rooms(dsn=None):
+    """Recompute every room, e.g. after the initial import"""
+    conn = db_pool.get_db_connection(dsn, autocommit=False)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return []
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT DISTINCT room FROM room_categories ORDER BY room")
+        rooms = [row[0] for row in cursor.fetchall()]
+        for room in rooms:
+            count = refresh_room(cursor, room)
+            logger.info(f"Refreshed {count} recommendations for room '{room}'")
+        cursor.execute("DELETE FROM room_recommendation_dirty")
+        conn.commit()
+        cursor.close()
+        return rooms
+    except Exception as e:
+        logger.error(f"Error refreshing room recommendations: {str(e)}")
+        conn.rollback()
+        return []
+    finally:
+        conn.close()
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        try:
+            refresh_dirty_rooms()
+        except Exception as e:
+            logger.error(f"Room recommendation refresher error: {str(e)}")
+
+
+def start_refresher():
+    """Refresh rooms marked dirty by product changes in a background thread"""
+    global _refresher_pid
+    if REFRESH_INTERVAL <= 0 or not os.environ.get('DATABASE_URL'):
+        return
+    with _refresher_lock:
+        # Threads do not survive a fork, so each worker starts its own
+        if _refresher_pid == os.getpid():
+            return
+        _refresher_pid = os.getpid()
+        threading.Thread(target=_refresh_loop, name='room-recommendations-refresh', daemon=True).start()
+
+
+if __name__ == '__main__':
+    log_config.configure()
+    ensure_recommendation_tables()
+    if '--all' in sys.argv[1:]:
+        refresh_all_rooms()
+    else:
+        refresh_dirty_rooms()
@@ -0,0 +1,376 @@
+"""
+Review Analysis Client
+
+Sends contractor reviews to a language model for sentiment and quality
+keywords, without one slow round trip per contractor.
+
+- Batching: several contractors are packed into one request, up to
+  REVIEW_LLM_TOKEN_BUDGET estimated prompt tokens. A contractor whose
+  reviews alone exceed the budget is sent with as many reviews as fit.
+- Caching: results are keyed by a hash of the backend's identity (name,
+  model and endpoint), the prompt version and the contractor's review
+  texts. They are kept in an in-process LRU and the review_analysis_cache
+  table, so an unchanged review set is never analyzed twice, and answers
+  from the stub or a benchmark server are never served as real ones.
+- Backends: OpenAIBackend talks to the chat completions API, or to any
+  compatible server given in REVIEW_LLM_BASE_URL (e.g. a local stub server
+  in benchmarks). StubBackend answers in-process from review_scoring and is
+  selected with REVIEW_LLM_BACKEND=stub. Without an API key or backend
+  setting the analyzer does not call a model at all (see is_enabled()).
+
+Configuration:
+- REVIEW_LLM_BACKEND: 'openai' or 'stub' (default: openai when OPENAI_API_KEY is set)
+- REVIEW_LLM_MODEL: model name (default gpt-4o-mini)
+- REVIEW_LLM_BASE_URL: alternative OpenAI-compatible endpoint
+- REVIEW_LLM_TOKEN_BUDGET: estimated prompt tokens per request (default 6000)
+- REVIEW_LLM_TIMEOUT: request timeout in seconds (default 60)
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+import db_pool
+import review_scoring
+from catalog_cache import CatalogCache
+
+logger = logging.getLogger(__name__)
+
+MODEL = os.environ.get('REVIEW_LLM_MODEL', 'gpt-4o-mini')
+TOKEN_BUDGET = int(os.environ.get('REVIEW_LLM_TOKEN_BUDGET', 6000))
+TIMEOUT = float(os.environ.get('REVIEW_LLM_TIMEOUT', 60))
+
+# Bump when the prompt changes so cached answers to the old prompt are not reused
+PROMPT_VERSION = 1
+
+# Rough size of the instructions and per-contractor framing, in tokens
+PROMPT_OVERHEAD_TOKENS = 200
+CONTRACTOR_OVERHEAD_TOKENS = 10
+
+SYSTEM_PROMPT = (
+    "You analyze customer reviews of home service contractors. For each "
+    "contractor in the input, rate the overall sentiment of its reviews from "
+    "0 (very negative) to 5 (very positive) and list up to 5 short keywords "
+    "describing the quality of its work. Answer with JSON only: "
+    '{"results": [{"id": "<contractor id>", "sentiment_score": <0-5>, '
+    '"quality_keywords": ["..."]}]}'
+)
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (about four characters per token)"""
+    return len(text) // 4 + 1
+
+
+def review_texts(reviews_data):
+    """All review texts of one contractor, in a stable order"""
+    return sorted(
+        review.get("text") or ""
+        for source_data in reviews_data
+        for review in source_data["reviews"]
+    )
+
+
+def cache_key(texts, backend_id):
+    """Cache key for a contractor's review set as answered by one backend"""
+    digest = hashlib.sha256()
+    digest.update(f"{backend_id}|{PROMPT_VERSION}".encode('utf-8'))
+    for text in texts:
+        digest.update(b"\x00" + text.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def pack_requests(items, token_budget=TOKEN_BUDGET):
+    """
+    Group (id, texts) items into requests within the token budget
+
+    Returns a list of requests, each a list of (id, texts). Items keep their
+    order. Texts of an item too large for an empty request are truncated.
+    """
+    requests = []
+    current = []
+    used = PROMPT_OVERHEAD_TOKENS
+    for item_id, texts in items:
+        cost = CONTRACTOR_OVERHEAD_TOKENS + sum(estimate_tokens(text) for text in texts)
+        if current and used + cost > token_budget:
+            requests.append(current)
+            current = []
+            used = PROMPT_OVERHEAD_TOKENS
+        if used + cost > token_budget:
+            kept = []
+            cost = CONTRACTOR_OVERHEAD_TOKENS
+            for text in texts:
+                if used + cost + estimate_tokens(text) > token_budget:
+                    break
+                kept.append(text)
+                cost += estimate_tokens(text)
+            texts = kept
+        current.append((item_id, texts))
+        used += cost
+    if current:
+        requests.append(current)
+    return requests
+
+
+def build_prompt(request):
+    """User message for one packed request"""
+    return json.dumps({
+        "contractors": [{"id": str(item_id), "reviews": texts} for item_id, texts in request]
+    })
+
+
+def parse_results(content):
+    """Parse a model answer into {id: {"sentiment_score", "quality_keywords"}}"""
+    results = {}
+    for entry in json.loads(content).get("results", []):
+        try:
+            results[str(entry["id"])] = {
+                "sentiment_score": max(0.0, min(5.0, float(entry["sentiment_score"]))),
+                "quality_keywords": [str(k) for k in entry.get("quality_keywords", [])][:5]
+            }
+        except (KeyError, TypeError, ValueError):
+            continue
+    return results
+
+
+class OpenAIBackend:
+    """Analyze reviews with the OpenAI chat completions API"""
+
+    name = 'openai'
+
+    def __init__(self, model=MODEL, base_url=None, api_key=None, timeout=TIMEOUT):
+        from openai import OpenAI
+        self.model = model
+        self.base_url = base_url or os.environ.get('REVIEW_LLM_BASE_URL') or None
+        self.identity = f"{self.name}|{model}|{self.base_url or ''}"
+        self.client = OpenAI(
+            api_key=api_key or os.environ.get('OPENAI_API_KEY') or 'unused',
+            base_url=self.base_url,
+            timeout=timeout,
+        )
+
+    def analyze(self, request):
+        """Send one packed request and return the parsed results"""
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": build_prompt(request)},
+            ],
+            response_format={"type": "json_object"},
+            temperature=0,
+        )
+        return parse_results(response.choices[0].message.content)
+
+
+class StubBackend:
+    """Offline backend answering from the local review scorer"""
+
+    name = 'stub'
+    identity = 'stub'
+
+    def __init__(self):
+        self.requests = 0
+
+    def analyze(self, request):
+        """Score a packed request with review_scoring, in the API's answer format"""
+        self.requests += 1
+        scores = review_scoring.score_reviews({
+            str(item_id): [{"source": "stub", "reviews": [{"rating": 3, "text": text} for text in texts]}]
+            for item_id, texts in request
+        })
+        # The rating is unknown here, so sentiment is the neutral rating moved by the lexicon
+        return parse_results(json.dumps({"results": [
+            {"id": item_id, "sentiment_score": score["sentiment_score"], "quality_keywords": score["quality_keywords"]}
+            for item_id, score in scores.items()
+        ]}))
+
+
+def ensure_review_analysis_cache_table(dsn=None):
+    """Ensure the review_analysis_cache table exists"""
+    conn = db_pool.get_db_connection(dsn)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS review_analysis_cache (
+                review_set_hash TEXT PRIMARY KEY,
+                result JSONB NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        cursor.close()
+        return True
+    except Exception as e:
+        logger.error(f"Error creating review_analysis_cache table: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+
+class ReviewAnalysisClient:
+    """Batched, cached review analysis on top of a backend"""
+
+    def __init__(self, backend, token_budget=TOKEN_BUDGET, memory_entries=4096):
+        self.backend = backend
+        self.token_budget = token_budget
+        self.memory = CatalogCache(max_entries=memory_entries, default_ttl=86400.0)
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0, "contractors_sent": 0, "tokens_estimated": 0,
+            "cache_hits": 0, "cache_misses": 0, "failures": 0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _load_cached(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            result = self.memory.get(key)
+            if result is not None:
+                found[key] = result
+            else:
+                missing.append(key)
+        if not missing:
+            return found
+
+        conn = db_pool.get_db_connection()
+        if not conn:
+            return found
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT review_set_hash, result FROM review_analysis_cache
+                WHERE review_set_hash = ANY(%s)
+            """, (missing,))
+            for key, result in cursor.fetchall():
+                result = result if isinstance(result, dict) else json.loads(result)
+                self.memory.put(key, result)
+                found[key] = result
+            cursor.close()
+        except Exception as e:
+            logger.warning(f"Review analysis cache lookup failed: {str(e)}")
+        finally:
+            conn.close()
+        return found
+
+    def _store_cached(self, results):
+        for key, result in results.items():
+            self.memory.put(key, result)
+        conn = db_pool.get_db_connection()
+        if not conn:
+            return
+        try:
+            cursor = conn.cursor()
+            for key in sorted(results):
+                cursor.execute("""
+                    INSERT INTO review_analysis_cache (review_set_hash, result, created_at)
+                    VALUES (%s, %s, NOW())
+                    ON CONFLICT (review_set_hash) DO NOTHING
+                """, (key, json.dumps(results[key])))
+            cursor.close()
+        except Exception as e:
+            logger.warning(f"Review analysis cache write failed: {str(e)}")
+        finally:
+            conn.close()
+
+    def analyze(self, reviews_by_contractor):
+        """
+        Analyze {contractor_id: [source data, ...]}
+
+        Returns {contractor_id: {"sentiment_score", "quality_keywords"}} for
+        every contractor that has reviews and was answered; contractors in a
+        failed request are left out so the caller can fall back.
+        """
+        keys = {}
+        texts_by_key = {}
+        for contractor_id, reviews_data in reviews_by_contractor.items():
+            texts = review_texts(reviews_data)
+            if texts:
+                key = cache_key(texts, getattr(self.backend, 'identity', type(self.backend).__name__))
+                keys[contractor_id] = key
+                texts_by_key[key] = texts
+
+        cached = self._load_cached(list(texts_by_key))
+        self._count("cache_hits", len(cached))
+        pending = [(key, texts) for key, texts in texts_by_key.items() if key not in cached]
+        self._count("cache_misses", len(pending))
+
+        fresh = {}
+        for request in pack_requests(pending, self.token_budget):
+            # Short positional ids keep the prompt small
+            numbered = [(str(i), texts) for i, (_, texts) in enumerate(request)]
+            self._count("requests")
+            self._count("contractors_sent", len(request))
+            self._count("tokens_estimated", estimate_tokens(build_prompt(numbered)) + PROMPT_OVERHEAD_TOKENS)
+            try:
+                answered = self.backend.analyze(numbered)
+            except Exception as e:
+                self._count("failures")
+                logger.error(f"Review analysis request for {len(request)} contractors failed: {str(e)}")
+                continue
+            for i, (key, _) in enumerate(request):
+                if str(i) in answered:
+                    fresh[key] = answered[str(i)]
+        if fresh:
+            self._store_cached(fresh)
+
+        results = {**cached, **fresh}
+        return {
+            contractor_id: dict(results[key])
+            for contractor_id, key in keys.items()
+            if key in results
+        }
+
+    def stats(self):
+        """Return request and cache counters"""
+        with self._lock:
+            return dict(self._stats)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def is_enabled():
+    """Whether the analyzer should ask a language model (an API key or backend is configured)"""
+    return bool(os.environ.get('REVIEW_LLM_BACKEND') or os.environ.get('OPENAI_API_KEY')) or _client is not None
+
+
+def get_client():
+    """Return the shared client with the configured backend"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            default = 'openai' if os.environ.get('OPENAI_API_KEY') else 'stub'
+            if os.environ.get('REVIEW_LLM_BACKEND', default) == 'openai':
+                backend = OpenAIBackend()
+            else:
+                backend = StubBackend()
+            _client = ReviewAnalysisClient(backend)
+        return _client
+
+
+def set_backend(backend):
+    """Replace the backend (e.g. with a StubBackend in tests)"""
+    global _client
+    with _client_lock:
+        _client = ReviewAnalysisClient(backend)
+
+
+def analyze(reviews_by_contractor):
+    """Analyze reviews with the shared client"""
+    return get_client().analyze(reviews_by_contractor)
+
+
+def stats():
+    """Return review analysis counters"""
+    return get_client().stats()
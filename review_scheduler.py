@@ -0,0 +1,286 @@
+"""
+Review Refresh Scheduler
+
+Lets any number of review analyzer workers, on one machine or many, share
+the refresh work without processing a contractor twice.
+
+A worker claims a batch of stale contractors in one short transaction,
+most urgent first: staleness (days since the last refresh, a year for
+contractors never analyzed) times 1 + their recent traffic from
+contractor_traffic, so the refresh budget goes to the contractors live
+requests actually show. The candidate contractors rows are locked with
+FOR UPDATE SKIP LOCKED, so two workers claiming at the same moment get
+different rows. Each claim is recorded as a lease in review_refresh_leases
+with an expiry time:
+
+- while a batch is being processed, a heartbeat thread extends its leases
+- finished contractors have their lease deleted
+- failed contractors are released with the error and a retry delay that
+  grows with the number of attempts
+- leases of a worker that died simply expire and are claimed again
+
+Configuration:
+- REVIEW_LEASE_SECONDS: lease length before an unrenewed claim expires (default 300)
+- REVIEW_CLAIM_BATCH: contractors claimed at a time (default 50)
+- REVIEW_IDLE_SLEEP: seconds a daemon waits when there is no work (default 60)
+"""
+
+import os
+import uuid
+import signal
+import socket
+import logging
+import threading
+
+import db_pool
+import contractor_traffic
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = int(os.environ.get('REVIEW_LEASE_SECONDS', 300))
+CLAIM_BATCH = int(os.environ.get('REVIEW_CLAIM_BATCH', 50))
+IDLE_SLEEP = float(os.environ.get('REVIEW_IDLE_SLEEP', 60))
+
+# Longest delay before a repeatedly failing contractor is retried
+MAX_RETRY_SECONDS = 3600
+
+# Refresh priority of a contractor row c with metrics m and traffic t:
+# days since the last refresh (365 if never) x (1 + decayed recent hits)
+PRIORITY_SQL = (
+    "EXTRACT(EPOCH FROM NOW() - COALESCE(m.last_updated, NOW() - INTERVAL '365 days')) / 86400.0"
+    f" * (1 + {contractor_traffic.decayed_hits_sql('t')})"
+)
+
+
+def new_worker_id():
+    """Identify a worker by host, process and a random suffix"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def ensure_lease_table(dsn=None):
+    """Ensure the review_refresh_leases table exists"""
+    conn = db_pool.get_db_connection(dsn)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS review_refresh_leases (
+                contractor_id INTEGER PRIMARY KEY,
+                worker_id TEXT,
+                leased_until TIMESTAMP NOT NULL,
+                claimed_at TIMESTAMP,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_review_refresh_leases_worker
+            ON review_refresh_leases (worker_id)
+        """)
+        cursor.close()
+        return True
+    except Exception as e:
+        logger.error(f"Error creating review_refresh_leases table: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+
+def claim(worker_id, limit=CLAIM_BATCH, days_threshold=7, lease_seconds=LEASE_SECONDS):
+    """
+    Lease up to ``limit`` contractors whose metrics are missing or stale
+
+    Returns [{"id", "name", "website"}] for the claimed contractors, highest
+    refresh priority (staleness x traffic) first.
+    """
+    conn = db_pool.get_db_connection(autocommit=False)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            WITH candidates AS (
+                SELECT c.id, c.name, {PRIORITY_SQL} AS priority
+                FROM contractors c
+                LEFT JOIN contractor_metrics m ON c.id = m.contractor_id
+                LEFT JOIN contractor_traffic t ON c.id = t.contractor_id
+                LEFT JOIN review_refresh_leases l ON c.id = l.contractor_id
+                WHERE (m.contractor_id IS NULL
+                       OR m.last_updated < NOW() - make_interval(days => %s))
+                AND (l.contractor_id IS NULL OR l.leased_until < NOW())
+                ORDER BY priority DESC, c.id
+                LIMIT %s
+                FOR UPDATE OF c SKIP LOCKED
+            ), leased AS (
+                INSERT INTO review_refresh_leases (contractor_id, worker_id, leased_until, claimed_at, attempts)
+                SELECT id, %s, NOW() + make_interval(secs => %s), NOW(), 1
+                FROM candidates
+                ON CONFLICT (contractor_id) DO UPDATE
+                SET worker_id = EXCLUDED.worker_id,
+                    leased_until = EXCLUDED.leased_until,
+                    claimed_at = EXCLUDED.claimed_at,
+                    attempts = review_refresh_leases.attempts + 1
+                WHERE review_refresh_leases.leased_until < NOW()
+                RETURNING contractor_id
+            )
+            SELECT candidates.id, candidates.name
+            FROM candidates
+            JOIN leased ON leased.contractor_id = candidates.id
+            ORDER BY candidates.priority DESC, candidates.id
+        """, (days_threshold, limit, worker_id, lease_seconds))
+        contractors = [{"id": row[0], "name": row[1], "website": None} for row in cursor.fetchall()]
+        conn.commit()
+        cursor.close()
+        return contractors
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error claiming contractors for review refresh: {str(e)}")
+        return []
+    finally:
+        conn.close()
+
+
+def heartbeat(worker_id, contractor_ids, lease_seconds=LEASE_SECONDS):
+    """Extend this worker's leases; returns how many are still held"""
+    if not contractor_ids:
+        return 0
+    conn = db_pool.get_db_connection()
+    if not conn:
+        return 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE review_refresh_leases
+            SET leased_until = NOW() + make_interval(secs => %s)
+            WHERE worker_id = %s AND contractor_id = ANY(%s)
+        """, (lease_seconds, worker_id, list(contractor_ids)))
+        held = cursor.rowcount
+        cursor.close()
+        return held
+    except Exception as e:
+        logger.warning(f"Review lease heartbeat failed: {str(e)}")
+        return 0
+    finally:
+        conn.close()
+
+
+def complete(worker_id, contractor_ids):
+    """Drop the leases of contractors this worker refreshed"""
+    if not contractor_ids:
+        return
+    conn = db_pool.get_db_connection()
+    if not conn:
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM review_refresh_leases
+            WHERE worker_id = %s AND contractor_id = ANY(%s)
+        """, (worker_id, list(contractor_ids)))
+        cursor.close()
+    except Exception as e:
+        logger.warning(f"Error completing review leases: {str(e)}")
+    finally:
+        conn.close()
+
+
+def release(worker_id, failures):
+    """
+    Give up leases of contractors that failed, so another worker retries them
+
+    ``failures`` maps contractor id to an error message. The retry waits a
+    minute, doubling with every attempt up to MAX_RETRY_SECONDS.
+    """
+    if not failures:
+        return
+    conn = db_pool.get_db_connection()
+    if not conn:
+        return
+    try:
+        cursor = conn.cursor()
+        for contractor_id in sorted(failures):
+            cursor.execute("""
+                UPDATE review_refresh_leases
+                SET worker_id = NULL,
+                    leased_until = NOW() + make_interval(secs => LEAST(%s, 60 * POWER(2, attempts - 1)::int)),
+                    last_error = %s
+                WHERE worker_id = %s AND contractor_id = %s
+            """, (MAX_RETRY_SECONDS, str(failures[contractor_id])[:1000], worker_id, contractor_id))
+        cursor.close()
+    except Exception as e:
+        logger.warning(f"Error releasing review leases: {str(e)}")
+    finally:
+        conn.close()
+
+
+class Worker:
+    """
+    Claims batches of stale contractors and hands them to ``process``
+
+    ``process(contractors)`` must return one {"id", "success", "errors"}
+    result per contractor, like analyze_contractors_concurrently().
+    """
+
+    def __init__(self, process, worker_id=None, batch_size=CLAIM_BATCH,
+                 lease_seconds=LEASE_SECONDS, days_threshold=7):
+        self.process = process
+        self.worker_id = worker_id or new_worker_id()
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.days_threshold = days_threshold
+        self.stopping = threading.Event()
+
+    def _heartbeat_loop(self, contractor_ids, done):
+        while not done.wait(self.lease_seconds / 3):
+            held = heartbeat(self.worker_id, contractor_ids, self.lease_seconds)
+            if held < len(contractor_ids):
+                logger.warning(f"Worker {self.worker_id} holds {held} of {len(contractor_ids)} leases")
+
+    def run_once(self, limit=None):
+        """Claim and process one batch; returns the per-contractor results"""
+        contractors = claim(self.worker_id, limit or self.batch_size, self.days_threshold, self.lease_seconds)
+        if not contractors:
+            return []
+        contractor_ids = [contractor['id'] for contractor in contractors]
+        logger.info(f"Worker {self.worker_id} claimed {len(contractors)} contractors")
+
+        done = threading.Event()
+        beat = threading.Thread(
+            target=self._heartbeat_loop, args=(contractor_ids, done),
+            name='review-lease-heartbeat', daemon=True
+        )
+        beat.start()
+        try:
+            results = self.process(contractors)
+        except Exception as e:
+            logger.error(f"Worker {self.worker_id} failed on its batch: {str(e)}")
+            results = [{"id": contractor_id, "success": False, "errors": {"worker": str(e)}} for contractor_id in contractor_ids]
+        finally:
+            done.set()
+            beat.join()
+
+        complete(self.worker_id, [result["id"] for result in results if result["success"]])
+        release(self.worker_id, {result["id"]: result["errors"] for result in results if not result["success"]})
+        return results
+
+    def run_forever(self, idle_sleep=IDLE_SLEEP):
+        """Daemon mode: keep claiming batches until stop() or SIGTERM"""
+        logger.info(f"Review worker {self.worker_id} started")
+        while not self.stopping.is_set():
+            results = self.run_once()
+            if not results:
+                self.stopping.wait(idle_sleep)
+        logger.info(f"Review worker {self.worker_id} stopped")
+
+    def stop(self, *_):
+        """Finish the current batch, then stop"""
+        self.stopping.set()
+
+    def install_signal_handlers(self):
+        """Stop cleanly on SIGTERM and SIGINT (main thread only)"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
@@ -0,0 +1,230 @@
+"""
+Review Scoring
+
+Batch scoring engine for contractor reviews. The reviews of any number of
+contractors are laid out as flat columns (owner, rating, age, text) and
+scored together with NumPy:
+
+- review count and average rating per contractor
+- recency-weighted average rating (a review loses half its weight every
+  REVIEW_HALF_LIFE_DAYS days)
+- per-review sentiment: the rating nudged up or down by a local word
+  lexicon, and its per-contractor mean
+- quality keywords: the most frequent QUALITY_KEYWORDS actually present in
+  a contractor's reviews
+
+Scores depend only on the input, so the same reviews always give the same
+result. All texts are tokenized in a single pass; everything else is array
+arithmetic over the whole batch.
+"""
+
+import os
+from datetime import datetime
+from itertools import repeat
+
+import numpy as np
+
+REVIEW_HALF_LIFE_DAYS = float(os.environ.get('REVIEW_HALF_LIFE_DAYS', 180))
+
+# How far (in stars) the lexicon may move a review's sentiment from its rating
+LEXICON_WEIGHT = 0.5
+
+KEYWORDS_PER_CONTRACTOR = 5
+
+# Word polarity in [-1, 1]
+LEXICON = {
+    'great': 1.0, 'excellent': 1.0, 'amazing': 1.0, 'outstanding': 1.0,
+    'recommended': 0.8, 'recommend': 0.8, 'highly': 0.3, 'professional': 0.7,
+    'reliable': 0.7, 'thorough': 0.6, 'friendly': 0.6, 'courteous': 0.6,
+    'punctual': 0.6, 'efficient': 0.6, 'skilled': 0.6, 'knowledgeable': 0.6,
+    'responsive': 0.6, 'quality': 0.4, 'satisfied': 0.6, 'happy': 0.6,
+    'good': 0.5, 'decent': 0.1, 'okay': -0.1, 'acceptable': 0.0,
+    'improve': -0.4, 'better': -0.2, 'slow': -0.6, 'late': -0.7,
+    'rude': -0.9, 'disappointed': -0.9, 'terrible': -1.0, 'poor': -0.8,
+    'overpriced': -0.6, 'unreliable': -0.9, 'never': -0.5, 'mess': -0.7,
+}
+
+QUALITY_KEYWORDS = [
+    'professional', 'reliable', 'thorough', 'detailed', 'punctual', 'efficient',
+    'friendly', 'courteous', 'skilled', 'experienced', 'knowledgeable', 'responsive',
+    'quality', 'satisfied', 'recommend', 'great service', 'decent', 'acceptable',
+    'improvement', 'disappointed', 'late',
+]
+
+# Word forms counted towards a keyword ('great service' is counted on 'great')
+KEYWORD_FORMS = {
+    'recommended': 'recommend', 'recommends': 'recommend',
+    'improve': 'improvement', 'improved': 'improvement',
+    'great': 'great service', 'professionally': 'professional',
+    'responsiveness': 'responsive', 'experience': 'experienced',
+}
+
+_KEYWORD_INDEX = {keyword: i for i, keyword in enumerate(QUALITY_KEYWORDS)}
+_KEYWORD_INDEX.update({form: _KEYWORD_INDEX[keyword] for form, keyword in KEYWORD_FORMS.items()})
+
+# Every word the scorer cares about, with its polarity and keyword (-1 for none)
+_TERMS = sorted((set(LEXICON) | set(_KEYWORD_INDEX)) - {k for k in _KEYWORD_INDEX if ' ' in k})
+_TERM_INDEX = {term.encode('ascii'): i for i, term in enumerate(_TERMS)}
+_TERM_POLARITY = np.array([LEXICON.get(term, 0.0) for term in _TERMS])
+_TERM_KEYWORD = np.array([_KEYWORD_INDEX.get(term, -1) for term in _TERMS], dtype=np.int64)
+
+# Texts are joined with _SEPARATOR and tokenized as ASCII bytes: everything
+# but lowercase letters and the separator becomes whitespace
+_SEPARATOR = b"\x00"
+_SEPARATOR_ID = -2
+_TERM_INDEX[_SEPARATOR] = _SEPARATOR_ID
+_TOKEN_TABLE = bytes(code if ord('a') <= code <= ord('z') or code == 0 else ord(' ') for code in range(256))
+
+
+class ReviewBatch:
+    """Reviews of many contractors as flat columns"""
+
+    def __init__(self, contractor_ids, owners, ratings, ages, texts, sources):
+        self.contractor_ids = contractor_ids   # position -> contractor id
+        self.owners = owners                   # review -> contractor position
+        self.ratings = ratings                 # review -> rating
+        self.ages = ages                       # review -> age in days
+        self.texts = texts                     # review -> text
+        self.sources = sources                 # contractor position -> source names
+
+    def __len__(self):
+        return len(self.ratings)
+
+
+def build_batch(reviews_by_contractor, today=None):
+    """Lay out {contractor_id: [source data, ...]} as a ReviewBatch"""
+    today = np.datetime64((today or datetime.now()).date(), 'D')
+    contractor_ids = list(reviews_by_contractor)
+    owners, ratings, dates, texts, sources = [], [], [], [], []
+
+    for position, contractor_id in enumerate(contractor_ids):
+        names = []
+        for source_data in reviews_by_contractor[contractor_id]:
+            names.append(source_data["source"])
+            for review in source_data["reviews"]:
+                owners.append(position)
+                ratings.append(review["rating"])
+                dates.append(str(review.get("date") or "NaT")[:10])
+                texts.append((review.get("text") or "").replace("\x00", " "))
+        sources.append(names)
+
+    try:
+        days = np.array(dates, dtype='datetime64[D]')
+    except ValueError:
+        days = np.array([_parse_day(value) for value in dates], dtype='datetime64[D]')
+    ages = (today - days).astype(np.float64)
+    # Undated reviews count as new
+    ages[np.isnat(days)] = 0
+
+    return ReviewBatch(
+        contractor_ids,
+        np.array(owners, dtype=np.int64),
+        np.array(ratings, dtype=np.float64),
+        np.maximum(ages, 0),
+        texts,
+        sources,
+    )
+
+
+def _parse_day(value):
+    try:
+        return np.datetime64(value, 'D')
+    except ValueError:
+        return np.datetime64('NaT')
+
+
+def _per_contractor_mean(owners, values, weights, size):
+    totals = np.bincount(owners, weights=values * weights, minlength=size)
+    norms = np.bincount(owners, weights=weights, minlength=size)
+    return np.divide(totals, norms, out=np.zeros(size), where=norms > 0)
+
+
+def score_batch(batch, half_life_days=REVIEW_HALF_LIFE_DAYS, lexicon_weight=LEXICON_WEIGHT):
+    """
+    Score every contractor in a ReviewBatch
+
+    Returns a dict of arrays indexed by contractor position (review_count,
+    average_rating, recency_weighted_rating, sentiment_score,
+    keyword_counts) plus review_sentiment indexed by review.
+    """
+    size = len(batch.contractor_ids)
+    owners, ratings = batch.owners, batch.ratings
+    ones = np.ones(len(batch))
+
+    review_count = np.bincount(owners, minlength=size)
+    average_rating = _per_contractor_mean(owners, ratings, ones, size)
+    recency = np.power(0.5, batch.ages / half_life_days)
+    recency_weighted_rating = _per_contractor_mean(owners, ratings, recency, size)
+
+    # Tokenize all texts in one pass; a separator token marks where each review ends
+    text = "\x00".join(batch.texts).lower().encode('ascii', 'replace')
+    words = text.translate(_TOKEN_TABLE).replace(_SEPARATOR, b" " + _SEPARATOR + b" ").split()
+    ids = np.fromiter(map(_TERM_INDEX.get, words, repeat(-1)), dtype=np.int64, count=len(words))
+    token_review = np.cumsum(ids == _SEPARATOR_ID)
+    relevant = ids >= 0
+    terms = ids[relevant]
+    token_review = token_review[relevant]
+    token_polarity = _TERM_POLARITY[terms]
+    token_keyword = _TERM_KEYWORD[terms]
+
+    polar = token_polarity != 0
+    polarity = _per_contractor_mean(token_review[polar], token_polarity[polar], np.ones(int(polar.sum())), len(batch))
+    review_sentiment = np.clip(ratings + lexicon_weight * polarity, 0, 5)
+    sentiment_score = _per_contractor_mean(owners, review_sentiment, ones, size)
+
+    found = token_keyword >= 0
+    width = len(QUALITY_KEYWORDS)
+    keyword_counts = np.bincount(
+        owners[token_review[found]] * width + token_keyword[found], minlength=size * width
+    ).reshape(size, width)
+
+    return {
+        "review_count": review_count,
+        "average_rating": average_rating,
+        "recency_weighted_rating": recency_weighted_rating,
+        "sentiment_score": sentiment_score,
+        "keyword_counts": keyword_counts,
+        "review_sentiment": review_sentiment,
+    }
+
+
+def top_keywords(keyword_counts, limit=KEYWORDS_PER_CONTRACTOR):
+    """Most frequent keywords per contractor; ties keep QUALITY_KEYWORDS order"""
+    order = np.argsort(-keyword_counts, axis=1, kind='stable')[:, :limit]
+    return [
+        [QUALITY_KEYWORDS[k] for k in row if counts[k] > 0]
+        for row, counts in zip(order, keyword_counts)
+    ]
+
+
+def score_reviews(reviews_by_contractor, annotate=False, today=None, lexicon_weight=LEXICON_WEIGHT):
+    """
+    Score {contractor_id: [source data, ...]} in one batch
+
+    Returns {contractor_id: metrics} in the analyzer's metrics format. With
+    ``annotate`` each review dict also gets its own "sentiment".
+    """
+    batch = build_batch(reviews_by_contractor, today)
+    scores = score_batch(batch, lexicon_weight=lexicon_weight)
+
+    if annotate:
+        review_sentiment = scores["review_sentiment"].tolist()
+        position = 0
+        for contractor_id in batch.contractor_ids:
+            for source_data in reviews_by_contractor[contractor_id]:
+                for review in source_data["reviews"]:
+                    review["sentiment"] = review_sentiment[position]
+                    position += 1
+
+    keywords = top_keywords(scores["keyword_counts"])
+    return {
+        contractor_id: {
+            "sentiment_score": float(scores["sentiment_score"][i]),
+            "average_rating": float(scores["average_rating"][i]),
+            "recency_weighted_rating": float(scores["recency_weighted_rating"][i]),
+            "quality_keywords": keywords[i],
+            "data_sources": batch.sources[i],
+            "review_count": int(scores["review_count"][i])
+        }
+        for i, contractor_id in enumerate(batch.contractor_ids)
+    }
@@ -0,0 +1,241 @@
+"""
+Review Store
+
+Persists raw contractor reviews so the review analyzer only has to fetch
+and process what is new since its last run.
+
+contractor_review_items holds one compact row per review, keyed by source and
+a hash of the review, so a review fetched twice is stored once. It is kept
+apart from contractor_reviews, which /api/contractors counts reviews from.
+review_watermarks holds, per contractor and source, the date of the latest
+review seen (the next fetch starts there) together with running totals of
+the review count, ratings and sentiment. Contractor aggregates are derived
+from those totals, so a run only adds the new reviews instead of
+recomputing every contractor's whole history.
+"""
+
+import hashlib
+import logging
+from datetime import date, datetime
+
+from psycopg2.extras import execute_values
+
+import db_pool
+
+logger = logging.getLogger(__name__)
+
+
+def review_hash(contractor_id, source, review):
+    """Stable identity of a review: the source's review id, or its content"""
+    basis = review.get('id') or f"{review.get('date')}|{review.get('rating')}|{review.get('text')}"
+    return hashlib.sha1(f"{contractor_id}|{source}|{basis}".encode('utf-8')).hexdigest()[:32]
+
+
+def review_date(review):
+    """Parse a review's date (YYYY-MM-DD), or None"""
+    value = review.get('date')
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+
+
+def review_sentiment(review):
+    """Sentiment of one review on the 0-5 scale, defaulting to its rating"""
+    sentiment = review.get('sentiment')
+    return float(sentiment) if sentiment is not None else float(review['rating'])
+
+
+def ensure_review_tables(dsn=None):
+    """Ensure the contractor_review_items and review_watermarks tables exist"""
+    conn = db_pool.get_db_connection(dsn)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS contractor_review_items (
+                source TEXT NOT NULL,
+                review_hash TEXT NOT NULL,
+                contractor_id INTEGER NOT NULL,
+                rating SMALLINT NOT NULL,
+                sentiment REAL NOT NULL,
+                review_date DATE,
+                review_text TEXT,
+                fetched_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (source, review_hash)
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_contractor_review_items_contractor
+            ON contractor_review_items (contractor_id, source, review_date)
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS review_watermarks (
+                contractor_id INTEGER NOT NULL,
+                source TEXT NOT NULL,
+                last_review_date DATE,
+                review_count INTEGER NOT NULL DEFAULT 0,
+                rating_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+                sentiment_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (contractor_id, source)
+            )
+        """)
+        cursor.close()
+        return True
+    except Exception as e:
+        logger.error(f"Error creating review tables: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+
+def load_watermarks(contractor_ids):
+    """Return {(contractor_id, source): last review date} for the given contractors"""
+    if not contractor_ids:
+        return {}
+    conn = db_pool.get_db_connection()
+    if not conn:
+        logger.error("Failed to connect to database")
+        return {}
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT contractor_id, source, last_review_date
+            FROM review_watermarks
+            WHERE contractor_id = ANY(%s)
+        """, (list(contractor_ids),))
+        watermarks = {(row[0], row[1]): row[2] for row in cursor.fetchall()}
+        cursor.close()
+        return watermarks
+    except Exception as e:
+        logger.error(f"Error loading review watermarks: {str(e)}")
+        return {}
+    finally:
+        conn.close()
+
+
+def _aggregate(rows):
+    """Combine per-source watermark totals into per-contractor aggregates"""
+    totals = {}
+    for contractor_id, source, review_count, rating_sum, sentiment_sum in rows:
+        entry = totals.setdefault(contractor_id, {
+            "review_count": 0, "rating_sum": 0.0, "sentiment_sum": 0.0, "data_sources": []
+        })
+        entry["review_count"] += review_count
+        entry["rating_sum"] += rating_sum
+        entry["sentiment_sum"] += sentiment_sum
+        if review_count:
+            entry["data_sources"].append(source)
+
+    aggregates = {}
+    for contractor_id, entry in totals.items():
+        count = entry["review_count"]
+        aggregates[contractor_id] = {
+            "review_count": count,
+            "average_rating": entry["rating_sum"] / count if count else 0,
+            "sentiment_score": entry["sentiment_sum"] / count if count else 0,
+            "data_sources": sorted(entry["data_sources"])
+        }
+    return aggregates
+
+
+def ingest(fetched):
+    """
+    Store newly fetched reviews and advance the watermarks in one transaction
+
+    ``fetched`` maps contractor_id to a list of source results as returned
+    by the analyzer's fetchers. Reviews already stored are skipped. Returns
+    {contractor_id: {"new_reviews", "review_count", "average_rating",
+    "sentiment_score", "data_sources"}} built from the running totals, or
+    None if the transaction failed.
+    """
+    review_rows = []
+    latest = {}
+    for contractor_id, sources in fetched.items():
+        for source_data in sources:
+            source = source_data["source"]
+            latest.setdefault((contractor_id, source), None)
+            for review in source_data["reviews"]:
+                reviewed_on = review_date(review)
+                review_rows.append((
+                    source,
+                    review_hash(contractor_id, source, review),
+                    contractor_id,
+                    int(review['rating']),
+                    review_sentiment(review),
+                    reviewed_on,
+                    review.get('text')
+                ))
+                if reviewed_on and (latest[(contractor_id, source)] is None or reviewed_on > latest[(contractor_id, source)]):
+                    latest[(contractor_id, source)] = reviewed_on
+    if not latest:
+        return {}
+
+    conn = db_pool.get_db_connection(autocommit=False)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return None
+    try:
+        cursor = conn.cursor()
+
+        inserted = []
+        if review_rows:
+            inserted = execute_values(cursor, """
+                INSERT INTO contractor_review_items
+                (source, review_hash, contractor_id, rating, sentiment, review_date, review_text)
+                VALUES %s
+                ON CONFLICT (source, review_hash) DO NOTHING
+                RETURNING contractor_id, source, rating, sentiment
+            """, review_rows, page_size=1000, fetch=True)
+
+        added = {key: [0, 0.0, 0.0] for key in latest}
+        new_reviews = {}
+        for contractor_id, source, rating, sentiment in inserted:
+            totals = added[(contractor_id, source)]
+            totals[0] += 1
+            totals[1] += rating
+            totals[2] += sentiment
+            new_reviews[contractor_id] = new_reviews.get(contractor_id, 0) + 1
+
+        # Rows in key order so concurrent runs cannot deadlock
+        execute_values(cursor, """
+            INSERT INTO review_watermarks AS w
+            (contractor_id, source, last_review_date, review_count, rating_sum, sentiment_sum)
+            VALUES %s
+            ON CONFLICT (contractor_id, source) DO UPDATE
+            SET last_review_date = GREATEST(w.last_review_date, EXCLUDED.last_review_date),
+                review_count = w.review_count + EXCLUDED.review_count,
+                rating_sum = w.rating_sum + EXCLUDED.rating_sum,
+                sentiment_sum = w.sentiment_sum + EXCLUDED.sentiment_sum,
+                updated_at = NOW()
+        """, [
+            (contractor_id, source, latest[(contractor_id, source)], *added[(contractor_id, source)])
+            for contractor_id, source in sorted(latest)
+        ], template="(%s, %s, %s::date, %s, %s, %s)", page_size=1000)
+
+        cursor.execute("""
+            SELECT contractor_id, source, review_count, rating_sum, sentiment_sum
+            FROM review_watermarks
+            WHERE contractor_id = ANY(%s)
+        """, (list(fetched),))
+        aggregates = _aggregate(cursor.fetchall())
+
+        conn.commit()
+        cursor.close()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error storing reviews: {str(e)}")
+        return None
+    finally:
+        conn.close()
+
+    for contractor_id, aggregate in aggregates.items():
+        aggregate["new_reviews"] = new_reviews.get(contractor_id, 0)
+    logger.info(f"Stored {len(inserted)} new reviews for {len(fetched)} contractors")
+    return aggregates
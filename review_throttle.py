@@ -0,0 +1,427 @@
+"""
+Review Source Throttling
+
+Keeps the review analyzer's fetches within each review provider's quota, no
+matter how many fetch threads and analyzer processes are running.
+
+- Rate: every source has a token bucket of REVIEW_RATE_LIMITS requests per
+  second, holding up to REVIEW_RATE_BURST seconds' worth of requests. The
+  bucket is a row in review_rate_buckets. One UPDATE refills it and reserves
+  a token, so threads, processes and machines all draw from the same bucket.
+  An empty bucket gives a negative balance. The caller sleeps until its
+  reserved token is due, so waiting requests need no polling. Without a
+  database connection, each process falls back to a bucket of its own.
+- Concurrency: the number of fetches in flight per source adapts to the
+  provider, additive increase and multiplicative decrease. The limit grows
+  by about one per window of fast, successful fetches. It shrinks when
+  latency exceeds REVIEW_SOURCE_TARGET_LATENCY or the recent error rate is
+  high. It halves when the provider answers with RateLimited. A retry-after
+  from the provider also empties the shared bucket for that long.
+- Counters: for each source, the time spent waiting for a fetch slot and
+  for a token, compared with the time spent fetching (see stats()).
+
+FakeProvider puts a provider's quota, latency and failures around a fetcher.
+With it the limiter can be load tested without calling a real API (see
+``contractor_review_analyzer.py --load-test``).
+
+Configuration:
+- REVIEW_RATE_LIMITS: "source=requests per second,..." (default Google=10,Yelp=5)
+- REVIEW_RATE_BURST: bucket size in seconds of traffic (default 2)
+- REVIEW_SOURCE_MAX_CONCURRENCY: most fetches in flight per source (default 8)
+- REVIEW_SOURCE_TARGET_LATENCY: fetch seconds above which concurrency shrinks (default 2)
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+import db_pool
+
+logger = logging.getLogger(__name__)
+
+RATE_BURST = float(os.environ.get('REVIEW_RATE_BURST', 2))
+MAX_CONCURRENCY = int(os.environ.get('REVIEW_SOURCE_MAX_CONCURRENCY', 8))
+TARGET_LATENCY = float(os.environ.get('REVIEW_SOURCE_TARGET_LATENCY', 2))
+
+# Requests per second for sources missing from REVIEW_RATE_LIMITS
+DEFAULT_RATE = 5.0
+
+# Share of recent fetches that may fail before concurrency is reduced
+ERROR_RATE_LIMIT = 0.2
+
+# Weight of the newest fetch in the latency and error rate averages
+SMOOTHING = 0.2
+
+# Back-off when a provider refuses a request without saying for how long
+DEFAULT_RETRY_AFTER = 1.0
+
+OK, ERROR, THROTTLED = 'ok', 'error', 'throttled'
+
+
+def parse_rates(value):
+    """Parse "source=rate,source=rate" into a dict of requests per second"""
+    rates = {}
+    for item in (value or '').split(','):
+        name, _, rate = item.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = max(0.01, float(rate))
+    return rates
+
+
+RATE_LIMITS = parse_rates(os.environ.get('REVIEW_RATE_LIMITS', 'Google=10,Yelp=5'))
+
+
+class RateLimited(Exception):
+    """Raised by a fetcher when the provider refuses a request for exceeding its quota"""
+
+    def __init__(self, message="Rate limited by provider", retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ThrottleTimeout(Exception):
+    """Raised when no fetch slot or token for a source becomes available in time"""
+
+
+def ensure_rate_limit_table(dsn=None):
+    """Ensure the review_rate_buckets table exists"""
+    conn = db_pool.get_db_connection(dsn)
+    if not conn:
+        logger.error("Failed to connect to database")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS review_rate_buckets (
+                source TEXT PRIMARY KEY,
+                tokens DOUBLE PRECISION NOT NULL,
+                updated_at TIMESTAMP NOT NULL
+            )
+        """)
+        cursor.close()
+        return True
+    except Exception as e:
+        logger.error(f"Error creating review_rate_buckets table: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+
+class LocalBucket:
+    """Token bucket shared by the threads of one process"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Reserve one token; returns the seconds until it may be used"""
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def try_take(self):
+        """Take one token if one is available now"""
+        with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def refund(self):
+        """Return a reserved token that was not used"""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def penalize(self, seconds):
+        """Hold back every request for ``seconds``"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class DatabaseBucket:
+    """Token bucket in review_rate_buckets, shared by every analyzer process"""
+
+    def __init__(self, source, rate, capacity):
+        self.source = source
+        self.rate = rate
+        self.capacity = capacity
+        self.fallback = LocalBucket(rate, capacity)
+        self._warned = False
+
+    def _execute(self, statement, params):
+        conn = db_pool.get_db_connection()
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor()
+            cursor.execute(statement, params)
+            row = cursor.fetchone() if cursor.description else None
+            cursor.close()
+            return row if row is not None else ()
+        except Exception as e:
+            if not self._warned:
+                self._warned = True
+                logger.warning(f"Shared {self.source} rate limit unavailable, limiting per process: {str(e)}")
+            return None
+        finally:
+            conn.close()
+
+    def reserve(self):
+        """Reserve one token; returns the seconds until it may be used"""
+        row = self._execute("""
+            INSERT INTO review_rate_buckets AS b (source, tokens, updated_at)
+            VALUES (%(source)s, %(capacity)s - 1, statement_timestamp())
+            ON CONFLICT (source) DO UPDATE
+            SET tokens = LEAST(%(capacity)s, b.tokens + %(rate)s * EXTRACT(EPOCH FROM statement_timestamp() - b.updated_at)) - 1,
+                updated_at = statement_timestamp()
+            RETURNING tokens
+        """, {"source": self.source, "rate": self.rate, "capacity": self.capacity})
+        if not row:
+            return self.fallback.reserve()
+        return max(0.0, -row[0] / self.rate)
+
+    def refund(self):
+        """Return a reserved token that was not used"""
+        if self._execute("""
+            UPDATE review_rate_buckets
+            SET tokens = LEAST(%s, tokens + 1)
+            WHERE source = %s
+        """, (self.capacity, self.source)) is None:
+            self.fallback.refund()
+
+    def penalize(self, seconds):
+        """Hold back every process's requests for ``seconds``"""
+        if self._execute("""
+            UPDATE review_rate_buckets
+            SET tokens = LEAST(%(capacity)s, tokens + %(rate)s * EXTRACT(EPOCH FROM statement_timestamp() - updated_at),
+                               -%(seconds)s * %(rate)s),
+                updated_at = statement_timestamp()
+            WHERE source = %(source)s
+        """, {"source": self.source, "rate": self.rate, "capacity": self.capacity, "seconds": seconds}) is None:
+            self.fallback.penalize(seconds)
+
+
+class AdaptiveLimit:
+    """Fetches allowed in flight for one source, adjusted to its latency and errors"""
+
+    def __init__(self, maximum=MAX_CONCURRENCY, target_latency=TARGET_LATENCY, minimum=1):
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        self.target_latency = target_latency
+        self.limit = float(max(minimum, self.maximum // 2))
+        self.in_flight = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout):
+        """Wait for a free slot; returns False if none frees up within ``timeout``"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def cancel(self):
+        """Give back a slot that was never used for a fetch"""
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def release(self, latency, outcome):
+        """Give back a slot and adjust the limit to how the fetch went"""
+        with self._cond:
+            self.in_flight -= 1
+            self.latency += SMOOTHING * (latency - self.latency)
+            self.error_rate += SMOOTHING * ((outcome != OK) - self.error_rate)
+            if outcome == THROTTLED:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif self.error_rate > ERROR_RATE_LIMIT or latency > self.target_latency:
+                self.limit = max(self.minimum, self.limit * 0.9)
+            elif outcome == OK:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class SourceThrottle:
+    """Rate and concurrency limit for one review source"""
+
+    def __init__(self, source, rate, burst=RATE_BURST, shared=True,
+                 max_concurrency=MAX_CONCURRENCY, target_latency=TARGET_LATENCY):
+        self.source = source
+        capacity = max(1.0, rate * burst)
+        self.bucket = DatabaseBucket(source, rate, capacity) if shared else LocalBucket(rate, capacity)
+        self.concurrency = AdaptiveLimit(max_concurrency, target_latency)
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0, "errors": 0, "throttled": 0, "timeouts": 0,
+            "slot_wait_seconds": 0.0, "rate_wait_seconds": 0.0, "fetch_seconds": 0.0,
+        }
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self._stats[name] += amount
+
+    def _acquire(self, timeout):
+        started = time.monotonic()
+        if not self.concurrency.acquire(timeout):
+            self._count(timeouts=1, slot_wait_seconds=time.monotonic() - started)
+            raise ThrottleTimeout(f"No {self.source} fetch slot within {timeout:g}s")
+        slot_wait = time.monotonic() - started
+
+        delay = self.bucket.reserve()
+        if slot_wait + delay > timeout:
+            self.bucket.refund()
+            self.concurrency.cancel()
+            self._count(timeouts=1, slot_wait_seconds=slot_wait)
+            raise ThrottleTimeout(f"{self.source} rate limit allows no fetch within {timeout:g}s")
+        if delay:
+            time.sleep(delay)
+        self._count(slot_wait_seconds=slot_wait, rate_wait_seconds=delay)
+
+    @contextmanager
+    def permit(self, timeout):
+        """Hold a fetch slot and a token for the body of the with block"""
+        self._acquire(timeout)
+        started = time.monotonic()
+        outcome = OK
+        try:
+            yield
+        except RateLimited as e:
+            outcome = THROTTLED
+            self.bucket.penalize(e.retry_after or DEFAULT_RETRY_AFTER)
+            raise
+        except Exception:
+            outcome = ERROR
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self.concurrency.release(elapsed, outcome)
+            self._count(
+                requests=1, fetch_seconds=elapsed,
+                errors=int(outcome == ERROR), throttled=int(outcome == THROTTLED)
+            )
+
+    def stats(self):
+        """Return wait and fetch counters and the current concurrency limit"""
+        with self._lock:
+            snapshot = dict(self._stats)
+        limit = self.concurrency
+        snapshot.update({
+            "concurrency_limit": int(limit.limit),
+            "in_flight": limit.in_flight,
+            "latency_avg": round(limit.latency, 3),
+            "error_rate": round(limit.error_rate, 3),
+        })
+        return snapshot
+
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+_shared = True
+
+
+def configure(rates=None, shared=True):
+    """Replace the source rates and choose shared (database) or per-process buckets"""
+    global _shared
+    with _throttles_lock:
+        if rates is not None:
+            RATE_LIMITS.clear()
+            RATE_LIMITS.update(rates)
+        _shared = shared
+        _throttles.clear()
+
+
+def settings():
+    """Return the current (rates, shared), to restore later with configure()"""
+    with _throttles_lock:
+        return dict(RATE_LIMITS), _shared
+
+
+def get_throttle(source):
+    """Return the throttle of a source, creating it on first use"""
+    with _throttles_lock:
+        throttle = _throttles.get(source)
+        if throttle is None:
+            throttle = SourceThrottle(source, RATE_LIMITS.get(source, DEFAULT_RATE), shared=_shared)
+            _throttles[source] = throttle
+        return throttle
+
+
+def permit(source, timeout):
+    """Hold a fetch slot and a token of ``source`` for the body of the with block"""
+    return get_throttle(source).permit(timeout)
+
+
+def stats():
+    """Return per-source throttle counters"""
+    with _throttles_lock:
+        throttles = dict(_throttles)
+    return {source: throttle.stats() for source, throttle in throttles.items()}
+
+
+class FakeProvider:
+    """
+    Stand-in for a review provider API, for load tests
+
+    Wraps ``fetch`` (e.g. fetch_google_reviews) with the provider's own
+    quota of ``rate`` requests per second, and raises RateLimited above it.
+    Latency grows once more than ``capacity`` requests are in flight. A
+    share ``error_rate`` of requests fail.
+    """
+
+    def __init__(self, fetch, rate=10.0, latency=0.05, capacity=4, error_rate=0.0, seed=0):
+        self.fetch = fetch
+        self.rate = rate
+        self.quota = LocalBucket(rate, max(1.0, rate * RATE_BURST))
+        self.latency = latency
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.calls = {"ok": 0, "throttled": 0, "errors": 0, "peak_in_flight": 0}
+
+    def __call__(self, contractor, since=None):
+        with self._lock:
+            self.in_flight += 1
+            self.calls["peak_in_flight"] = max(self.calls["peak_in_flight"], self.in_flight)
+            load = self.in_flight / self.capacity
+            failed = self.random.random() < self.error_rate
+        outcome = "errors"
+        try:
+            if not self.quota.try_take():
+                outcome = "throttled"
+                raise RateLimited(retry_after=1 / self.rate)
+            # An overloaded provider answers more slowly
+            time.sleep(self.latency * max(1.0, load))
+            if failed:
+                raise RuntimeError("Fake provider error")
+            result = self.fetch(contractor, since=since)
+            outcome = "ok"
+            return result
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.calls[outcome] += 1
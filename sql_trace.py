@@ -0,0 +1,286 @@
+"""
+SQL Tracing
+
+Records every statement a request runs on a pooled cursor, with its
+duration and the line of application code that ran it. Traces are taken
+from db_pool's query observers.
+
+At the end of a traced request:
+- statements are grouped by shape (the SQL with literals and value lists
+  replaced by placeholders), and a shape run SQL_TRACE_N_PLUS_ONE times or
+  more is flagged as an N+1 pattern, with the call sites that ran it
+- with SQL_TRACE_SERVER_TIMING, a Server-Timing header reports the
+  database time and statement count, so browser dev tools show them
+- in dev mode the slowest statements and every N+1 pattern are logged
+
+Tests can hold an endpoint to a query budget with assert_max_queries() or
+assert_query_budgets().
+
+Configuration:
+- SQL_TRACE: 'off', 'on' (trace and warn about N+1 patterns) or 'dev'
+  (also log the worst statements of each request). Default: 'dev' when
+  FLASK_ENV is development, otherwise 'off'
+- SQL_TRACE_N_PLUS_ONE: runs of one shape in a request that count as N+1 (default 5)
+- SQL_TRACE_SERVER_TIMING: add a Server-Timing header (default off)
+- SQL_TRACE_LOG_WORST: statements logged per request in dev mode (default 3)
+"""
+
+import os
+import re
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from flask import request
+
+import db_pool
+
+logger = logging.getLogger(__name__)
+
+MODE = os.environ.get('SQL_TRACE') or ('dev' if os.environ.get('FLASK_ENV') == 'development' else 'off')
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('SQL_TRACE_N_PLUS_ONE', 5))
+SERVER_TIMING = os.environ.get('SQL_TRACE_SERVER_TIMING', '').lower() in ('1', 'true', 'yes', 'on')
+LOG_WORST = int(os.environ.get('SQL_TRACE_LOG_WORST', 3))
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_VALUE_LIST = re.compile(r"\(\s*(?:\?\s*,\s*)*\?\s*\)(?:\s*,\s*\(\s*(?:\?\s*,\s*)*\?\s*\))*")
+_ARRAY = re.compile(r"ARRAY\[[^\]]*\]")
+_SPACE = re.compile(r"\s+")
+
+# Frames in these files are plumbing, not the code that ran the statement
+_PLUMBING_FILES = ('db_pool.py', 'sql_trace.py', 'contextlib.py')
+_PLUMBING_PACKAGE = f"{os.sep}psycopg2{os.sep}"
+
+
+def statement_shape(statement):
+    """The statement with literals, parameters and VALUES lists replaced by '?'"""
+    if isinstance(statement, bytes):
+        statement = statement.decode('utf-8', 'replace')
+    shape = str(statement).replace('%s', '?')
+    shape = _STRING.sub('?', shape)
+    shape = _NUMBER.sub('?', shape)
+    shape = _ARRAY.sub('ARRAY[...]', shape)
+    shape = _VALUE_LIST.sub('(...)', shape)
+    return _SPACE.sub(' ', shape).strip()
+
+
+def call_site():
+    """'file:line function' of the innermost application frame"""
+    frame = sys._getframe(1)
+    while frame is not None and (
+        frame.f_code.co_filename.endswith(_PLUMBING_FILES) or _PLUMBING_PACKAGE in frame.f_code.co_filename
+    ):
+        frame = frame.f_back
+    if frame is None:
+        return 'unknown'
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+class Trace:
+    """Statements run while a trace is active, in order"""
+
+    def __init__(self, label=None):
+        self.label = label
+        self.statements = []    # (shape, seconds, call site)
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    def add(self, statement, seconds, site):
+        self.statements.append((statement_shape(statement), seconds, site))
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def db_seconds(self):
+        return sum(seconds for _, seconds, _ in self.statements)
+
+    def by_shape(self):
+        """{shape: {"count", "seconds", "sites"}}, most frequent first"""
+        shapes = {}
+        for shape, seconds, site in self.statements:
+            entry = shapes.setdefault(shape, {"count": 0, "seconds": 0.0, "sites": {}})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["sites"][site] = entry["sites"].get(site, 0) + 1
+        return dict(sorted(shapes.items(), key=lambda item: (-item[1]["count"], -item[1]["seconds"])))
+
+    def n_plus_one(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """Shapes run at least ``threshold`` times"""
+        return {shape: entry for shape, entry in self.by_shape().items() if entry["count"] >= threshold}
+
+    def worst(self, limit=LOG_WORST):
+        """The slowest statements"""
+        return sorted(self.statements, key=lambda statement: -statement[1])[:limit]
+
+    def summary(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """Readable report of the trace, for logs and failed assertions"""
+        lines = [f"{self.label or 'trace'}: {self.count} statements, {self.db_seconds * 1000:.1f} ms in the database"]
+        for shape, entry in self.by_shape().items():
+            flag = " [N+1]" if entry["count"] >= threshold else ""
+            sites = ", ".join(f"{site} x{count}" for site, count in entry["sites"].items())
+            lines.append(f"  {entry['count']}x {entry['seconds'] * 1000:.1f} ms{flag} {shape[:200]} ({sites})")
+        return "\n".join(lines)
+
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {"requests_traced": 0, "statements": 0, "n_plus_one_requests": 0}
+_n_plus_one_routes = {}
+
+
+def _active():
+    traces = getattr(_local, 'traces', None)
+    if traces is None:
+        traces = _local.traces = []
+    return traces
+
+
+def _observe_query(statement, seconds):
+    traces = getattr(_local, 'traces', None)
+    if not traces:
+        return
+    site = call_site()
+    for trace in traces:
+        trace.add(statement, seconds, site)
+
+
+@contextmanager
+def capture(label=None):
+    """Trace the statements run by this thread inside the with block"""
+    db_pool.add_query_observer(_observe_query)
+    trace = Trace(label)
+    _active().append(trace)
+    try:
+        yield trace
+    finally:
+        trace.finish()
+        _active().remove(trace)
+
+
+@contextmanager
+def assert_max_queries(limit, allow_n_plus_one=False, threshold=N_PLUS_ONE_THRESHOLD, label=None):
+    """
+    Fail if the with block runs more than ``limit`` statements
+
+    Unless ``allow_n_plus_one`` is set, it also fails on any statement shape
+    run ``threshold`` times or more. For example, in a test:
+
+        with sql_trace.assert_max_queries(2):
+            client.get('/api/services')
+    """
+    with capture(label) as trace:
+        yield trace
+    if trace.count > limit:
+        raise AssertionError(f"Query budget of {limit} exceeded\n{trace.summary(threshold)}")
+    if not allow_n_plus_one and trace.n_plus_one(threshold):
+        raise AssertionError(f"N+1 query pattern\n{trace.summary(threshold)}")
+
+
+def assert_query_budgets(client, budgets, bodies=None, threshold=N_PLUS_ONE_THRESHOLD):
+    """
+    Request each endpoint with a Flask test client and check its query budget
+
+    ``budgets`` maps "path" (a GET) or "METHOD path" to the most statements
+    the request may run; ``bodies`` optionally maps the same keys to a JSON
+    body. Every endpoint is checked before the failures are raised together:
+
+        sql_trace.assert_query_budgets(app.test_client(), {
+            "/api/services": 2,
+            "POST /api/match-contractor": 0,
+        }, bodies={"POST /api/match-contractor": {"service_id": 1, "zipcode": "94103"}})
+    """
+    bodies = bodies or {}
+    failures = []
+    for target, limit in budgets.items():
+        method, _, path = target.rpartition(' ')
+        method = method or 'GET'
+        try:
+            with assert_max_queries(limit, threshold=threshold, label=f"{method} {path}"):
+                client.open(path, method=method, json=bodies.get(target))
+        except AssertionError as e:
+            failures.append(str(e))
+    if failures:
+        raise AssertionError("\n\n".join(failures))
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _discard_request_trace():
+    trace = getattr(_local, 'request_trace', None)
+    _local.request_trace = None
+    if trace is not None and trace in _active():
+        _active().remove(trace)
+    return trace
+
+
+def _before_request():
+    # A request whose teardown never ran must not keep recording this thread
+    _discard_request_trace()
+    _local.request_trace = Trace()
+    _active().append(_local.request_trace)
+
+
+def _teardown_request(error=None):
+    # after_request is skipped when an exception propagates (debug, testing)
+    _discard_request_trace()
+
+
+def _after_request(response):
+    trace = _discard_request_trace()
+    if trace is None:
+        return response
+    trace.finish()
+    trace.label = f"{request.method} {_route()}"
+
+    patterns = trace.n_plus_one()
+    with _stats_lock:
+        _stats["requests_traced"] += 1
+        _stats["statements"] += trace.count
+        if patterns:
+            _stats["n_plus_one_requests"] += 1
+            _n_plus_one_routes[trace.label] = _n_plus_one_routes.get(trace.label, 0) + 1
+
+    if patterns:
+        logger.warning(f"N+1 query pattern in {trace.label}: " + "; ".join(
+            f"{entry['count']}x {shape[:120]} at {', '.join(entry['sites'])}" for shape, entry in patterns.items()
+        ))
+    if MODE == 'dev' and trace.statements:
+        logger.info(f"{trace.label}: {trace.count} statements, {trace.db_seconds * 1000:.1f} ms in the database; slowest: " + "; ".join(
+            f"{seconds * 1000:.1f} ms {shape[:120]} at {site}" for shape, seconds, site in trace.worst()
+        ))
+    if SERVER_TIMING:
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={trace.db_seconds * 1000:.1f};desc="{trace.count} queries", app;dur={trace.elapsed * 1000:.1f}'
+        )
+    return response
+
+
+def instrument(app):
+    """Trace the statements of every request to ``app`` unless SQL_TRACE is off"""
+    if MODE not in ('on', 'dev'):
+        return False
+    db_pool.add_query_observer(_observe_query)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    return True
+
+
+def stats():
+    """Return tracing counters and the routes where N+1 patterns were seen"""
+    with _stats_lock:
+        snapshot = dict(_stats)
+        snapshot["n_plus_one_routes"] = dict(_n_plus_one_routes)
+    snapshot["mode"] = MODE
+    return snapshot
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Keep the app from listening for notifications or writing log files while imported
+os.environ.setdefault('CATALOG_CACHE_LISTEN', '0')
+os.environ.setdefault('LOG_FILE', '')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
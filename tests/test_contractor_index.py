@@ -0,0 +1,80 @@
+"""Contractor match index, loaded and refreshed from an in-memory fake of its tables"""
+
+import time
+
+import contractor_index
+
+CONTRACTORS = {
+    1: {"id": 1, "name": "Alpha", "rating": 4.0, "tier_level": "Gold"},
+    2: {"id": 2, "name": "Beta", "rating": 4.8, "tier_level": "Standard"},
+    3: {"id": 3, "name": "Gamma", "rating": 3.0, "tier_level": "Diamond"},
+}
+SERVICES_OF = [(1, 10), (2, 10), (3, 10), (3, 20)]
+AREAS = [(1, "94103"), (2, "94103"), (3, "10001")]
+
+
+class FakeCursor:
+    """Answers the index's queries from the tables above"""
+
+    def __init__(self):
+        self.rows = []
+        self.statements = []
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+        keys = set(params[0]) if params and "ANY" in query else None
+
+        def wanted(contractor_id):
+            return keys is None or str(contractor_id) in keys
+
+        if "FROM contractors" in query:
+            self.rows = [dict(row) for cid, row in CONTRACTORS.items() if wanted(cid)]
+        elif "FROM contractor_services" in query:
+            self.rows = [{"contractor_id": c, "service_id": s} for c, s in SERVICES_OF if wanted(c)]
+        elif "FROM contractor_service_areas" in query:
+            self.rows = [{"contractor_id": c, "zipcode": z} for c, z in AREAS if wanted(c)]
+        elif "FROM services" in query:
+            self.rows = [{"id": 10, "name": "Painting"}, {"id": 20, "name": "Roofing"}]
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_ranked_by_tier_then_rating_per_service_area():
+    index = contractor_index.ContractorIndex()
+    index.load(FakeCursor())
+
+    assert [c["name"] for c in index.ranked(10, "94103")] == ["Alpha", "Beta"]
+    assert index.best_match("20", "10001")["name"] == "Gamma"
+    assert index.ranked(20, "94103") == []
+
+
+def test_batch_refresh_reloads_changed_contractors_in_three_queries(monkeypatch):
+    index = contractor_index.ContractorIndex()
+    index.load(FakeCursor())
+
+    monkeypatch.setitem(CONTRACTORS, 2, {"id": 2, "name": "Beta", "rating": 4.9, "tier_level": "Diamond"})
+    monkeypatch.delitem(CONTRACTORS, 1)
+    cursor = FakeCursor()
+    index.refresh_contractors(cursor, ["1", "2"])
+
+    assert len(cursor.statements) == 3
+    assert [c["name"] for c in index.ranked(10, "94103")] == ["Beta"]
+    assert index.stats()["contractors"] == 2
+
+
+def test_notifications_are_refreshed_in_one_batch(monkeypatch):
+    index = contractor_index.ContractorIndex()
+    index.load(FakeCursor())
+    batches = []
+    monkeypatch.setattr(contractor_index, "_index", index)
+    monkeypatch.setattr(index, "refresh_contractors", lambda cursor, keys: batches.append(set(keys)))
+    monkeypatch.setattr(contractor_index, "_with_cursor", lambda action: action(FakeCursor()))
+
+    for contractor_id in range(1, 501):
+        contractor_index._on_contractor_change(str(contractor_id))
+    deadline = time.monotonic() + 5
+    while not batches and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert batches == [{str(contractor_id) for contractor_id in range(1, 501)}]
@@ -0,0 +1,31 @@
+"""Keyset pagination cursors of /api/contractors"""
+
+from decimal import Decimal
+
+import pytest
+
+import glassrain_unified
+
+
+def test_cursor_round_trips():
+    cursor = glassrain_unified.encode_page_cursor(["Gold", Decimal("4.5"), 7])
+    assert glassrain_unified.decode_page_cursor(cursor) == ("Gold", Decimal("4.5"), 7)
+
+
+@pytest.mark.parametrize("values", [
+    ["Gold", 4.5],
+    ["Gold", {"rating": 4.5}, 7],
+    ["Gold", 4.5, [7]],
+    [["Gold"], 4.5, 7],
+    ["Gold", "4.5", 7],
+    ["Gold", True, 7],
+    ["Gold", 4.5, 7.5],
+    ["Gold", 4.5, 2**70],
+])
+def test_malformed_cursor_is_rejected(values):
+    assert glassrain_unified.decode_page_cursor(glassrain_unified.encode_page_cursor(values)) is None
+
+
+def test_invalid_cursor_is_a_bad_request():
+    response = glassrain_unified.app.test_client().get('/api/contractors?after=not-a-cursor')
+    assert response.status_code == 400
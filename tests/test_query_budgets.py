@@ -0,0 +1,104 @@
+"""Query budgets for catalog endpoints, run against a fake database connection"""
+
+import re
+
+import pytest
+
+import db_pool
+import catalog_cache
+import sql_trace
+import glassrain_unified
+
+CATEGORIES = [
+    {"id": 1, "name": "Cleaning", "description": "", "icon_url": None},
+    {"id": 2, "name": "Roofing", "description": "", "icon_url": None},
+]
+SERVICES = [
+    {"id": 10, "category_id": 1, "name": "Deep clean", "description": "", "base_price": 100,
+     "base_price_per_sqft": 0, "min_price": 0, "unit": ""},
+    {"id": 11, "category_id": 1, "name": "Window clean", "description": "", "base_price": 50,
+     "base_price_per_sqft": 0, "min_price": 0, "unit": ""},
+    {"id": 20, "category_id": 2, "name": "Roof repair", "description": "", "base_price": 900,
+     "base_price_per_sqft": 0, "min_price": 0, "unit": ""},
+]
+OPTIONS = [
+    {"id": 100, "service_id": 10, "name": "Eco products", "description": "", "price_adjustment": 10, "is_default": False},
+]
+
+# Answers by the table a statement reads from; anything else returns no rows
+TABLES = [
+    (re.compile(r"FROM\s+service_categories", re.I), CATEGORIES),
+    (re.compile(r"FROM\s+services\b", re.I), SERVICES),
+    (re.compile(r"FROM\s+service_options", re.I), OPTIONS),
+]
+
+
+class FakeCursor:
+    def __init__(self):
+        self.rows = []
+
+    def execute(self, query, vars=None):
+        self.rows = []
+        for pattern, rows in TABLES:
+            if pattern.search(query):
+                self.rows = [dict(row) for row in rows]
+                break
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class FakeRawConnection:
+    autocommit = True
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor()
+
+
+class FakePool:
+    def putconn(self, raw):
+        pass
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(
+        db_pool, 'get_db_connection',
+        lambda dsn=None, autocommit=True: db_pool.PooledConnection(FakePool(), FakeRawConnection())
+    )
+    catalog_cache.clear()
+    yield glassrain_unified.app.test_client()
+    catalog_cache.clear()
+
+
+def test_services_query_count_does_not_grow_with_catalog(client):
+    with sql_trace.assert_max_queries(3) as trace:
+        response = client.get('/api/services')
+
+    assert response.status_code == 200
+    assert trace.count == 3
+    categories = response.get_json()
+    assert [len(category["services"]) for category in categories] == [2, 1]
+    assert categories[0]["services"][0]["options"][0]["name"] == "Eco products"
+
+
+def test_cached_services_run_no_queries(client):
+    client.get('/api/services')
+    sql_trace.assert_query_budgets(client, {"/api/services": 0, "/api/service-categories": 1})
+
+
+def test_product_listings_share_a_bounded_cache(client):
+    client.get('/api/products?limit=5000')
+    sql_trace.assert_query_budgets(client, {
+        "/api/products?limit=100&utm_source=mail": 0,
+        "/api/products?search=drill": 2,
+    })
+    products = catalog_cache.stats()["products"]
+    assert products["size"] == 1
+    assert products["size"] <= products["max_entries"]
@@ -0,0 +1,79 @@
+"""Request tracing and the query budget helpers"""
+
+import pytest
+from flask import Flask
+
+import db_pool
+import sql_trace
+
+
+class FakeCursor:
+    def execute(self, query, vars=None):
+        pass
+
+
+class FakeRawConnection:
+    def cursor(self, *args, **kwargs):
+        return FakeCursor()
+
+
+class FakePool:
+    def putconn(self, raw):
+        pass
+
+
+def run(statement, times=1):
+    cursor = db_pool.PooledConnection(FakePool(), FakeRawConnection()).cursor()
+    for i in range(times):
+        cursor.execute(statement, (i,))
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(sql_trace, 'MODE', 'on')
+    app = Flask(__name__)
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+
+    @app.route('/loop')
+    def loop():
+        run("SELECT * FROM services WHERE category_id = %s", times=6)
+        return "ok"
+
+    @app.route('/boom')
+    def boom():
+        run("SELECT 1")
+        raise RuntimeError("boom")
+
+    assert sql_trace.instrument(app)
+    return app
+
+
+def test_statement_shape_ignores_literals_and_value_lists():
+    assert sql_trace.statement_shape(
+        b"INSERT INTO t (a, b) VALUES ('x', 1), ('y''s', 2.5)"
+    ) == "INSERT INTO t (a, b) VALUES (...)"
+    assert sql_trace.statement_shape(
+        "SELECT * FROM t WHERE id = ANY(ARRAY[1,2]) AND n IN (%s, %s)"
+    ) == "SELECT * FROM t WHERE id = ANY(ARRAY[...]) AND n IN (...)"
+
+
+def test_assert_max_queries_reports_n_plus_one(app):
+    client = app.test_client()
+    with pytest.raises(AssertionError, match=r"N\+1"):
+        with sql_trace.assert_max_queries(10):
+            client.get('/loop')
+    with pytest.raises(AssertionError, match="Query budget of 3 exceeded"):
+        sql_trace.assert_query_budgets(client, {"/loop": 3})
+
+
+def test_unhandled_exception_does_not_leave_trace_recording(app):
+    client = app.test_client()
+    with pytest.raises(RuntimeError):
+        client.get('/boom')
+    assert sql_trace._active() == []
+
+    # Statements outside any request are no longer attributed to the failed one
+    with sql_trace.capture() as trace:
+        run("SELECT 2")
+    assert trace.count == 1
+    assert sql_trace._active() == []